@@ -20,14 +20,20 @@
 import requests
 import jsons
 
+import concurrent.futures
+import glob
+import json
+import threading
 import uuid
 import pathlib
 import logging
 import sys
 import os
 import base64
+import hashlib
 import time
 import random
+import urllib.parse
 
 from configparser import ConfigParser
 
@@ -138,6 +144,67 @@ def web_service_get(url):
     return None
     
 
+###################################################################
+#
+# web_service_get_pages
+#
+# List endpoints return one page of results at a time, as
+# {"items": [...], "next": token}. This follows the next tokens,
+# yielding one page (the response) at a time, so the next page
+# is only requested once the caller asks for it.
+#
+PAGE_SIZE = 25
+
+def web_service_get_pages(url, limit=PAGE_SIZE):
+  """
+  Generator that GETs a paginated web service one page at a
+  time (with retries, see web_service_get). Yields each
+  response; stops after a response without a next page, or
+  after a failed (non-200) response, which is yielded so the
+  caller can report it.
+
+  Parameters
+  ----------
+  url: url for calling the web service
+  limit: number of items per page
+
+  Returns
+  -------
+  generator of responses (None if the service could not be
+  reached)
+  """
+  after = None
+
+  while True:
+    params = {"limit": limit}
+    if after is not None:
+      params["after"] = after
+
+    sep = "&" if "?" in url else "?"
+    res = web_service_get(url + sep + urllib.parse.urlencode(params))
+
+    yield res
+
+    if res is None or res.status_code != 200:
+      return
+
+    after = res.json().get("next")
+    if after is None:
+      return
+
+
+def more_pages():
+  """
+  Asks the user whether to fetch the next page of results
+
+  Returns
+  -------
+  True to continue, False to stop
+  """
+  print("Press ENTER for more, or 'q' to stop>")
+  return input().strip().lower() != "q"
+
+
 ############################################################
 #
 # prompt
@@ -166,6 +233,9 @@ def prompt():
     print("   6 => retrieve gallery by labels")
     print("   7 => download image")
     print("   8 => process image")
+    print("   9 => photo details")
+    print("  10 => find similar photos")
+    print("  11 => upload a directory")
 
     cmd = input()
 
@@ -209,47 +279,53 @@ def users(baseurl):
     api = '/users'
     url = baseurl + api
 
-    # res = requests.get(url)
-    res = web_service_get(url)
-
     #
-    # let's look at what we got back:
+    # users come back one page at a time:
     #
-    if res.status_code == 200: #success
-      pass
-    else:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 500:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
+    shown = 0
+
+    for res in web_service_get_pages(url):
       #
-      return
+      # let's look at what we got back:
+      #
+      if res.status_code == 200: #success
+        pass
+      else:
+        # failed:
+        print("Failed with status code:", res.status_code)
+        print("url: " + url)
+        if res.status_code == 500:
+          # we'll have an error message
+          body = res.json()
+          print("Error message:", body)
+        #
+        return
 
-    #
-    # deserialize and extract users:
-    #
-    body = res.json()
+      #
+      # deserialize and extract users:
+      #
+      body = res.json()
 
-    #
-    # let's map each row into a User object:
-    #
-    users = []
-    for row in body:
-      user = User(row)
-      users.append(user)
-    #
-    # Now we can think OOP:
-    #
-    if len(users) == 0:
-      print("no users...")
-      return
+      #
+      # let's map each row into a User object:
+      #
+      users = []
+      for row in body["items"]:
+        user = User(row)
+        users.append(user)
+      #
+      # Now we can think OOP:
+      #
+      for user in users:
+        print(" - User Id: ",user.userid)
+        print("   User Name: ", user.username)
+      shown += len(users)
+
+      if body["next"] is not None and not more_pages():
+        break
 
-    for user in users:
-      print(" - User Id: ",user.userid)
-      print("   User Name: ", user.username)
+    if shown == 0:
+      print("no users...")
     #
     return
 
@@ -355,37 +431,46 @@ def listphotos(baseurl):
       #get labels of the input userid TODO what is our api
       api = f"/listphotos/{userid}"
       url = baseurl + api
-      res = web_service_get(url)
 
-      if res is None:
-        print("Fail to list photos.")
-        return
+      shown = 0
 
-      if res.status_code == 400:
-        print(res.json())
-        return
+      for res in web_service_get_pages(url):
+        if res is None:
+          print("Fail to list photos.")
+          return
+
+        if res.status_code == 400:
+          print(res.json())
+          return
 
-      if res.status_code !=200:
-        print(f"Fail with status code: {res.status_code}")
+        if res.status_code !=200:
+          print(f"Fail with status code: {res.status_code}")
+          return
 
-      #successful 200
-      photos = res.json()
+        #successful 200
+        body = res.json()
+        photos = body["items"]
 
-      if not photos:
+        ##display this page of photos
+        if shown == 0 and photos:
+          print(f"\nList all photos of user {userid}:")
+        for photo in photos:
+            print(f"  \nPhoto Details:")
+            print(f"  User ID: {photo[1]}")
+            print(f"  Photo ID: {photo[0]}")
+            print(f"  Photo Original Name: {photo[2]}")
+            if photo[3] is not None:
+              print(f"  Size: {photo[3]}x{photo[4]} {photo[5]}, {photo[6]} bytes")
+            print("\n")
+        shown += len(photos)
+
+        if body["next"] is not None and not more_pages():
+          break
+
+      if shown == 0:
         print(f"No photos found for user {userid}")
         return
 
-
-      ##display all the photos
-      print(f"\nList all photos of user {userid}:")
-      for photo in photos:
-          print(f"  \nPhoto Details:")
-          print(f"  User ID: {photo[1]}")
-          print(f"  Photo ID: {photo[0]}")
-          print(f"  Photo Original Name: {photo[2]}")
-          print("\n")    
-
-
     except Exception as e:
       logging.error("**ERROR: listphotos() failed:")
       logging.error(e)
@@ -398,6 +483,235 @@ def listphotos(baseurl):
 #
 # upload
 #
+#
+# a reservation is not used this close (seconds) to its expiry:
+#
+RESERVATION_MARGIN = 60
+
+
+def reservation_valid(reservation):
+  """
+  Returns True if the reservation (from /upload-url, with the
+  time it was issued) can still be used for the PUT
+  """
+  return ("uploadid" in reservation and
+          time.time() < reservation["issued_at"] + reservation["expires_in"] - RESERVATION_MARGIN)
+
+
+def presigned_upload(baseurl, userid, local_filename, reservation=None):
+  """
+  Uploads a photo in three steps: reserve the upload and get a
+  presigned S3 URL from the web service, PUT the file straight
+  to S3, then ask the web service to finalize the upload
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  userid: user id (string)
+  local_filename: path of the photo to upload
+  reservation: dict kept between attempts at the same file; an
+    earlier reservation in it is reused unless it has expired,
+    and once the file is sent, a retry only finalizes
+
+  Returns
+  -------
+  the response of the step that failed, or of the finalize
+  step (its body has the new photoid)
+  """
+  if reservation is None:
+    reservation = {}
+
+  with open(local_filename, "rb") as infile:
+    bytes = infile.read()
+
+  if not reservation.get("sent") and not reservation_valid(reservation):
+    data = {
+      "filename": local_filename,
+      "bytesize": len(bytes),
+      "sha256": hashlib.sha256(bytes).hexdigest()
+    }
+
+    url = baseurl + f"/upload-url/{userid}"
+    res = requests.post(url, json=data)
+    if res.status_code != 200:
+      return res
+
+    reservation.clear()
+    reservation.update(res.json(), issued_at=time.time())
+
+  if not reservation.get("sent"):
+    #
+    # S3 checks the signed headers (type, length, checksum):
+    #
+    res = requests.put(reservation["url"], data=bytes, headers=reservation["headers"])
+    if res.status_code != 200:
+      print("S3 rejected the upload:", res.status_code, res.text)
+      return res
+    reservation["sent"] = True
+
+  url = baseurl + f"/upload-finalize/{userid}/{reservation['uploadid']}"
+  return requests.post(url, json={})
+
+
+#
+# files larger than this are uploaded in parts, in parallel:
+#
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_WORKERS = 4
+MANIFEST_DIR = ".pixeltailor-uploads"
+
+
+def file_sha256(local_filename):
+  """
+  Returns the SHA-256 (hex) of a file, reading it in chunks
+  """
+  digest = hashlib.sha256()
+  with open(local_filename, "rb") as infile:
+    for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+class UploadManifest:
+  """
+  Local record of a multipart upload in progress: the upload id
+  and part size the server gave us, and the ETag of every part
+  S3 has confirmed. Saved after each part, so an interrupted
+  upload resumes from the parts already sent. Keyed by user and
+  file content, in MANIFEST_DIR.
+  """
+
+  def __init__(self, userid, sha256):
+    self.path = pathlib.Path(MANIFEST_DIR) / f"{userid}-{sha256}.json"
+    self.state = {}
+    self.lock = threading.Lock()
+    if self.path.is_file():
+      with open(self.path) as infile:
+        self.state = json.load(infile)
+
+  def start(self, uploadid, part_size, part_count):
+    self.state = {"uploadid": uploadid, "part_size": part_size,
+                  "part_count": part_count, "parts": {}}
+    self.save()
+
+  def confirm(self, part_number, etag):
+    with self.lock:
+      self.state["parts"][str(part_number)] = etag
+      self.save()
+
+  def pending_parts(self):
+    done = self.state.get("parts", {})
+    return [n for n in range(1, self.state["part_count"] + 1) if str(n) not in done]
+
+  def save(self):
+    #
+    # write then rename, so a crash never leaves half a manifest:
+    #
+    self.path.parent.mkdir(exist_ok=True)
+    temp = self.path.with_suffix(".tmp")
+    with open(temp, "w") as outfile:
+      json.dump(self.state, outfile)
+    os.replace(temp, self.path)
+
+  def discard(self):
+    self.state = {}
+    if self.path.is_file():
+      self.path.unlink()
+
+
+def multipart_upload(baseurl, userid, local_filename, workers=MULTIPART_WORKERS):
+  """
+  Uploads a large photo in parts, PUT straight to S3 by a pool
+  of threads, then completes and finalizes the upload. Resumes
+  a previous, interrupted upload of the same file if there is
+  one.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  userid: user id (string)
+  local_filename: path of the photo to upload
+  workers: # of parts uploaded at the same time
+
+  Returns
+  -------
+  the response of the step that failed, or of the finalize
+  step (its body has the new photoid)
+  """
+  bytesize = os.path.getsize(local_filename)
+  sha256 = file_sha256(local_filename)
+  api = baseurl + f"/multipart/{userid}"
+
+  manifest = UploadManifest(userid, sha256)
+
+  if manifest.state:
+    print(f"Resuming upload {manifest.state['uploadid']}: "
+          f"{len(manifest.state['parts'])} of {manifest.state['part_count']} parts already sent")
+  else:
+    data = {"filename": local_filename, "bytesize": bytesize, "sha256": sha256}
+    res = requests.post(api + "/initiate", json=data)
+    if res.status_code != 200:
+      return res
+    body = res.json()
+    manifest.start(body["uploadid"], body["part_size"], body["part_count"])
+
+  uploadid = manifest.state["uploadid"]
+  part_size = manifest.state["part_size"]
+
+  def put_part(part_number, url):
+    with open(local_filename, "rb") as infile:
+      infile.seek((part_number - 1) * part_size)
+      data = infile.read(part_size)
+    for attempt in range(3):
+      res = requests.put(url, data=data)
+      if res.status_code == 200:
+        manifest.confirm(part_number, res.headers["ETag"])
+        return
+      time.sleep(attempt + 1)
+    raise Exception(f"part {part_number} failed with status code {res.status_code}")
+
+  pending = manifest.pending_parts()
+
+  #
+  # presigned URLs expire, so ask for them as we go, a batch
+  # at a time:
+  #
+  for start in range(0, len(pending), 100):
+    batch = pending[start:start + 100]
+    res = requests.post(api + "/presign", json={"uploadid": uploadid, "part_numbers": batch})
+    if res.status_code == 400:
+      # the server no longer knows the upload: start over next time
+      manifest.discard()
+      return res
+    if res.status_code != 200:
+      return res
+    urls = res.json()["urls"]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      futures = [pool.submit(put_part, n, urls[str(n)]) for n in batch]
+      for future in concurrent.futures.as_completed(futures):
+        future.result()  # re-raises a failed part; the manifest keeps the others
+
+    print(f"  {len(manifest.state['parts'])} of {manifest.state['part_count']} parts sent")
+
+  #
+  # completing (and finalizing) again is harmless, so an upload
+  # whose reply was lost just carries on here when resumed:
+  #
+  res = requests.post(api + "/complete", json={"uploadid": uploadid})
+  if res.status_code == 400:
+    # the upload is gone, or S3 lacks parts we have: start over next time
+    manifest.discard()
+    return res
+  if res.status_code != 200:
+    return res
+
+  res = requests.post(baseurl + f"/upload-finalize/{userid}/{uploadid}", json={})
+  if res.status_code == 200:
+    manifest.discard()
+  return res
+
+
 def upload(baseurl):
   """
   Prompts the user for a local filename and user id, 
@@ -428,30 +742,13 @@ def upload(baseurl):
         print("Invalid input. User ID must be numbers.")
         return
     #
-    # build the data packet. First step is read the PDF
-    # as raw bytes:
-    #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
-
-    #
-    # now encode the pdf as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for upload to server:
-    #
-    
-    datastr = base64.b64encode(bytes).decode('utf-8')
-    
-    data = {"filename": local_filename, "data": datastr}
-
-    #
-    # call the web service:
+    # the image goes straight to S3 with a presigned PUT, then
+    # the upload is confirmed:
     #
-    api = f"/upload/{userid}"
-    url = baseurl + api
-    res = requests.post(url, json=data)
+    if os.path.getsize(local_filename) > MULTIPART_THRESHOLD:
+      res = multipart_upload(baseurl, userid, local_filename)
+    else:
+      res = presigned_upload(baseurl, userid, local_filename)
     
     #
     # let's look at what we got back:
@@ -465,7 +762,7 @@ def upload(baseurl):
     else:
       # failed:
       print("Failed with status code:", res.status_code)
-      print("url: " + url)
+      print("url: " + res.url)
       if res.status_code == 500:
         # we'll have an error message
         body = res.json()
@@ -479,11 +776,265 @@ def upload(baseurl):
     body = res.json()
     newid = body["photoid"]
     print("The photo ",newid," was uploaded successfully")
+    if body.get("duplicate"):
+      print("(same content as an earlier upload: stored once, labels reused)")
     return
 
   except Exception as e:
     logging.error("**ERROR: upload() failed:")
-    logging.error("url: " + url)
+    logging.error("baseurl: " + baseurl)
+    logging.error(e)
+    return
+
+
+############################################################
+#
+# bulk upload
+#
+BULK_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+BULK_WORKERS = 4
+BULK_ATTEMPTS = 5
+RESERVE_BATCH = 100  # most uploads /upload-url reserves at once
+
+
+def find_photos(path):
+  """
+  Returns the photo files (.jpg, .jpeg, .png) under a directory,
+  recursively, or matching a glob pattern, sorted by name
+  """
+  if os.path.isdir(path):
+    candidates = [str(p) for p in pathlib.Path(path).rglob("*")]
+  else:
+    candidates = glob.glob(path, recursive=True)
+
+  return sorted(c for c in candidates
+                if os.path.isfile(c) and pathlib.Path(c).suffix.lower() in BULK_EXTENSIONS)
+
+
+class UploadedManifest:
+  """
+  Local record of the photos a user has uploaded from this
+  machine, by content hash (so a renamed or moved file is still
+  recognized), plus a cache of each file's hash by path, size
+  and modification time, so unchanged files are not re-read to
+  be hashed. Kept in MANIFEST_DIR, saved after every upload.
+  """
+
+  def __init__(self, userid):
+    self.path = pathlib.Path(MANIFEST_DIR) / f"uploaded-{userid}.json"
+    self.lock = threading.Lock()
+    self.state = {"uploaded": {}, "hashes": {}}
+    if self.path.is_file():
+      with open(self.path) as infile:
+        self.state = json.load(infile)
+
+  def sha256(self, filename):
+    info = os.stat(filename)
+    key = os.path.abspath(filename)
+    cached = self.state["hashes"].get(key)
+    if cached and cached[0] == info.st_size and cached[1] == info.st_mtime_ns:
+      return cached[2]
+    sha256 = file_sha256(filename)
+    with self.lock:
+      self.state["hashes"][key] = [info.st_size, info.st_mtime_ns, sha256]
+    return sha256
+
+  def photoid(self, sha256):
+    return self.state["uploaded"].get(sha256)
+
+  def record(self, sha256, photoid):
+    with self.lock:
+      self.state["uploaded"][sha256] = photoid
+      self.save()
+
+  def save(self):
+    self.path.parent.mkdir(exist_ok=True)
+    temp = self.path.with_suffix(".tmp")
+    with open(temp, "w") as outfile:
+      json.dump(self.state, outfile)
+    os.replace(temp, self.path)
+
+
+class Progress:
+  """
+  Thread-safe progress of a bulk upload: files and bytes done,
+  and from them the throughput and an ETA, printed on one line
+  """
+
+  def __init__(self, files, total_bytes):
+    self.files = files
+    self.total_bytes = total_bytes
+    self.done_files = 0
+    self.done_bytes = 0
+    self.failed = 0
+    self.started = time.time()
+    self.lock = threading.Lock()
+
+  def update(self, nbytes, failed=False):
+    with self.lock:
+      self.done_files += 1
+      self.done_bytes += nbytes
+      self.failed += 1 if failed else 0
+
+      elapsed = max(time.time() - self.started, 0.001)
+      rate = self.done_bytes / elapsed
+      remaining = self.total_bytes - self.done_bytes
+      eta = remaining / rate if rate > 0 else 0
+
+      print(f"\r  {self.done_files}/{self.files} files, "
+            f"{self.done_bytes / 1e6:.1f}/{self.total_bytes / 1e6:.1f} MB, "
+            f"{rate / 1e6:.2f} MB/s, ETA {int(eta) // 60}m{int(eta) % 60:02d}s, "
+            f"{self.failed} failed   ", end="", flush=True)
+
+
+def reserve_uploads(baseurl, userid, files):
+  """
+  Reserves presigned uploads for the files (a list of (filename,
+  sha256)) not large enough for a multipart upload, in one
+  request. Returns a dict of filename -> reservation; a file the
+  server refused, or every file if the request failed, has none.
+  """
+  small = [(filename, sha256) for filename, sha256 in files
+           if os.path.getsize(filename) <= MULTIPART_THRESHOLD]
+  if not small:
+    return {}
+
+  data = {"files": [{"filename": filename, "bytesize": os.path.getsize(filename),
+                     "sha256": sha256}
+                    for filename, sha256 in small]}
+
+  try:
+    res = requests.post(baseurl + f"/upload-url/{userid}", json=data)
+  except Exception:
+    return {}
+  if res.status_code != 200:
+    return {}
+
+  issued_at = time.time()
+  return {filename: dict(result, issued_at=issued_at)
+          for (filename, sha256), result in zip(small, res.json()["results"])
+          if "uploadid" in result}
+
+
+def with_retries(upload_once, attempts=BULK_ATTEMPTS):
+  """
+  Calls upload_once() until it returns a response that is not
+  worth retrying (success, or a 4xx other than 429), waiting
+  with exponential backoff and jitter between attempts. Returns
+  the last response; raises the last error if every attempt
+  raised one.
+  """
+  for attempt in range(attempts):
+    try:
+      res = upload_once()
+      if res.status_code < 500 and res.status_code != 429:
+        return res
+    except Exception:
+      if attempt == attempts - 1:
+        raise
+    if attempt < attempts - 1:
+      time.sleep(min(2 ** attempt, 30) + random.uniform(0, 1))
+  return res
+
+
+def bulk_upload(baseurl):
+  """
+  Prompts the user for a user id, a directory or glob pattern, and
+  a number of workers, and uploads every photo found, several at a
+  time, skipping photos already uploaded (by content hash)
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+  try:
+    print("Enter user id>")
+    userid = input().strip()
+
+    if userid == "" or not userid.isdigit():
+      print("Invalid input. User ID must be numbers.")
+      return
+
+    print("Enter directory or glob pattern (e.g. photos/**/*.jpg)>")
+    path = input().strip()
+
+    print(f"Enter number of parallel uploads (blank for {BULK_WORKERS})>")
+    workers = input().strip()
+    workers = int(workers) if workers.isdigit() and int(workers) > 0 else BULK_WORKERS
+
+    filenames = find_photos(path)
+    if not filenames:
+      print("No .jpg, .jpeg or .png files found.")
+      return
+
+    manifest = UploadedManifest(userid)
+
+    print(f"Hashing {len(filenames)} files...")
+    todo = []
+    skipped = 0
+    for filename in filenames:
+      sha256 = manifest.sha256(filename)
+      if manifest.photoid(sha256) is not None:
+        skipped += 1
+      else:
+        todo.append((filename, sha256))
+    manifest.save()
+
+    print(f"{skipped} already uploaded, {len(todo)} to upload")
+    if not todo:
+      return
+
+    progress = Progress(len(todo), sum(os.path.getsize(f) for f, sha256 in todo))
+    failures = []
+
+    def upload_one(filename, sha256, reservation):
+      size = os.path.getsize(filename)
+
+      #
+      # every attempt at the file shares its reservation, so a
+      # retry reuses it (and skips the PUT once it succeeded):
+      #
+      def upload_once():
+        if size > MULTIPART_THRESHOLD:
+          return multipart_upload(baseurl, userid, filename)
+        return presigned_upload(baseurl, userid, filename, reservation)
+
+      try:
+        res = with_retries(upload_once)
+        if res.status_code == 200:
+          manifest.record(sha256, res.json()["photoid"])
+          progress.update(size)
+          return
+        failures.append((filename, f"status code {res.status_code}: {res.text[:200]}"))
+      except Exception as e:
+        failures.append((filename, str(e)))
+      progress.update(size, failed=True)
+
+    #
+    # reserve the uploads a batch at a time, with one request per
+    # batch, just before they are sent; a file left without a
+    # reservation is reserved on its own when it is sent:
+    #
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      for start in range(0, len(todo), RESERVE_BATCH):
+        batch = todo[start:start + RESERVE_BATCH]
+        reservations = reserve_uploads(baseurl, userid, batch)
+
+        futures = [pool.submit(upload_one, filename, sha256, reservations.get(filename, {}))
+                   for filename, sha256 in batch]
+        concurrent.futures.wait(futures)
+
+    print()
+    print(f"{len(todo) - len(failures)} uploaded, {skipped} skipped, {len(failures)} failed")
+    for filename, error in failures:
+      print(f"  {filename}: {error}")
+
+  except Exception as e:
+    logging.error("**ERROR: bulk_upload() failed:")
     logging.error(e)
     return
 
@@ -546,6 +1097,115 @@ def download_photo(baseurl):
         print(f"**ERROR**: {str(e)}")
 
 
+############################################################
+#
+# photo metadata
+#
+def photo_metadata(baseurl):
+    """
+    Prompts the user for photoid and userid, and prints the photo's
+    metadata (dimensions, format, size) without downloading it.
+
+    Parameters
+    ----------
+    baseurl: base URL for the web service
+
+    Returns
+    -------
+    nothing
+    """
+    try:
+        print("Enter Photo ID>")
+        photoid = input().strip()
+
+        print("Enter User ID>")
+        userid = input().strip()
+
+        if not photoid.isdigit() or not userid.isdigit():
+            print("Invalid input. Photo ID and User ID must be numbers.")
+            return
+
+        api = f"/metadata/{userid}/{photoid}"
+        url = f"{baseurl}{api}"
+
+        response = requests.get(url)
+
+        if response.status_code == 200:
+            meta = response.json()
+            print(f"Photo ID: {meta['photoid']}")
+            print(f"Original Name: {meta['original_name']}")
+            if meta["complete"]:
+                print(f"Dimensions: {meta['width']}x{meta['height']}")
+                print(f"Format: {meta['format']} ({meta['mode']})")
+                print(f"Size: {meta['bytesize']} bytes")
+                print(f"SHA-256: {meta['sha256']}")
+            else:
+                print("No metadata recorded for this photo yet.")
+        elif response.status_code == 400:
+            print(response.json())
+        else:
+            print(f"Failed to get photo details. Status code: {response.status_code}")
+            print("Error: ", response.text)
+
+    except Exception as e:
+        print(f"**ERROR**: {str(e)}")
+
+
+############################################################
+#
+# similar photos
+#
+def similar_photos(baseurl):
+    """
+    Prompts the user for photoid, userid and a maximum distance, and
+    lists the user's photos that look nearly the same as that photo.
+
+    Parameters
+    ----------
+    baseurl: base URL for the web service
+
+    Returns
+    -------
+    nothing
+    """
+    try:
+        print("Enter Photo ID>")
+        photoid = input().strip()
+
+        print("Enter User ID>")
+        userid = input().strip()
+
+        if not photoid.isdigit() or not userid.isdigit():
+            print("Invalid input. Photo ID and User ID must be numbers.")
+            return
+
+        print("Enter maximum distance (0-12, blank for 10)>")
+        max_distance = input().strip()
+
+        api = f"/similar/{userid}/{photoid}"
+        url = f"{baseurl}{api}"
+        if max_distance:
+            url += "?" + urllib.parse.urlencode({"max_distance": max_distance})
+
+        response = requests.get(url)
+
+        if response.status_code == 200:
+            body = response.json()
+            if not body["similar"]:
+                print("No similar photos found.")
+                return
+            for photo in body["similar"]:
+                print(f"  Photo ID: {photo['photoid']}  distance: {photo['distance']}  ({photo['original_name']})")
+        elif response.status_code == 400:
+            print(response.json())
+        else:
+            print(f"Failed to find similar photos. Status code: {response.status_code}")
+            print("Error: ", response.text)
+
+    except Exception as e:
+        print(f"**ERROR**: {str(e)}")
+
+
 ############################################################
 # 
 # process image
@@ -710,8 +1370,8 @@ def validate_color_name():
 #
 def delete(baseurl):
   """
-  Prompts the user for a local filename and user id.
-  Delete that photo
+  Prompts the user for a user id and one or more photo ids.
+  Delete those photos
 
   Parameters
   ----------
@@ -727,16 +1387,23 @@ def delete(baseurl):
     print("Enter user id>")
     userid = input()
 
-    print("Enter photo id>")
-    photoid = input()
+    print("Enter photo id(s), separated by commas>")
+    photoids = [photoid.strip() for photoid in input().split(",") if photoid.strip()]
 
-    if userid =="" or not userid.isdigit() or not photoid.isdigit():
-      print("Invalid input. User ID must be numbers.")
+    if userid =="" or not userid.isdigit() or not photoids or not all(p.isdigit() for p in photoids):
+      print("Invalid input. User ID and photo IDs must be numbers.")
       return
     
     api = f"/delete/{userid}"
     url = baseurl + api
-    data = {"photoid":photoid}
+
+    #
+    # one request deletes up to 1000 photos:
+    #
+    if len(photoids) == 1:
+      data = {"photoid": photoids[0]}
+    else:
+      data = {"photoids": photoids}
 
     res = requests.delete(url, json=data)
     
@@ -758,13 +1425,25 @@ def delete(baseurl):
       return
 
     #
-    # success, extract photoid:
+    # success:
     #
-    print("The photo ",photoid," was deleted successfully.")
+    if len(photoids) == 1:
+      print("The photo ",photoids[0]," was deleted successfully.")
+      return
+
+    body = res.json()
+    for result in body["results"]:
+      if result["status"] == "deleted":
+        print("The photo ", result["photoid"], " was deleted successfully.")
+      elif result["status"] == "not_found":
+        print("The photo ", result["photoid"], " was not found.")
+      else:
+        print("The photo ", result["photoid"], " could not be deleted:", result.get("error"))
+    print(body["deleted"], "of", len(photoids), "photos deleted.")
     return
 
   except Exception as e:
-    logging.error("**ERROR: upload() failed:")
+    logging.error("**ERROR: delete() failed:")
     logging.error("url: " + url)
     logging.error(e)
     return
@@ -817,10 +1496,10 @@ def retrieve_user_labels_and_images(baseurl):
         print(f"No labels found for user {userid}")
         return
 
-      ##display all the labels
+      ##display all the labels, with how many photos have each
       print(f"Lable for user {userid}:")
       for label in labels:
-        print(f" - {label} \n")
+        print(f" - {label['labelname']} ({label['photo_count']} photos) \n")
 
       
       #prompt for user to select which label they want contain in the photo or EXIT
@@ -834,36 +1513,40 @@ def retrieve_user_labels_and_images(baseurl):
 
         api_photos = f"/labelphoto/{userid}/{selected_label}"
         url_photos = baseurl + api_photos
-        res_photos = web_service_get(url_photos)
 
-        if res_photos is None:
-          print("Fail to retrieve photos.")
-          continue
+        shown = 0
 
-        if res_photos.status_code == 400:
-          print(res_photos.json())
-          continue
+        for res_photos in web_service_get_pages(url_photos):
+          if res_photos is None:
+            print("Fail to retrieve photos.")
+            break
 
-        if res_photos.status_code != 200:
-          print(f"Failed with status code: {res_images.status_code}")
-          continue
+          if res_photos.status_code == 400:
+            print(res_photos.json())
+            break
 
-        #photos infomation
-        photos = res_photos.json()
+          if res_photos.status_code != 200:
+            print(f"Failed with status code: {res_photos.status_code}")
+            break
 
-        if not photos:
-          print(f"No photos found for label {selected_label}")
-          continue
+          #photos infomation
+          body = res_photos.json()
+          photos = body["items"]
 
-        ##display all the labels
-        print(f"\nPhotos with label {selected_label}:")
-        for photo in photos:
-          print(f"  \nPhoto Details:")
-          print(f"  User ID: {photo.get('userid', 'N/A')}")
-          print(f"  Photo ID: {photo.get('photoid', 'N/A')}")
-          print(f"  Lable Name: {photo.get('labelname', 'N/A')}")
-          print(f"  Photo Original Name: {photo.get('original_name', 'N/A')}")
-          print("\n")
+          ##display this page of photos
+          if shown == 0 and photos:
+            print(f"\nPhotos with label {selected_label}:")
+          for photo in photos:
+            print(f"  \nPhoto Details:")
+            print(f"  User ID: {photo.get('userid', 'N/A')}")
+            print(f"  Photo ID: {photo.get('photoid', 'N/A')}")
+            print(f"  Lable Name: {photo.get('labelname', 'N/A')}")
+            print(f"  Photo Original Name: {photo.get('original_name', 'N/A')}")
+            print("\n")
+          shown += len(photos)
+
+          if body["next"] is not None and not more_pages():
+            break
 
 
 
@@ -946,6 +1629,12 @@ try:
        download_photo(baseurl)
     elif cmd == 8:
        process_image(baseurl)
+    elif cmd == 9:
+       photo_metadata(baseurl)
+    elif cmd == 10:
+       similar_photos(baseurl)
+    elif cmd == 11:
+       bulk_upload(baseurl)
     else:
       print("** Unknown command, try again...")
     #
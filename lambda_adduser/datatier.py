@@ -8,7 +8,17 @@
 #   Northwestern University
 #
 
+import contextlib
+import hashlib
+import json
+import os
 import pymysql
+import re
+import threading
+import time
+import weakref
+
+from pymysql.constants import SERVER_STATUS
 
 
 ###################################################################
@@ -50,6 +60,466 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
     raise
 
 
+###################################################################
+#
+# rds_settings:
+#
+# Reads the connection settings for the database from the
+# config file. Writes go to the primary, configured in the
+# [rds] section. Handlers that only SELECT can pass
+# readonly=True to be routed to the [rds_readonly] section
+# instead, e.g. a read replica endpoint and the
+# pixel-tailor-read-only account; any setting missing from
+# that section (or the whole section) falls back to [rds].
+#
+def rds_settings(configur, readonly=False):
+  """
+  Returns the database connection settings from the config
+  file, for the primary or the read-only endpoint
+
+  Parameters
+  ----------
+  configur : the ConfigParser holding the config file,
+  readonly : True for SELECT-only access (boolean)
+
+  Returns
+  -------
+  tuple (endpoint, portnum, username, pwd, dbname)
+  """
+  section = 'rds'
+  if readonly and configur.has_section('rds_readonly'):
+    section = 'rds_readonly'
+
+  def setting(key):
+    return configur.get(section, key, fallback=configur.get('rds', key))
+
+  return (setting('endpoint'),
+          int(setting('port_number')),
+          setting('user_name'),
+          setting('user_pwd'),
+          setting('db_name'))
+
+
+###################################################################
+#
+# ConnectionPool:
+#
+# A small pool of open MySQL connections that lives at module
+# scope, and so survives across warm Lambda invocations. Idle
+# connections are pinged (and transparently reopened) before
+# being handed out, and the total number of open connections
+# is capped so a burst of traffic cannot exhaust the server.
+#
+class ConnectionPool:
+  """
+  Thread-safe pool of connections to one MySQL database
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string),
+  max_connections : cap on open connections (integer),
+  ping_after : seconds a connection may sit idle before it is
+    pinged on checkout (float),
+  acquire_timeout : seconds to wait for a free connection
+    before giving up (float)
+  """
+
+  def __init__(self, endpoint, portnum, username, pwd, dbname,
+               max_connections=4, ping_after=30.0, acquire_timeout=10.0):
+    self.endpoint = endpoint
+    self.portnum = portnum
+    self.username = username
+    self.pwd = pwd
+    self.dbname = dbname
+    self.max_connections = max_connections
+    self.ping_after = ping_after
+    self.acquire_timeout = acquire_timeout
+
+    self._idle = []       # list of (connection, time released)
+    self._in_use = set()  # ids of connections handed out
+    self._opening = 0     # connections being opened or pinged
+    self._cond = threading.Condition()
+
+  def _open(self):
+    return get_dbConn(self.endpoint, self.portnum, self.username,
+                      self.pwd, self.dbname)
+
+  def _revive(self, dbConn, released):
+    #
+    # a connection that has been idle for a while may have been
+    # dropped by the server (wait_timeout) or by the network while
+    # the Lambda container was frozen; ping reconnects if so:
+    #
+    if time.monotonic() - released < self.ping_after:
+      return dbConn
+    try:
+      dbConn.ping(reconnect=True)
+      return dbConn
+    except Exception as err:
+      print("datatier.ConnectionPool: stale connection, reopening:")
+      print(str(err))
+      _close_quietly(dbConn)
+      return self._open()
+
+  def acquire(self):
+    """
+    Checks out a connection, opening a new one if none are idle
+    and the cap has not been reached; otherwise waits up to
+    acquire_timeout seconds for one to be released
+
+    Returns
+    -------
+    a connection object
+    """
+    deadline = time.monotonic() + self.acquire_timeout
+
+    with self._cond:
+      while True:
+        if self._idle:
+          dbConn, released = self._idle.pop()  # LIFO: warmest first
+          break
+        if len(self._in_use) + self._opening < self.max_connections:
+          dbConn, released = None, None
+          break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          raise Exception("datatier.ConnectionPool: no free connection after "
+                          + str(self.acquire_timeout) + " seconds")
+        self._cond.wait(remaining)
+
+      # count the slot as taken before doing any I/O:
+      self._opening += 1
+
+    result = None
+    try:
+      if dbConn is None:
+        result = self._open()
+      else:
+        result = self._revive(dbConn, released)
+    finally:
+      with self._cond:
+        self._opening -= 1
+        if result is not None:
+          self._in_use.add(id(result))
+        self._cond.notify()
+
+    return result
+
+  def owns(self, dbConn):
+    with self._cond:
+      return id(dbConn) in self._in_use
+
+  def release(self, dbConn):
+    """
+    Returns a connection to the pool. Any transaction left open
+    (including the read snapshot a SELECT starts) is rolled back
+    so the next invocation does not see stale data; connections
+    that fail to reset are closed rather than reused.
+    """
+    reusable = dbConn.open
+    if reusable and dbConn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+      try:
+        dbConn.rollback()
+      except Exception:
+        reusable = False
+
+    if not reusable:
+      _close_quietly(dbConn)
+
+    with self._cond:
+      self._in_use.discard(id(dbConn))
+      if reusable:
+        self._idle.append((dbConn, time.monotonic()))
+      self._cond.notify()
+
+  def close_all(self):
+    """
+    Closes every idle connection in the pool
+    """
+    with self._cond:
+      idle = self._idle
+      self._idle = []
+    for dbConn, released in idle:
+      _close_quietly(dbConn)
+
+
+#
+# pools are kept at module scope, keyed by connection settings,
+# so they are reused by every invocation of a warm container:
+#
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _close_quietly(dbConn):
+  try:
+    dbConn.close()
+  except Exception:
+    pass
+
+
+###################################################################
+#
+# get_pool:
+#
+# Returns the module-scope connection pool for the given
+# database, creating it on first use.
+#
+def get_pool(endpoint, portnum, username, pwd, dbname, max_connections=4):
+  """
+  Returns the (module-scope) connection pool for a MySQL
+  database, creating it the first time it is requested
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string),
+  max_connections : cap on open connections (integer)
+
+  Returns
+  -------
+  a ConnectionPool object
+  """
+  key = (endpoint, portnum, username, pwd, dbname)
+
+  with _pools_lock:
+    pool = _pools.get(key)
+    if pool is None:
+      pool = ConnectionPool(endpoint, portnum, username, pwd, dbname,
+                            max_connections=max_connections)
+      _pools[key] = pool
+
+  return pool
+
+
+###################################################################
+#
+# get_pooled_dbConn:
+#
+# Like get_dbConn, but checks the connection out of a pool that
+# is kept open across warm Lambda invocations. Hand it back with
+# release_dbConn when done.
+#
+def get_pooled_dbConn(endpoint, portnum, username, pwd, dbname):
+  """
+  Checks out a pooled connection for interacting with a MySQL
+  database; call release_dbConn() when done with it
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string)
+
+  Returns
+  -------
+  a connection object
+  """
+  pool = get_pool(endpoint, portnum, username, pwd, dbname)
+  return pool.acquire()
+
+
+###################################################################
+#
+# release_dbConn:
+#
+# Hands a connection obtained from get_pooled_dbConn back to
+# its pool. Safe to call with None, and closes connections that
+# did not come from a pool.
+#
+def release_dbConn(dbConn):
+  """
+  Returns a pooled connection to its pool (or closes it if it
+  was not pooled)
+
+  Parameters
+  ----------
+  dbConn : the database connection, or None
+
+  Returns
+  -------
+  nothing
+  """
+  if dbConn is None:
+    return
+
+  with _pools_lock:
+    pools = list(_pools.values())
+
+  for pool in pools:
+    if pool.owns(dbConn):
+      pool.release(dbConn)
+      return
+
+  _close_quietly(dbConn)
+
+
+##################################################################
+#
+# Query instrumentation:
+#
+# Every query executed through datatier is timed, and its row
+# count, approximate bytes returned and a fingerprint (the
+# normalized SQL text plus the shape of its parameters) are
+# recorded. Queries slower than the slow-query threshold are
+# logged as they happen, as one JSON object per line; set the
+# DATATIER_LOG_QUERIES environment variable to 1 to log every
+# query. Call reset_query_stats() at the start of an invocation
+# and log_query_summary() at the end to get the query count and
+# total DB time for that invocation, along with the most
+# repeated fingerprints (a hint of N+1 query patterns).
+#
+_slow_query_ms = float(os.environ.get('DATATIER_SLOW_QUERY_MS', '200'))
+_log_all_queries = os.environ.get('DATATIER_LOG_QUERIES', '') == '1'
+
+_stats_lock = threading.Lock()
+_stats = {'queries': 0, 'db_ms': 0.0, 'rows': 0, 'bytes': 0, 'errors': 0,
+          'slow': 0, 'fingerprints': {}}
+
+
+def set_slow_query_threshold(ms):
+  """
+  Sets the duration (in milliseconds) at or above which a query
+  is logged as slow
+
+  Parameters
+  ----------
+  ms : threshold in milliseconds (float)
+
+  Returns
+  -------
+  nothing
+  """
+  global _slow_query_ms
+  _slow_query_ms = float(ms)
+
+
+def reset_query_stats():
+  """
+  Clears the statistics gathered so far, e.g. at the start of
+  a Lambda invocation
+  """
+  with _stats_lock:
+    _stats.update(queries=0, db_ms=0.0, rows=0, bytes=0, errors=0, slow=0)
+    _stats['fingerprints'] = {}
+
+
+def query_summary(top=5):
+  """
+  Returns the statistics gathered since the last reset
+
+  Parameters
+  ----------
+  top : # of most frequently executed fingerprints to include
+
+  Returns
+  -------
+  dictionary with query count, total DB ms, rows, bytes, errors,
+  slow query count, and the top fingerprints by execution count
+  """
+  with _stats_lock:
+    fingerprints = sorted(_stats['fingerprints'].items(),
+                          key=lambda item: item[1]['count'], reverse=True)
+    return {
+      'queries': _stats['queries'],
+      'db_ms': round(_stats['db_ms'], 2),
+      'rows': _stats['rows'],
+      'bytes': _stats['bytes'],
+      'errors': _stats['errors'],
+      'slow': _stats['slow'],
+      'top': [dict(fingerprint=key, **value) for key, value in fingerprints[:top]]
+    }
+
+
+def log_query_summary():
+  """
+  Logs query_summary() as a structured (JSON) log record
+  """
+  record = {'event': 'datatier.summary'}
+  record.update(query_summary())
+  print(json.dumps(record, default=str))
+
+
+def _param_shape(parameters):
+  #
+  # the types of the parameters, not their values, so queries
+  # that differ only in their values share a fingerprint; long
+  # lists (e.g. expanded IN clauses) are summarized by length:
+  #
+  if isinstance(parameters, dict):
+    parameters = list(parameters.values())
+  if parameters is None:
+    return ""
+
+  shapes = [type(value).__name__ for value in parameters]
+  if len(shapes) > 8 and len(set(shapes)) == 1:
+    return shapes[0] + "*" + str(len(shapes))
+  return ",".join(shapes)
+
+
+def _fingerprint(sql, parameters):
+  normalized = " ".join(sql.split())
+  digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+  return digest + "/" + _param_shape(parameters), normalized
+
+
+def _approx_bytes(rows):
+  total = 0
+  for row in rows:
+    for value in row:
+      if isinstance(value, (str, bytes, bytearray)):
+        total += len(value)
+      elif value is not None:
+        total += 8
+  return total
+
+
+def _observe(kind, sql, parameters, started, rows=(), affected=None, nbytes=None,
+             error=None):
+  elapsed_ms = (time.perf_counter() - started) * 1000.0
+  fingerprint, normalized = _fingerprint(sql, parameters)
+
+  nrows = affected if affected is not None else len(rows)
+  if nbytes is None:
+    nbytes = _approx_bytes(rows)
+  slow = elapsed_ms >= _slow_query_ms
+
+  with _stats_lock:
+    _stats['queries'] += 1
+    _stats['db_ms'] += elapsed_ms
+    _stats['rows'] += max(nrows, 0)
+    _stats['bytes'] += nbytes
+    _stats['errors'] += 1 if error is not None else 0
+    _stats['slow'] += 1 if slow else 0
+
+    entry = _stats['fingerprints'].setdefault(fingerprint, {'count': 0, 'ms': 0.0})
+    entry['count'] += 1
+    entry['ms'] = round(entry['ms'] + elapsed_ms, 2)
+
+  if slow or _log_all_queries or error is not None:
+    record = {
+      'event': 'datatier.slow_query' if slow else 'datatier.query',
+      'kind': kind,
+      'ms': round(elapsed_ms, 2),
+      'rows': nrows,
+      'bytes': nbytes,
+      'fingerprint': fingerprint,
+      'sql': normalized[:500]
+    }
+    if error is not None:
+      record['error'] = str(error)
+    print(json.dumps(record, default=str))
+
+
 ##################################################################
 #
 # retrieve_one_row:
@@ -78,16 +548,20 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
   """
 
   dbCursor = dbConn.cursor()
+  started = time.perf_counter()
 
   try:
     dbCursor.execute(sql, parameters)
     row = dbCursor.fetchone()
+    _observe("retrieve_one_row", sql, parameters, started,
+             rows=[] if row is None else [row])
     if row is None:  # executed successfully, but no data was retrieved
       return ()
     else:
       return row
 
   except Exception as err:
+    _observe("retrieve_one_row", sql, parameters, started, error=err)
     print("datatier.retrieve_one_row() failed:")
     print(str(err))
     raise
@@ -125,16 +599,19 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   """
 
   dbCursor = dbConn.cursor()
+  started = time.perf_counter()
 
   try:
     dbCursor.execute(sql, parameters)
     rows = dbCursor.fetchall()
+    _observe("retrieve_all_rows", sql, parameters, started, rows=rows or [])
     if rows is None:  # executed successfully, but no data was retrieved
       return []
     else:
       return rows
 
   except Exception as err:
+    _observe("retrieve_all_rows", sql, parameters, started, error=err)
     print("datatier.retrieve_all_rows() failed:")
     print(str(err))
     raise
@@ -143,6 +620,127 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
     dbCursor.close()
 
 
+##################################################################
+#
+# stream_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query using an unbuffered (server-side) cursor
+# and yields the rows (tuples) one at a time, fetching them
+# from the server chunk_size rows at a time. Unlike
+# retrieve_all_rows, the full result set is never held in
+# memory. The connection cannot be used for anything else
+# until the generator is exhausted or closed.
+#
+def stream_rows(dbConn, sql, parameters=[], chunk_size=1000):
+  """
+  Executes an sql SELECT query against the database connection
+  and yields the rows as tuples, without materializing the
+  entire result set
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  chunk_size : # of rows fetched from the server at a time
+
+  Returns
+  _______
+  a generator of rows (tuples); yields nothing if SELECT
+  retrieves no data
+  """
+
+  dbCursor = dbConn.cursor(pymysql.cursors.SSCursor)
+  started = time.perf_counter()
+  fetched = 0
+  nbytes = 0
+
+  try:
+    dbCursor.execute(sql, parameters)
+
+    while True:
+      rows = dbCursor.fetchmany(chunk_size)
+      if not rows:
+        break
+      fetched += len(rows)
+      nbytes += _approx_bytes(rows)
+      for row in rows:
+        yield row
+
+    #
+    # (the time recorded includes the time the caller spent
+    # consuming the rows, since they arrive as they are read)
+    #
+    _observe("stream_rows", sql, parameters, started, affected=fetched, nbytes=nbytes)
+
+  except GeneratorExit:
+    # the caller stopped early (e.g. a full page), not an error:
+    _observe("stream_rows", sql, parameters, started, affected=fetched, nbytes=nbytes)
+    raise
+
+  except Exception as err:
+    _observe("stream_rows", sql, parameters, started, affected=fetched, nbytes=nbytes,
+             error=err)
+    print("datatier.stream_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    # closing an unbuffered cursor discards any unread rows:
+    dbCursor.close()
+
+
+##################################################################
+#
+# stream_json_array:
+#
+# Encodes an iterable of rows as a JSON array, yielding the
+# text in pieces as the rows are consumed; joining the pieces
+# gives the same text as json.dumps(list(rows)). Pair with
+# stream_rows so rows are encoded as they arrive from the
+# server instead of being collected into a list first. An
+# optional transform function converts each row (e.g. tuple
+# to dict) before encoding.
+#
+def stream_json_array(rows, transform=None, rows_per_piece=500):
+  """
+  Encodes rows as a JSON array, incrementally
+
+  Parameters
+  __________
+  rows : iterable of JSON-serializable rows,
+  transform : optional function applied to each row first,
+  rows_per_piece : # of rows encoded into each yielded piece
+
+  Returns
+  _______
+  a generator of strings that together form the JSON array
+  """
+
+  encoder = json.JSONEncoder()
+
+  yield "["
+
+  pending = []
+  first = True
+
+  for row in rows:
+    if transform is not None:
+      row = transform(row)
+    pending.append(encoder.encode(row))
+
+    if len(pending) >= rows_per_piece:
+      yield ("" if first else ", ") + ", ".join(pending)
+      first = False
+      pending = []
+
+  if pending:
+    yield ("" if first else ", ") + ", ".join(pending)
+
+  yield "]"
+
+
 ###############################################################
 #
 # perform_action:
@@ -173,15 +771,18 @@ def perform_action(dbConn, sql, parameters=[]):
   """
 
   dbCursor = dbConn.cursor()
+  started = time.perf_counter()
 
   try:
     # try to execute, and if successful commit the changes
     # and return the # of rows modified by the query:
     dbCursor.execute(sql, parameters)
     dbConn.commit()
+    _observe("perform_action", sql, parameters, started, affected=dbCursor.rowcount)
     return dbCursor.rowcount
 
   except Exception as err:
+    _observe("perform_action", sql, parameters, started, error=err)
     # failed, rollback any possible changes and log error:
     dbConn.rollback()
     print("datatier.perform_action() failed:")
@@ -190,3 +791,300 @@ def perform_action(dbConn, sql, parameters=[]):
 
   finally:
     dbCursor.close()
+
+
+#
+# matches "INSERT ... VALUES (%s, %s, ...)" so the VALUES tuple
+# can be repeated into a single multi-row INSERT:
+#
+_INSERT_VALUES = re.compile(
+  r"\s*((?:INSERT|REPLACE)\b.+\bVALUES?\s*)"
+  r"(\(\s*%s\s*(?:,\s*%s\s*)*\))"
+  r"(\s*(?:ON\s+DUPLICATE\b.*)?);?\s*\Z",
+  re.IGNORECASE | re.DOTALL)
+
+
+###############################################################
+#
+# perform_bulk_action:
+#
+# Given a database connection, an SQL action query and a list
+# of parameter lists, executes the query once per parameter
+# list but in as few round trips as possible, and commits once
+# at the end. An INSERT ... VALUES (%s, ...) is rewritten into
+# multi-row INSERTs of at most chunk_size rows each; other
+# action queries are sent with executemany. Returns the total
+# number of rows modified and, for a plain INSERT into a table
+# with an AUTO_INCREMENT key, the generated ids in row order.
+#
+def perform_bulk_action(dbConn, sql, rows, chunk_size=500):
+  """
+  Executes an sql ACTION query against the database connection
+  once for each list of parameters, with a single commit, and
+  returns the number of rows modified and any generated ids
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL ACTION query (parameterized with %s),
+  rows : list of parameter lists, one per execution,
+  chunk_size : max # of rows sent per statement
+
+  Returns
+  _______
+  tuple (number of rows modified, list of generated ids); the
+  list is empty unless sql is a plain INSERT that generated
+  AUTO_INCREMENT values
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    result = _execute_bulk(dbCursor, sql, rows, chunk_size)
+
+    dbConn.commit()
+    return result
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error:
+    dbConn.rollback()
+    print("datatier.perform_bulk_action() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+#
+# @@auto_increment_increment of each connection, read once:
+#
+_auto_increment_steps = weakref.WeakKeyDictionary()
+
+
+def _auto_increment_step(dbCursor):
+  #
+  # the gap between consecutive AUTO_INCREMENT ids: 1, unless
+  # the server is set up for multi-primary replication
+  #
+  dbConn = dbCursor.connection
+  step = _auto_increment_steps.get(dbConn)
+  if step is None:
+    dbCursor.execute("SELECT @@auto_increment_increment;")
+    step = int(dbCursor.fetchone()[0])
+    _auto_increment_steps[dbConn] = step
+  return step
+
+
+def _execute_bulk(dbCursor, sql, rows, chunk_size):
+  rows = list(rows)
+  if len(rows) == 0:
+    return (0, [])
+
+  match = _INSERT_VALUES.match(sql)
+
+  #
+  # generated ids are only predictable when every row is
+  # actually inserted, i.e. not for INSERT IGNORE / REPLACE /
+  # ON DUPLICATE KEY UPDATE:
+  #
+  report_ids = (match is not None
+                and not match.group(3).strip()
+                and re.match(r"\s*INSERT\s+INTO\b", sql, re.IGNORECASE) is not None)
+
+  modified = 0
+  ids = []
+
+  for start in range(0, len(rows), chunk_size):
+    chunk = rows[start:start + chunk_size]
+
+    started = time.perf_counter()
+
+    if match is None:
+      try:
+        dbCursor.executemany(sql, chunk)
+      except Exception as err:
+        _observe("perform_bulk_action", sql, chunk[0], started, error=err)
+        raise
+      _observe("perform_bulk_action", sql, chunk[0], started, affected=dbCursor.rowcount)
+      modified += dbCursor.rowcount
+      continue
+
+    prefix, values, postfix = match.groups()
+    chunk_sql = prefix + ",".join([values] * len(chunk)) + postfix
+    parameters = [value for row in chunk for value in row]
+
+    try:
+      dbCursor.execute(chunk_sql, parameters)
+    except Exception as err:
+      _observe("perform_bulk_action", sql, chunk[0], started, error=err)
+      raise
+    _observe("perform_bulk_action", sql, chunk[0], started, affected=dbCursor.rowcount)
+    modified += dbCursor.rowcount
+
+    #
+    # MySQL reports the id of the *first* row of a multi-row
+    # INSERT; the rest follow it, auto_increment_increment apart:
+    #
+    if report_ids and dbCursor.lastrowid:
+      first = dbCursor.lastrowid
+      step = _auto_increment_step(dbCursor)
+      ids.extend(range(first, first + step * len(chunk), step))
+
+  return (modified, ids)
+
+
+###############################################################
+#
+# Transaction:
+#
+# A unit of work on one connection: every statement executed
+# through it is part of the same database transaction, which
+# is committed (or rolled back) once, by datatier.transaction.
+# Create it with datatier.transaction, not directly.
+#
+class Transaction:
+  """
+  Executes queries inside one database transaction
+
+  Attributes
+  ----------
+  dbConn : the database connection,
+  lastrowid : AUTO_INCREMENT id generated by the most recent
+    action query (or None)
+  """
+
+  def __init__(self, dbConn):
+    self.dbConn = dbConn
+    self.lastrowid = None
+    self._cursor = dbConn.cursor()
+
+  def _run(self, kind, sql, parameters, fetch=None):
+    #
+    # executes and (optionally) fetches, recording the query's
+    # statistics; fetch is None, "one" or "all":
+    #
+    started = time.perf_counter()
+    try:
+      self._cursor.execute(sql, parameters)
+      if fetch == "one":
+        result = self._cursor.fetchone()
+        rows = [] if result is None else [result]
+      elif fetch == "all":
+        result = self._cursor.fetchall()
+        rows = result or []
+      else:
+        result = None
+    except Exception as err:
+      _observe(kind, sql, parameters, started, error=err)
+      raise
+
+    if fetch is None:
+      _observe(kind, sql, parameters, started, affected=self._cursor.rowcount)
+    else:
+      _observe(kind, sql, parameters, started, rows=rows)
+    return result
+
+  def retrieve_one_row(self, sql, parameters=[]):
+    """
+    Executes an sql SELECT query and returns the first row as
+    a tuple, or () if SELECT retrieves no data
+    """
+    row = self._run("retrieve_one_row", sql, parameters, "one")
+    if row is None:
+      return ()
+    else:
+      return row
+
+  def retrieve_all_rows(self, sql, parameters=[]):
+    """
+    Executes an sql SELECT query and returns all rows as a list
+    of tuples, or [] if SELECT retrieves no data
+    """
+    rows = self._run("retrieve_all_rows", sql, parameters, "all")
+    if rows is None:
+      return []
+    else:
+      return rows
+
+  def perform_action(self, sql, parameters=[]):
+    """
+    Executes an sql ACTION query (without committing) and
+    returns number of rows modified
+    """
+    self._run("perform_action", sql, parameters)
+    self.lastrowid = self._cursor.lastrowid
+    return self._cursor.rowcount
+
+  def insert(self, sql, parameters=[]):
+    """
+    Executes an sql INSERT query (without committing) and
+    returns the AUTO_INCREMENT id it generated, taken from the
+    server's reply rather than a separate SELECT LAST_INSERT_ID()
+    """
+    self.perform_action(sql, parameters)
+    return self.lastrowid
+
+  def perform_bulk_action(self, sql, rows, chunk_size=500):
+    """
+    Like datatier.perform_bulk_action, but without committing;
+    returns tuple (number of rows modified, generated ids)
+    """
+    return _execute_bulk(self._cursor, sql, rows, chunk_size)
+
+  def close(self):
+    self._cursor.close()
+
+
+###############################################################
+#
+# transaction:
+#
+# Context manager that groups the statements executed through
+# the yielded Transaction object into one database
+# transaction: committed when the with-block finishes, rolled
+# back if it raises. Work that must succeed for the rows to be
+# kept (e.g. an S3 upload) can be done inside the block.
+#
+#   with datatier.transaction(dbConn) as tx:
+#     photoid = tx.insert(sql, [...])
+#     ...
+#
+@contextlib.contextmanager
+def transaction(dbConn):
+  """
+  Runs the with-block as a single database transaction
+
+  Parameters
+  __________
+  dbConn : the database connection
+
+  Returns
+  _______
+  a Transaction object, for executing queries within the
+  transaction
+  """
+
+  #
+  # connections are opened with autocommit off, so the first
+  # statement already starts a transaction; only an explicit
+  # BEGIN (one more round trip) is needed if autocommit is on:
+  #
+  if dbConn.get_autocommit():
+    dbConn.begin()
+
+  tx = Transaction(dbConn)
+
+  try:
+    yield tx
+    dbConn.commit()
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error:
+    dbConn.rollback()
+    print("datatier.transaction() rolled back:")
+    print(str(err))
+    raise
+
+  finally:
+    tx.close()
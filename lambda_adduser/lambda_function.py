@@ -4,36 +4,31 @@
 #
 
 import json
-import boto3
-import os
 import datatier
+import runtime
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: final_adduser**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
     #
     #TODO: config file needed
     #
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
 
     # Access request body
     print("**Accessing request body**")
@@ -61,7 +56,7 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
     # Insert the new user into the database
     print("**Adding user to database**")
@@ -69,12 +64,9 @@ def lambda_handler(event, context):
         INSERT INTO users(username, password, bucketfolder)
         VALUES(%s, %s, %s);
     """
-    datatier.perform_action(dbConn, sql, [username, password, bucketfolder])
-
-    # Retrieve the user ID of the newly added user
-    sql = "SELECT LAST_INSERT_ID();"
-    row = datatier.retrieve_one_row(dbConn, sql)
-    userid = row[0]
+    # (the user ID of the newly added user comes back with the INSERT)
+    with datatier.transaction(dbConn) as tx:
+      userid = tx.insert(sql, [username, password, bucketfolder])
 
     print("UserID:", userid)
 
@@ -97,3 +89,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
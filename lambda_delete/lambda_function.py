@@ -1,37 +1,146 @@
 import json
-import boto3
-import os
 import datatier
-from configparser import ConfigParser
+import runtime
+
+from collections import Counter
+
+MAX_BATCH = 1000        # photo ids per request
+S3_DELETE_BATCH = 1000  # keys per S3 DeleteObjects call (S3's limit)
+
+
+def parse_photoids(body):
+    """
+    Returns the list of photo ids to delete from the request
+    body: either "photoids" (a list, at most MAX_BATCH) or a
+    single "photoid". Raises ValueError if missing or invalid.
+    """
+    if "photoids" in body:
+        photoids = body["photoids"]
+        if not isinstance(photoids, list) or not photoids:
+            raise ValueError("'photoids' must be a non-empty list")
+    elif "photoid" in body:
+        photoids = [body["photoid"]]
+    else:
+        raise ValueError("event body missing 'photoids' or 'photoid'")
+
+    try:
+        photoids = [int(photoid) for photoid in photoids]
+    except (TypeError, ValueError):
+        raise ValueError("photo ids must be numbers")
+
+    photoids = list(dict.fromkeys(photoids))  # drop duplicates, keep order
+    if len(photoids) > MAX_BATCH:
+        raise ValueError(f"at most {MAX_BATCH} photo ids per request")
+
+    return photoids
+
+
+def delete_s3_objects(s3_client, bucketname, bucketkeys):
+    """
+    Deletes the objects from S3 with one DeleteObjects call per
+    S3_DELETE_BATCH keys. Returns a dictionary of bucketkey ->
+    error message for the keys that could not be deleted.
+    """
+    errors = {}
+
+    for start in range(0, len(bucketkeys), S3_DELETE_BATCH):
+        chunk = bucketkeys[start:start + S3_DELETE_BATCH]
+        response = s3_client.delete_objects(
+            Bucket=bucketname,
+            Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True}
+        )
+        # (in quiet mode only the failures are listed)
+        for error in response.get("Errors", []):
+            errors[error["Key"]] = error.get("Code", "") + ": " + error.get("Message", "")
+
+    return errors
+
+
+def object_references(tx, bucketkeys):
+    """
+    Returns a dictionary of bucketkey -> number of photos using
+    the object, from content_objects, locking the rows until the
+    transaction ends. Objects stored before deduplication may
+    not be registered; those are used by a single photo.
+    """
+    placeholders = ", ".join(["%s"] * len(bucketkeys))
+    sql = f"""
+        SELECT bucketkey, refcount FROM content_objects
+         WHERE bucketkey IN ({placeholders})
+           FOR UPDATE;
+    """
+    rows = tx.retrieve_all_rows(sql, list(bucketkeys))
+    return {row[0]: row[1] for row in rows}
+
+
+def release_objects(tx, released):
+    """
+    Takes the deleted photos' references off their objects in
+    content_objects (released is a Counter of bucketkey -> # of
+    photos deleted), removing the rows that reach zero
+    """
+    sql = "UPDATE content_objects SET refcount = refcount - %s WHERE bucketkey = %s"
+    tx.perform_bulk_action(sql, [[n, key] for key, n in released.items()])
+
+    placeholders = ", ".join(["%s"] * len(released))
+    sql = f"DELETE FROM content_objects WHERE refcount <= 0 AND bucketkey IN ({placeholders});"
+    tx.perform_action(sql, list(released))
+
+
+def delete_photo_rows(tx, userid, photoids):
+    """
+    Deletes the photos, and their labels, from the database and
+    takes their labels out of the user's label counts
+    """
+    placeholders = ", ".join(["%s"] * len(photoids))
+
+    # Take the photos' labels out of the user's label counts
+    print("**Updating label counts**")
+    sql = f"""
+        UPDATE label_counts c
+          JOIN (SELECT labelid, COUNT(*) AS n
+                  FROM photo_labels
+                 WHERE photoid IN ({placeholders})
+                 GROUP BY labelid) d ON d.labelid = c.labelid
+           SET c.photo_count = c.photo_count - d.n
+         WHERE c.userid = %s;
+    """
+    tx.perform_action(sql, photoids + [userid])
+    sql = "DELETE FROM label_counts WHERE userid = %s AND photo_count <= 0;"
+    tx.perform_action(sql, [userid])
+
+    # Delete the photos' labels and metadata from the database
+    print("**Deleting photos' metadata from database**")
+    sql = f"DELETE FROM label_instances WHERE photoid IN ({placeholders});"
+    tx.perform_action(sql, photoids)
+    sql = f"DELETE FROM photo_labels WHERE photoid IN ({placeholders});"
+    tx.perform_action(sql, photoids)
+    sql = f"DELETE FROM photos WHERE userid = %s AND photoid IN ({placeholders});"
+    tx.perform_action(sql, [userid] + photoids)
+
 
 def lambda_handler(event, context):
+    dbConn = None
+
     try:
         print("**STARTING**")
         print("**lambda: final_delete_image**")
+        datatier.reset_query_stats()
 
         # Setup AWS based on config file
-        config_file = 'final-project-config.ini'  
-        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-        configur = ConfigParser()
-        configur.read(config_file)
+        # (cached across warm invocations, re-read if the file changes)
+        configur = runtime.get_config()
 
         #
         # configure for S3 access:
         #
-        s3_profile = 's3readwrite'
-        boto3.setup_default_session(profile_name=s3_profile)
-        
         bucketname = configur.get('s3', 'bucket_name')
         
-        s3 = boto3.resource('s3')
+        s3_client = runtime.get_client('s3')
         
         # Configure for RDS access
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
+        rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+            datatier.rds_settings(configur)
 
         # Access userid from event
         print("**Accessing event/pathParameters**")
@@ -44,22 +153,27 @@ def lambda_handler(event, context):
 
         print("userid:", userid)
 
-        # Access photoid from request body
+        # Access photoid(s) from request body
         print("**Accessing request body**")
         if "body" not in event:
             raise Exception("event has no body")
 
         body = json.loads(event["body"])  # Parse the JSON
 
-        if "photoid" not in body:
-            raise Exception("event body missing 'photoid'")
+        try:
+            photoids = parse_photoids(body)
+        except ValueError as err:
+            return {
+                'statusCode': 400,
+                'body': json.dumps(str(err))
+            }
 
-        photoid = body["photoid"]
-        print("photoid:", photoid)
+        single = "photoids" not in body
+        print("photoids:", len(photoids))
 
         # Open connection to the database
         print("**Opening database connection**")
-        dbConn = datatier.get_dbConn(
+        dbConn = datatier.get_pooled_dbConn(
             rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname
         )
 
@@ -75,39 +189,74 @@ def lambda_handler(event, context):
                 'body': json.dumps("No such user.")
             }
 
-        # Check if photo exists and belongs to the user
-        print("**Checking if photo exists and belongs to the user**")
-        sql = "SELECT photoid, bucketkey FROM photos WHERE photoid = %s AND userid = %s;"
-        asset_row = datatier.retrieve_one_row(dbConn, sql, [photoid, userid])
+        # Check the photos and delete their rows as one unit of work;
+        # the S3 objects go only after the commit, so a failed
+        # transaction never leaves rows pointing at deleted objects
+        with datatier.transaction(dbConn) as tx:
+            # Check which photos exist and belong to the user, in one query
+            print("**Checking photos exist and belong to the user**")
+            placeholders = ", ".join(["%s"] * len(photoids))
+            sql = f"""
+                SELECT photoid, bucketkey FROM photos
+                 WHERE userid = %s AND photoid IN ({placeholders})
+                   FOR UPDATE;
+            """
+            rows = tx.retrieve_all_rows(sql, [userid] + photoids)
+            bucketkeys = {row[0]: row[1] for row in rows}
 
-        if not asset_row:
-            print("**Photo not found or does not belong to user**")
-            return {
-                'statusCode': 400,
-                'body': json.dumps("Photo not found or does not belong to user.")
-            }
+            status = {}
+            for photoid in photoids:
+                if photoid not in bucketkeys:
+                    status[photoid] = {"photoid": photoid, "status": "not_found"}
+
+            if single and status:
+                print("**Photo not found or does not belong to user**")
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps("Photo not found or does not belong to user.")
+                }
+
+            # Identical uploads share one S3 object: an object is only
+            # deleted from S3 along with the last photo using it
+            uses = Counter(bucketkeys.values())
+            refs = object_references(tx, list(uses)) if uses else {}
+            unused = [key for key, n in uses.items() if refs.get(key, 0) <= n]
+
+            deleted = list(bucketkeys)
+            if deleted:
+                delete_photo_rows(tx, userid, deleted)
+                release_objects(tx, uses)
 
-        bucketkey = asset_row[1]
-        print("datafilekey:", bucketkey)
+        for photoid in deleted:
+            status[photoid] = {"photoid": photoid, "status": "deleted"}
 
-        # Delete the photo from S3
-        print("**Deleting photo from S3**")
-        s3_object = s3.Object(bucketname, bucketkey)
-        s3_object.delete()
+        # The rows are gone: now delete the objects no photo uses. An
+        # object that fails to delete is only an orphan in S3, which
+        # nothing refers to any more
+        print("**Deleting", len(unused), "objects from S3**")
+        try:
+            errors = delete_s3_objects(s3_client, bucketname, unused)
+        except Exception as err:
+            errors = {key: str(err) for key in unused}
 
-        # Delete the photo's metadata from the database
-        print("**Deleting photo's metadata from database**")
-        sql = "DELETE FROM photos WHERE photoid = %s AND userid = %s;"
-        datatier.perform_action(dbConn, sql, [photoid, userid])
+        for bucketkey, error in errors.items():
+            print("**Orphaned S3 object", bucketkey, ":", error, "**")
 
-        # Close the database connection
-        dbConn.close()
+        # Respond with success (and the outcome for each photo)
+        print("**DONE,", len(deleted), "photo(s) deleted**")
+
+        if single:
+            return {
+                'statusCode': 200,
+                'body': json.dumps("Photo deleted successfully.")
+            }
 
-        # Respond with success
-        print("**DONE, photo deleted**")
         return {
             'statusCode': 200,
-            'body': json.dumps("Photo deleted successfully.")
+            'body': json.dumps({
+                "deleted": len(deleted),
+                "results": [status[photoid] for photoid in photoids]
+            })
         }
 
     except Exception as err:
@@ -117,3 +266,7 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps(str(err))
         }
+
+    finally:
+        datatier.release_dbConn(dbConn)
+        datatier.log_query_summary()
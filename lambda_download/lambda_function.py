@@ -1,37 +1,37 @@
-import boto3
 import os
 import base64
 import datatier
+import imagemeta
+import runtime
 import json  # Input JSON module
 from mimetypes import guess_type
-from configparser import ConfigParser
 import uuid  # For generating unique filenames
 
 
+#
+# Lambda's limit on a (synchronous) response payload; the file
+# is returned base64-encoded, which grows it by a third:
+#
+MAX_RESPONSE_BYTES = 6 * 1024 * 1024
+
+
 def lambda_handler(event, context):
     try:
         print("**STARTING Lambda Function**")
+        datatier.reset_query_stats()
         
         # Setup AWS based on config file
-        config_file = 'final-project-config.ini'
-        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-        
-        configur = ConfigParser()
-        configur.read(config_file)
+        # (cached across warm invocations, re-read if the file changes)
+        configur = runtime.get_config()
         
         # Configure S3 access
-        s3_profile = 's3readwrite'
-        boto3.setup_default_session(profile_name=s3_profile)
-        
         bucketname = configur.get('s3', 'bucket_name')
-        s3_client = boto3.client('s3')  # S3 客户端
+        s3_client = runtime.get_client('s3')  # S3 客户端
         
         # Configure RDS access
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
+        # (SELECT-only, so routed to the read-only endpoint)
+        rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+            datatier.rds_settings(configur, readonly=True)
         
         # Extract input parameters from API Gateway pathParameters
         path_params = event.get("pathParameters", {})
@@ -45,13 +45,13 @@ def lambda_handler(event, context):
         
         # Open database connection
         print("**Opening connection to RDS**")
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+        dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
         
         try:
             # Validate photo ID and user ID
             print("**Verifying Photo ID and User ID**")
             sql_check_job = """
-                SELECT bucketkey, original_name 
+                SELECT bucketkey, original_name, format, bytesize
                 FROM photos 
                 WHERE photoid = %s AND userid = %s;
             """
@@ -60,9 +60,21 @@ def lambda_handler(event, context):
             if not row or row == ():
                 raise ValueError(f"Photo ID {photoid} does not exist or does not belong to User ID {userid}")
             
-            bucketkey, original_name = row
+            bucketkey, original_name, stored_format, bytesize = row
             print(f"Retrieved Bucket Key: {bucketkey}, Original Name: {original_name}")
 
+            # With the size recorded at upload, a file too large to
+            # return is turned away before it is downloaded
+            if bytesize is not None and 4 * ((bytesize + 2) // 3) > MAX_RESPONSE_BYTES - 1024:
+                return {
+                    "statusCode": 413,
+                    "headers": {"Content-Type": "application/json"},
+                    "body": json.dumps({
+                        "message": "Payload Too Large",
+                        "error": f"Photo ID {photoid} is {bytesize} bytes, too large to return encoded"
+                    })
+                }
+
             # Validate file extension
             allowed_extensions = ['jpg', 'jpeg', 'png']
             file_extension = os.path.splitext(original_name)[1][1:].lower()
@@ -86,8 +98,12 @@ def lambda_handler(event, context):
                 file_data = file.read()
             encoded_data = base64.b64encode(file_data).decode('utf-8')
 
-            # Determine MIME type
-            mime_type = guess_type(original_name)[0] or "application/octet-stream"
+            # Determine MIME type: the format recorded at upload, else
+            # a guess from the original filename
+            if stored_format in imagemeta.FORMATS:
+                mime_type = imagemeta.content_type(stored_format)
+            else:
+                mime_type = guess_type(original_name)[0] or "application/octet-stream"
             
             # Return results
             print("**Returning Results**")
@@ -102,8 +118,9 @@ def lambda_handler(event, context):
             }
         
         finally:
-            dbConn.close()
-            print("**Database connection closed**")
+            datatier.release_dbConn(dbConn)
+            datatier.log_query_summary()
+            print("**Database connection released**")
     
     except ValueError as ve:
         print(f"**INPUT ERROR**: {str(ve)}")
@@ -4,33 +4,29 @@
 #
 
 import json
-import boto3
-import os
 import datatier
+import runtime
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING LABEL RETRIEVAL**")
     print("**lambda: final_proj_gallery_labels**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
 
     #
     # userid from event: could be a parameter
@@ -57,7 +53,7 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
     #
     # now retrieve labels by the input user id:
@@ -65,9 +61,16 @@ def lambda_handler(event, context):
     print("**Retrieving data**")
 
     #
-    # write sql query to select all labels (unique) from Label with userid
+    # read the user's labels, with the number of photos that
+    # have each one, from the per-user label counts
     #
-    sql_get_labels = "SELECT DISTINCT labelname FROM labels WHERE userid = %s ORDER BY labelname;"
+    sql_get_labels = """
+        SELECT n.labelname, c.photo_count
+        FROM label_counts c
+        JOIN label_names n ON n.labelid = c.labelid
+        WHERE c.userid = %s AND c.photo_count > 0
+        ORDER BY n.labelname;
+        """
     
     labels = datatier.retrieve_all_rows(dbConn, sql_get_labels,(userid,))
 
@@ -88,7 +91,7 @@ def lambda_handler(event, context):
     
     print("**DONE, labels found successfully**")
 
-    label_list = [label[0] for label in labels]
+    label_list = [{"labelname": label[0], "photo_count": label[1]} for label in labels]
 
     return{
       'statusCode': 200,
@@ -104,3 +107,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps({"error": str(err)})
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
@@ -3,34 +3,50 @@
 #
 
 import json
-import boto3
-import os
 import datatier
+import runtime
+import paging
+
+
+#
+# confidence_param:
+#
+# The optional min_confidence (0-100) from the event or the
+# query string; 0 (every photo) if absent.
+#
+def confidence_param(event):
+  params = event.get("queryStringParameters") or {}
+  value = event.get("min_confidence", params.get("min_confidence"))
+
+  if value is None or value == "":
+    return 0.0
+
+  min_confidence = float(value)
+  if not 0 <= min_confidence <= 100:
+    raise ValueError("min_confidence must be between 0 and 100")
+  return min_confidence
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: proj03_users**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
     #TO DO: name of the config
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
 
 
     #
@@ -63,12 +79,27 @@ def lambda_handler(event, context):
         
     print("selected_label:", selected_label)
 
+    #
+    # which page? (limit and after from the query string)
+    # and the minimum label confidence (0-100) to include
+    #
+    try:
+      limit, after = paging.page_params(event)
+      min_confidence = confidence_param(event)
+      if after is not None:
+        after_confidence, after_photoid = float(after[0]), int(after[1])
+    except (ValueError, TypeError, IndexError) as err:
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
+
     #
     # open connection to the database:
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
     #
     # now retrieve all the photo by the input user id an label:
@@ -76,27 +107,58 @@ def lambda_handler(event, context):
     print("**Retrieving data**")
 
     #
-    # write sql query to select all photos from the Photos table
+    # write sql query to select the photos from the Photos table,
+    # best matches first: ranked by the label's confidence, then
+    # photoid, and paged on that same (confidence, photoid) key;
+    # the (userid, labelid, confidence, photoid) index serves
+    # the filter, the ranking and the paging
     #
     sql_get_photos =  """
         SELECT p.photoid, 
                p.original_name, 
                p.bucketkey, 
-               l.labelname
-        FROM photos p
-        JOIN labels l ON p.photoid = l.photoid AND p.userid = l.userid
-        WHERE p.userid = %s AND l.labelname = %s
+               n.labelname,
+               pl.confidence
+        FROM label_names n
+        JOIN photo_labels pl ON pl.labelid = n.labelid
+        JOIN photos p ON p.photoid = pl.photoid
+        WHERE n.labelname = %s AND pl.userid = %s
+          AND pl.confidence >= %s
+          AND (pl.confidence < %s OR (pl.confidence = %s AND pl.photoid < %s))
+        ORDER BY pl.confidence DESC, pl.photoid DESC
+        LIMIT %s
         """
-    
-    photos = datatier.retrieve_all_rows(dbConn, sql_get_photos, (userid, selected_label))
+
+    if after is None:
+      # (confidence is at most 100, so this starts at the top)
+      after_confidence, after_photoid = 101.0, 0
+
+    photos = datatier.stream_rows(dbConn, sql_get_photos,
+                                  (selected_label, userid, min_confidence,
+                                   after_confidence, after_confidence, after_photoid,
+                                   limit + 1))
+
+    page = paging.Page(photos, limit, key=lambda photo: [photo[4], photo[0]])
+
+    def to_photo(photo):
+      return {
+        'userid' : userid,
+        'photoid': photo[0],
+        'labelname': photo[3],
+        'original_name': photo[1],
+        'bucketkey': photo[2],
+        'confidence': photo[4]
+      }
+
+    body = paging.json_body("".join(datatier.stream_json_array(page, to_photo)), page)
 
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
 
-    #if no photos found
-    if not photos:
+    #if no photos found (at all, not just past the end of the pages)
+    if page.count == 0 and after is None:
       return {
         'statusCode': 400,
         'body': json.dumps({"message": f"No photos found for user {userid} with label {selected_label}"})
@@ -105,22 +167,11 @@ def lambda_handler(event, context):
     # found successfully and display photos with label of userid #
     
     print("**DONE, photos found successfully**")
-    
-    photo_list = []
-    for photo in photos:
-      photo_list.append({
-        'userid' : userid,
-        'photoid': photo[0],
-        'labelname': photo[3],
-        'original_name': photo[1],
-        'bucketkey': photo[2]
-        
-      })
 
     #return successful response
     return {
       'statusCode': 200,
-      'body': json.dumps(photo_list)
+      'body': body
     }
     
   except Exception as err:
@@ -131,3 +182,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps({"error": str(err)})
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
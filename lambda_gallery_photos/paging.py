@@ -0,0 +1,159 @@
+#
+# paging.py
+#
+# Keyset (cursor-based) pagination for list endpoints. A page
+# is requested with optional "limit" and "after" query string
+# parameters; the handler selects rows whose key is past the
+# "after" key, in key order, fetching one row more than the
+# limit to learn whether another page follows. The response
+# carries an opaque "next" token, which the client sends back
+# as "after" for the following page. Because each page starts
+# from an indexed key rather than an OFFSET, every page costs
+# the same however deep into the results it is.
+#
+
+import base64
+import binascii
+import json
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+###################################################################
+#
+# encode_token / decode_token:
+#
+# Tokens are URL-safe base64 of a small JSON value (the key of
+# the last row on the page); clients should treat them as
+# opaque.
+#
+def encode_token(key):
+  """
+  Returns the opaque page token for a key
+  """
+  text = json.dumps(key, separators=(",", ":"))
+  return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+  """
+  Returns the key encoded in a page token; raises ValueError if
+  the token is not valid
+  """
+  try:
+    padded = token + "=" * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+  except (binascii.Error, UnicodeDecodeError, ValueError):
+    raise ValueError("invalid page token")
+
+
+###################################################################
+#
+# page_params:
+#
+# Extracts (limit, after) from the event: either top-level
+# "limit" / "after" keys, or API Gateway queryStringParameters.
+# after is the decoded key, or None for the first page.
+#
+def page_params(event):
+  """
+  Returns the page size and starting key requested by the event
+
+  Parameters
+  ----------
+  event : the Lambda event
+
+  Returns
+  -------
+  tuple (limit, after); raises ValueError on bad parameters
+  """
+  params = event.get("queryStringParameters") or {}
+
+  limit = event.get("limit", params.get("limit"))
+  after = event.get("after", params.get("after"))
+
+  if limit is None or limit == "":
+    limit = DEFAULT_LIMIT
+  else:
+    try:
+      limit = int(limit)
+    except (TypeError, ValueError):
+      raise ValueError("limit must be a number")
+    if limit < 1:
+      raise ValueError("limit must be at least 1")
+    limit = min(limit, MAX_LIMIT)
+
+  if after is None or after == "":
+    after = None
+  else:
+    after = decode_token(after)
+
+  return limit, after
+
+
+###################################################################
+#
+# Page:
+#
+# Wraps the rows of a query that selected limit + 1 rows. While
+# iterating it yields at most limit rows, remembering the last
+# one; afterwards, next_token() is the token for the following
+# page, or None if this was the last page.
+#
+class Page:
+  """
+  One page of rows from an iterable of rows
+
+  Parameters
+  ----------
+  rows : iterable of rows (selected with LIMIT limit + 1),
+  limit : page size (integer),
+  key : function returning the (JSON-serializable) key of a row
+  """
+
+  def __init__(self, rows, limit, key):
+    self.rows = rows
+    self.limit = limit
+    self.key = key
+    self.count = 0
+    self.has_more = False
+    self._last = None
+
+  def __iter__(self):
+    try:
+      for row in self.rows:
+        if self.count == self.limit:
+          self.has_more = True
+          break
+        self.count += 1
+        self._last = row
+        yield row
+    finally:
+      # stop a streaming query as soon as the page is full:
+      if hasattr(self.rows, "close"):
+        self.rows.close()
+
+  def next_token(self):
+    """
+    Returns the token for the next page, or None
+    """
+    if not self.has_more:
+      return None
+    return encode_token(self.key(self._last))
+
+
+###################################################################
+#
+# json_body:
+#
+# Builds the response body for a page: {"items": [...],
+# "next": token-or-null}. items_json is the JSON text of the
+# items (e.g. joined from datatier.stream_json_array over the
+# Page), which must be produced before calling this.
+#
+def json_body(items_json, page):
+  """
+  Returns the JSON response body for a page
+  """
+  return '{"items": ' + items_json + ', "next": ' + json.dumps(page.next_token()) + '}'
@@ -1,37 +1,47 @@
 from PIL import Image, ImageOps, ImageEnhance
-import boto3
 import io
-import os
 import json
 import base64
 import datatier
-from configparser import ConfigParser
+import runtime
 import uuid
 
 
+def crop_box(params, width, height):
+    """
+    Returns the (left, top, right, bottom) crop rectangle from the
+    request parameters, checked against the image size; raises
+    ValueError if it is missing, empty, or outside the image
+    """
+    try:
+        box = tuple(int(params[side]) for side in ("left", "top", "right", "bottom"))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("crop requires integer 'left', 'top', 'right' and 'bottom' parameters")
+
+    left, top, right, bottom = box
+    if not (0 <= left < right <= width and 0 <= top < bottom <= height):
+        raise ValueError(f"crop rectangle {box} is outside the {width}x{height} image")
+
+    return box
+
+
 def lambda_handler(event, context):
     try:
         print("**STARTING IMAGE PROCESSING AND DOWNLOAD**")
+        datatier.reset_query_stats()
 
         # 1. Setup AWS credentials and config file
-        config_file = 'final-project-config.ini'
-        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-        configur = ConfigParser()
-        configur.read(config_file)
+        # (cached across warm invocations, re-read if the file changes)
+        configur = runtime.get_config()
 
         # Configure S3
-        s3_profile = 's3readwrite'
-        boto3.setup_default_session(profile_name=s3_profile)
         bucket_name = configur.get('s3', 'bucket_name')
-        s3 = boto3.client('s3')
+        s3 = runtime.get_client('s3')
 
         # Configure RDS access
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
+        # (SELECT-only, so routed to the read-only endpoint)
+        rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+            datatier.rds_settings(configur, readonly=True)
 
         # 2. Extract input parameters from pathParameters
         path_params = event.get("pathParameters", {})
@@ -52,13 +62,13 @@ def lambda_handler(event, context):
 
         # 3. Open DB connection
         print("**Connecting to RDS Database**")
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+        dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
 
         try:
             # Validate photo ID and user ID in DB
             print("**Validating Photo ID and User ID in Database**")
             sql = """
-                SELECT bucketkey, original_name
+                SELECT bucketkey, original_name, width, height, format
                 FROM photos
                 WHERE photoid = %s AND userid = %s;
             """
@@ -67,20 +77,26 @@ def lambda_handler(event, context):
             if not row:
                 raise ValueError(f"Photo ID {photoid} does not exist or does not belong to User ID {userid}")
 
-            bucketkey, original_name = row
+            bucketkey, original_name, width, height, stored_format = row
             print(f"Retrieved Bucket Key: {bucketkey}, Original Name: {original_name}")
 
+            # Reject a bad crop before fetching anything from S3, using
+            # the dimensions recorded at upload (photos uploaded before
+            # that are checked once the image is opened, below)
+            if operation == "crop" and width is not None:
+                crop_box(params, width, height)
+
             # Step 4. Retrieve photo from S3
             print("Retrieving Image from S3")
             response = s3.get_object(Bucket=bucket_name, Key=bucketkey)
             image_data = response["Body"].read()
             img = Image.open(io.BytesIO(image_data))
-            original_format = img.format  # Extract the original format (e.g., JPEG, PNG)
+            original_format = stored_format or img.format  # the original format (e.g., JPEG, PNG)
 
             # Step 5. Apply the specified operation
             print("Applying Image Operation")
             if operation == "crop":
-                img = img.crop((int(params["left"]), int(params["top"]), int(params["right"]), int(params["bottom"])))
+                img = img.crop(crop_box(params, *img.size))
             elif operation == "thumbnail":
                 img.thumbnail((128, 128))  # Fixed thumbnail size
             elif operation == "pad":
@@ -138,8 +154,9 @@ def lambda_handler(event, context):
             }
 
         finally:
-            dbConn.close()
-            print("Database Connection Closed")
+            datatier.release_dbConn(dbConn)
+            datatier.log_query_summary()
+            print("Database Connection Released")
 
     except ValueError as ve:
         print(f"Input error: {str(ve)}")
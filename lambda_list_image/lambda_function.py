@@ -4,36 +4,33 @@
 #
 
 import json
-import boto3
-import os
 import datatier
+import runtime
+import paging
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: final_list_image**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
     #
     #TODO: config file needed
     #
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
 
     # userid from event: could be a parameter
     # or could be part of URL path ("pathParameters"):
@@ -52,13 +49,23 @@ def lambda_handler(event, context):
         
     print("userid:", userid)
     
+    #
+    # which page? (limit and after from the query string)
+    #
+    try:
+      limit, after = paging.page_params(event)
+    except ValueError as err:
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
 
     #
     # open connection to the database:
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
 
     #
     # first we need to make sure the userid is valid:
@@ -84,25 +91,40 @@ def lambda_handler(event, context):
     print("**Retrieving data**")
 
     #
-    # select the users' images from the 
-    # photos table, ordered by photoid
-    #
-    sql2 = "SELECT photoid, userid, original_name FROM photos WHERE userid=%s ORDER BY photoid";
+    # select one page of the users' images from the 
+    # photos table, ordered by photoid, starting after
+    # the last photoid of the previous page; each row also
+    # carries the metadata recorded at upload (NULL for photos
+    # not yet backfilled)
+    #
+    sql2 = """
+      SELECT photoid, userid, original_name,
+             width, height, format, bytesize, mode, sha256
+        FROM photos
+       WHERE userid=%s AND photoid > %s
+       ORDER BY photoid
+       LIMIT %s
+    """
     
-    rows = datatier.retrieve_all_rows(dbConn, sql2, [userid])
+    #
+    # stream the rows from the server and encode them as they
+    # arrive, rather than materializing every row first:
+    #
+    rows = datatier.stream_rows(dbConn, sql2, [userid, after or 0, limit + 1])
     
-    for row in rows:
-      print(row)
+    page = paging.Page(rows, limit, key=lambda row: row[0])
+
+    body = paging.json_body("".join(datatier.stream_json_array(page)), page)
 
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE, returning rows**")
+    print("**DONE, returning", page.count, "rows**")
     
     return {
       'statusCode': 200,
-      'body': json.dumps(rows)
+      'body': body
     }
     
   except Exception as err:
@@ -113,3 +135,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
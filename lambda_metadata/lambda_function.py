@@ -0,0 +1,104 @@
+#
+# Returns the metadata of one of a user's photos (dimensions,
+# format, size, mode, SHA-256) from the PixelTailor database,
+# without fetching the image itself from S3.
+#
+
+import json
+import datatier
+import runtime
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_metadata**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for RDS access
+    #
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
+
+    #
+    # userid and photoid from event: could be parameters
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    params = event.get("pathParameters") or event
+
+    if "userid" not in params or "photoid" not in params:
+      raise Exception("requires userid and photoid parameters in event")
+
+    userid = params["userid"]
+    photoid = params["photoid"]
+
+    print("userid:", userid, "photoid:", photoid)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    #
+    # one indexed lookup by primary key, checking the owner:
+    #
+    print("**Retrieving metadata**")
+
+    sql = """
+      SELECT photoid, userid, original_name, width, height, format, bytesize, mode, sha256
+        FROM photos
+       WHERE photoid = %s AND userid = %s;
+    """
+
+    row = datatier.retrieve_one_row(dbConn, sql, [photoid, userid])
+
+    if row == ():  # no such photo for this user
+      print("**No such photo, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such photo...")
+      }
+
+    keys = ["photoid", "userid", "original_name", "width", "height",
+            "format", "bytesize", "mode", "sha256"]
+    metadata = dict(zip(keys, row))
+
+    #
+    # photos uploaded before metadata was recorded have NULLs
+    # until migrations/backfill_photo_metadata.py is run:
+    #
+    metadata["complete"] = metadata["sha256"] is not None
+
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps(metadata)
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
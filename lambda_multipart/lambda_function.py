@@ -0,0 +1,341 @@
+#
+# Multipart presigned uploads of large photos, where the client
+# PUTs the parts of the file to S3 in parallel, and can resume an
+# interrupted upload from the parts already sent. The operation
+# is the last part of the path, /multipart/{userid}/{operation}:
+#
+#  initiate  {"filename", "bytesize", "sha256"} -> reserves the
+#            upload and starts an S3 multipart upload; returns
+#            {"uploadid", "part_size", "part_count"}
+#  presign   {"uploadid", "part_numbers": [...]} -> a presigned
+#            PUT URL for each part, {"urls": {"1": url, ...}}
+#  complete  {"uploadid"} -> assembles the parts S3 holds into
+#            the object; the client then finalizes the upload
+#            with /upload-finalize, as for a single PUT. Asking
+#            again once the object exists succeeds again, so a
+#            client that lost the first reply can carry on
+#  abort     {"uploadid"} -> discards the parts and reservation
+#
+# A multipart upload must be done within [s3]
+# multipart_expire_days (default 7) of initiate; after that no
+# more parts are presigned, and expire_pending_uploads.py aborts
+# it.
+#
+
+import json
+import math
+import datatier
+import runtime
+import uploads
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3's minimum, except for the last part
+MAX_PARTS = 10000                # S3's maximum
+MAX_PRESIGN = 1000               # part URLs per presign request
+
+
+def pending_multipart(tx, userid, uploadid):
+  """
+  Returns (bucketkey, s3_uploadid, bytesize, part_size, photoid,
+  expired) of the user's multipart upload, locked; raises
+  ValueError if there is no such upload
+  """
+  sql = """
+    SELECT bucketkey, s3_uploadid, bytesize, part_size, photoid,
+           created_at + INTERVAL expires_in SECOND < NOW()
+      FROM pending_uploads
+     WHERE uploadid = %s AND userid = %s AND s3_uploadid IS NOT NULL
+       FOR UPDATE;
+  """
+  row = tx.retrieve_one_row(sql, [uploadid, userid])
+  if row == ():
+    raise ValueError("no such upload...")
+  return row
+
+
+def initiate(tx, s3_client, bucketname, max_upload_mb, part_mb, expire_days,
+             userid, bucketfolder, body):
+  """
+  Reserves the upload and starts the S3 multipart upload
+  """
+  filename = body.get("filename")
+  bytesize = body.get("bytesize")
+  sha256 = body.get("sha256")
+
+  extension = uploads.check_reservation(filename, bytesize, sha256, max_upload_mb)
+
+  #
+  # parts of part_mb, or larger if the file would need more
+  # than S3's maximum number of parts:
+  #
+  part_size = max(part_mb * 1024 * 1024, MIN_PART_SIZE, math.ceil(bytesize / MAX_PARTS))
+  part_count = math.ceil(bytesize / part_size)
+
+  bucketkey = uploads.new_bucketkey(bucketfolder, filename, extension)
+
+  print("S3 bucketkey:", bucketkey, "parts:", part_count, "x", part_size)
+
+  response = s3_client.create_multipart_upload(
+    Bucket=bucketname,
+    Key=bucketkey,
+    ContentType=uploads.CONTENT_TYPES[extension],
+    ACL='public-read'
+  )
+
+  sql = """
+    INSERT INTO pending_uploads(userid, original_name, bucketkey, bytesize, sha256,
+                                s3_uploadid, part_size, expires_in)
+                VALUES(%s, %s, %s, %s, %s, %s, %s, %s);
+  """
+  uploadid = tx.insert(sql, [userid, filename, bucketkey, bytesize,
+                             sha256.lower() if sha256 else None,
+                             response['UploadId'], part_size, expire_days * 24 * 60 * 60])
+
+  return {"uploadid": uploadid, "part_size": part_size, "part_count": part_count}
+
+
+def presign(tx, s3_client, bucketname, expires_in, userid, body):
+  """
+  Returns presigned PUT URLs for the requested parts
+  """
+  bucketkey, s3_uploadid, bytesize, part_size, photoid, expired = \
+    pending_multipart(tx, userid, body.get("uploadid"))
+
+  if expired:
+    raise ValueError("upload expired, start it again")
+
+  part_count = math.ceil(bytesize / part_size)
+  part_numbers = body.get("part_numbers") or []
+
+  if len(part_numbers) > MAX_PRESIGN:
+    raise ValueError(f"at most {MAX_PRESIGN} parts per request")
+  if not all(isinstance(n, int) and 1 <= n <= part_count for n in part_numbers):
+    raise ValueError(f"part numbers must be between 1 and {part_count}")
+
+  urls = {}
+  for n in part_numbers:
+    urls[str(n)] = s3_client.generate_presigned_url(
+      'upload_part',
+      Params={'Bucket': bucketname, 'Key': bucketkey,
+              'UploadId': s3_uploadid, 'PartNumber': n},
+      ExpiresIn=expires_in
+    )
+
+  return {"urls": urls, "expires_in": expires_in}
+
+
+def uploaded_parts(s3_client, bucketname, bucketkey, s3_uploadid):
+  """
+  Returns the parts S3 holds for the multipart upload, as
+  [{"PartNumber": n, "ETag": etag}, ...] in part order
+  """
+  parts = []
+  marker = 0
+
+  while True:
+    response = s3_client.list_parts(Bucket=bucketname, Key=bucketkey,
+                                    UploadId=s3_uploadid, PartNumberMarker=marker)
+    for part in response.get('Parts', []):
+      parts.append({"PartNumber": part['PartNumber'], "ETag": part['ETag']})
+
+    if not response.get('IsTruncated'):
+      return parts
+    marker = response['NextPartNumberMarker']
+
+
+def object_exists(s3_client, bucketname, bucketkey):
+  """
+  Returns True if S3 holds the object
+  """
+  try:
+    s3_client.head_object(Bucket=bucketname, Key=bucketkey)
+    return True
+  except s3_client.exceptions.ClientError as err:
+    if err.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+      raise
+    return False
+
+
+def complete(tx, s3_client, bucketname, userid, body):
+  """
+  Assembles the uploaded parts into the object, once S3 holds
+  every part; succeeds again if the upload was already
+  completed
+  """
+  uploadid = body.get("uploadid")
+  bucketkey, s3_uploadid, bytesize, part_size, photoid, expired = \
+    pending_multipart(tx, userid, uploadid)
+
+  part_count = math.ceil(bytesize / part_size)
+
+  try:
+    #
+    # the parts as S3 has them, rather than as the client says:
+    #
+    parts = uploaded_parts(s3_client, bucketname, bucketkey, s3_uploadid)
+    missing = sorted(set(range(1, part_count + 1)) - {part["PartNumber"] for part in parts})
+
+    if missing:
+      raise ValueError(f"parts not uploaded yet: {missing[:20]}")
+
+    s3_client.complete_multipart_upload(
+      Bucket=bucketname,
+      Key=bucketkey,
+      UploadId=s3_uploadid,
+      MultipartUpload={'Parts': parts}
+    )
+  except s3_client.exceptions.ClientError as err:
+    if err.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+      raise
+
+    #
+    # S3 no longer knows the multipart upload: either it was
+    # completed (by an earlier request whose reply was lost), or
+    # it was aborted, e.g. by a lifecycle rule
+    #
+    if not object_exists(s3_client, bucketname, bucketkey):
+      raise ValueError("upload no longer exists, start it again")
+
+    print("**Upload", uploadid, "was already completed**")
+
+  result = {"uploadid": uploadid, "message": "Upload complete, finalize it next."}
+  if photoid is not None:
+    result["photoid"] = photoid
+    result["message"] = "Upload already finalized."
+  return result
+
+
+def abort(tx, s3_client, bucketname, userid, body):
+  """
+  Discards the uploaded parts and the reservation
+  """
+  uploadid = body.get("uploadid")
+  bucketkey, s3_uploadid, bytesize, part_size, photoid, expired = \
+    pending_multipart(tx, userid, uploadid)
+
+  if photoid is not None:
+    raise ValueError("upload already finalized")
+
+  s3_client.abort_multipart_upload(Bucket=bucketname, Key=bucketkey, UploadId=s3_uploadid)
+
+  tx.perform_action("DELETE FROM pending_uploads WHERE uploadid = %s;", [uploadid])
+
+  return {"uploadid": uploadid, "message": "Upload aborted."}
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_multipart**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for S3 access:
+    #
+    bucketname = configur.get('s3', 'bucket_name')
+    max_upload_mb = configur.getint('s3', 'max_upload_mb', fallback=50)
+    part_mb = configur.getint('s3', 'multipart_part_mb', fallback=8)
+    expires_in = configur.getint('s3', 'presign_expires', fallback=900)  # seconds
+    expire_days = configur.getint('s3', 'multipart_expire_days', fallback=7)
+
+    s3_client = runtime.get_client('s3')
+
+    #
+    # configure for RDS access
+    #
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
+
+    #
+    # userid and operation from the URL path ("pathParameters"),
+    # or event parameters:
+    #
+    print("**Accessing event/pathParameters**")
+
+    params = event.get("pathParameters") or event
+
+    if "userid" not in params or "operation" not in params:
+      raise Exception("requires userid and operation parameters in event")
+
+    userid = params["userid"]
+    operation = params["operation"]
+
+    print("userid:", userid, "operation:", operation)
+
+    if operation not in ("initiate", "presign", "complete", "abort"):
+      return {
+        'statusCode': 400,
+        'body': json.dumps(f"unknown operation '{operation}'")
+      }
+
+    body = json.loads(event.get("body") or "{}")
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    #
+    # first we need to make sure the userid is valid:
+    #
+    print("**Checking if userid is valid**")
+
+    sql = "SELECT * FROM users WHERE userid = %s;"
+
+    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+    if row == ():  # no such user
+      print("**No such user, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such user...")
+      }
+
+    bucketfolder = row[3]
+
+    try:
+      with datatier.transaction(dbConn) as tx:
+        if operation == "initiate":
+          result = initiate(tx, s3_client, bucketname, max_upload_mb, part_mb, expire_days,
+                            userid, bucketfolder, body)
+        elif operation == "presign":
+          result = presign(tx, s3_client, bucketname, expires_in, userid, body)
+        elif operation == "complete":
+          result = complete(tx, s3_client, bucketname, userid, body)
+        else:
+          result = abort(tx, s3_client, bucketname, userid, body)
+    except ValueError as err:
+      print("**Bad request:", str(err), "**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
+
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps(result)
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
@@ -0,0 +1,114 @@
+#
+# benchmark_input.py
+#
+# Compares the end-to-end latency of recognizing images with each
+# recognition input strategy (see recognition_input.py): passing
+# an S3Object reference, sending the downloaded bytes, and sending
+# a downscaled copy. Each timing covers everything the lambda
+# would do for that strategy: reading the object from S3 (if the
+# strategy needs it), downscaling, and the detect_labels call.
+# A strategy that the image is outside Rekognition's limits for
+# is skipped.
+#
+# Usage:
+#   python benchmark_input.py bucketkey [bucketkey ...] [--repeat N]
+#
+# Run it from a folder with final-project-config.ini, as for the
+# lambda, against objects already in the bucket.
+#
+
+import recognition_input
+import runtime
+import statistics
+import sys
+import time
+
+
+def allowed(strategy, bytesize):
+  """
+  Returns True if Rekognition accepts an image of this size with
+  the strategy
+  """
+  if strategy == "s3object":
+    return bytesize <= recognition_input.MAX_S3OBJECT_BYTES
+  if strategy == "bytes":
+    return bytesize <= recognition_input.MAX_BYTES
+  return True
+
+
+def run_once(strategy, s3_client, rekognition, bucketname, bucketkey, settings):
+  """
+  Recognizes the image once with the strategy; returns (seconds,
+  bytes sent, number of labels)
+  """
+  start = time.perf_counter()
+
+  image, sent = recognition_input.image_param(strategy, s3_client, bucketname, bucketkey,
+                                              None, settings['max_dimension'])
+  response = rekognition.detect_labels(
+    Image=image,
+    MaxLabels=settings['max_labels'],
+    MinConfidence=settings['min_confidence']
+  )
+
+  return time.perf_counter() - start, sent, len(response['Labels'])
+
+
+def benchmark(bucketkeys, repeat):
+  configur = runtime.get_config()
+
+  bucketname = configur.get('s3', 'bucket_name')
+  settings = {
+    'max_labels': configur.getint('rekognition', 'max_labels', fallback=10),
+    'min_confidence': configur.getfloat('rekognition', 'min_confidence', fallback=55),
+    'max_dimension': configur.getint('rekognition', 'max_dimension',
+                                     fallback=recognition_input.DEFAULT_MAX_DIMENSION),
+  }
+
+  s3_client = runtime.get_client('s3')
+  rekognition = runtime.get_client('rekognition')
+
+  print(f"{'bucketkey':40s} {'strategy':10s} {'median ms':>10s} {'min ms':>8s} "
+        f"{'sent':>10s} {'labels':>6s}")
+
+  for bucketkey in bucketkeys:
+    bytesize = s3_client.head_object(Bucket=bucketname, Key=bucketkey)['ContentLength']
+    chosen = recognition_input.choose({"bytesize": bytesize})
+
+    for strategy in recognition_input.STRATEGIES:
+      if not allowed(strategy, bytesize):
+        print(f"{bucketkey[-40:]:40s} {strategy:10s} {'skipped, ' + str(bytesize) + ' bytes':>30s}")
+        continue
+
+      #
+      # one untimed run first, so connection setup is not counted:
+      #
+      run_once(strategy, s3_client, rekognition, bucketname, bucketkey, settings)
+
+      times = []
+      for i in range(repeat):
+        seconds, sent, labels = run_once(strategy, s3_client, rekognition,
+                                         bucketname, bucketkey, settings)
+        times.append(seconds * 1000)
+
+      mark = " *" if strategy == chosen else ""
+      print(f"{bucketkey[-40:]:40s} {strategy:10s} {statistics.median(times):10.1f} "
+            f"{min(times):8.1f} {sent:10d} {labels:6d}{mark}")
+
+  print("(* = the strategy the lambda chooses when the image is not in memory)")
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  repeat = 5
+
+  if "--repeat" in sys.argv:
+    index = sys.argv.index("--repeat")
+    repeat = int(sys.argv[index + 1])
+    args.remove(sys.argv[index + 1])
+
+  if not args:
+    print("usage: python benchmark_input.py bucketkey [bucketkey ...] [--repeat N]")
+    sys.exit(1)
+
+  benchmark(args, repeat)
@@ -1,168 +1,596 @@
 #
 # Python program to open and process a picture, recognizing labels from the picture.
-# When users upload a picture, download the pic automatically,
-# recognize tha picture by AWS Recognition. 
-# Only save the first five labels of the picture, save in RDS
+# When users upload a picture, recognize tha picture by AWS Recognition
+# (or the backend set in [rekognition] backend, see recognition_backend.py).
+# Save the labels of the picture (up to [rekognition] max_labels,
+# with their confidence, parent labels and instance boxes) in RDS
 #
+# One S3 event may carry several records (e.g. during an upload
+# burst); they are prepared and stored concurrently, each on
+# its own pooled connection, and labelled with one batched
+# backend call. A record that fails is reported in the result
+# without failing the others.
+#
+# With a [queue] configured, the upload lambdas queue a job per
+# new object instead, and this function drains the queue in
+# batches when invoked on a schedule (see worker.py), with
+# retries, backoff and a dead-letter store. S3 events then
+# only queue the presigned uploads not finalized yet (see
+# queue_unfinalized), so no photo is recognized twice.
 #
 
+import concurrent.futures
 import json
-import uuid
-import base64
-import pathlib
 import datatier
+import jobqueue
+import recognition_backend
+import recognition_cache
+import runtime
+import uploads
 import urllib.parse
+import worker
 import string
 
-import boto3
 import pymysql
-import os
 
-from configparser import ConfigParser
 
-def lambda_handler(event, context):
-  try:
-    print("**STARTING**")
-    print("**lambda: final_proj_recognition**")
-    
+###################################################################
+#
+# resolve_labelids:
+#
+# Returns a dictionary mapping each label name to its labelid
+# in the label_names dictionary, adding the names that are not
+# there yet. Most labels already exist, so this is usually a
+# single SELECT.
+#
+def resolve_labelids(tx, names):
+  if not names:
+    return {}
 
+  placeholders = ", ".join(["%s"] * len(names))
+  select_sql = f"SELECT labelid, labelname FROM label_names WHERE labelname IN ({placeholders})"
+
+  #
+  # (label names compare case-insensitively in MySQL)
+  #
+  rows = tx.retrieve_all_rows(select_sql + ";", names)
+  found = {row[1].lower(): row[0] for row in rows}
+
+  missing = [name for name in names if name.lower() not in found]
+  if missing:
     #
-    # setup AWS based on config file:
-    #
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    print("**config read**")
-    #
-    # configure for S3 access:
+    # IGNORE: another invocation may add the same name first,
+    # and a locking read is needed to see a name committed by
+    # that invocation after our transaction started
     #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    print("**s3 access**")
+    insert_sql = "INSERT IGNORE INTO label_names (labelname) VALUES (%s)"
+    tx.perform_bulk_action(insert_sql, [[name] for name in missing])
+
+    rows = tx.retrieve_all_rows(select_sql + " LOCK IN SHARE MODE;", names)
+    found = {row[1].lower(): row[0] for row in rows}
+
+  labelids = {name: found[name.lower()] for name in names}
+
+  return labelids
+
+
+###################################################################
+#
+# store_labels:
+#
+# Stores the labels Rekognition detected in a photo: each
+# label's confidence in photo_labels, its parent labels in
+# label_parents, and the bounding box of each instance in
+# label_instances. The user's label_counts go up by one for
+# each label the photo did not already have. Safe to repeat for
+# the same photo (e.g. a redelivered S3 event). Returns the list
+# of label names.
+#
+def store_labels(tx, photoid, userid, labels):
+  names = []
+  for label in labels:
+    for name in [label['Name']] + [p['Name'] for p in label.get('Parents', [])]:
+      if name not in names:
+        names.append(name)
+
+  if not names:
+    return []
+
+  labelids = resolve_labelids(tx, names)
+
+  #
+  # which labels does the photo have already? (locked, so a
+  # concurrent redelivery cannot count them twice)
+  #
+  sql = "SELECT labelid FROM photo_labels WHERE photoid = %s FOR UPDATE;"
+  existing = {row[0] for row in tx.retrieve_all_rows(sql, [photoid])}
+
+  #
+  # all the photo's labels in one statement; a repeat just
+  # refreshes the confidence:
+  #
+  insert_sql = """
+    INSERT INTO photo_labels (photoid, labelid, userid, confidence) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE confidence = VALUES(confidence)
+  """
+  label_rows = [[photoid, labelids[label['Name']], userid, label['Confidence']]
+                for label in labels]
+
+  tx.perform_bulk_action(insert_sql, label_rows)
+
+  new_labelids = {labelids[label['Name']] for label in labels} - existing
+  if new_labelids:
+    insert_sql = """
+      INSERT INTO label_counts (userid, labelid, photo_count) VALUES (%s, %s, 1)
+      ON DUPLICATE KEY UPDATE photo_count = photo_count + 1
+    """
+    tx.perform_bulk_action(insert_sql, [[userid, labelid] for labelid in sorted(new_labelids)])
+
+  parent_rows = [[labelids[label['Name']], labelids[parent['Name']]]
+                 for label in labels
+                 for parent in label.get('Parents', [])]
+
+  if parent_rows:
+    insert_sql = "INSERT IGNORE INTO label_parents (labelid, parentid) VALUES (%s, %s)"
+    tx.perform_bulk_action(insert_sql, parent_rows)
+
+  instance_rows = []
+  for label in labels:
+    for instance in label.get('Instances', []):
+      box = instance.get('BoundingBox', {})
+      instance_rows.append([photoid, labelids[label['Name']],
+                            instance.get('Confidence', label['Confidence']),
+                            box.get('Left', 0), box.get('Top', 0),
+                            box.get('Width', 0), box.get('Height', 0)])
+
+  tx.perform_action("DELETE FROM label_instances WHERE photoid = %s;", [photoid])
+  if instance_rows:
+    insert_sql = """
+      INSERT INTO label_instances
+        (photoid, labelid, confidence, box_left, box_top, box_width, box_height)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+    tx.perform_bulk_action(insert_sql, instance_rows)
+
+  return [label['Name'] for label in labels]
+
+
+###################################################################
+#
+# prepare:
+#
+# First step for one uploaded object: finalizes the upload if
+# it came through a presigned URL, and returns the record's
+# job. A job whose "result" is set is done already (rejected
+# or duplicate content); otherwise it has either cached labels
+# or the backend's "input" for the object. Runs on a worker
+# thread, so uses only thread-safe clients and its own
+# connection.
+#
+def prepare(bucketkey, settings, backend):
+  bucketname = settings['bucketname']
+  s3_client = runtime.get_client('s3')
+
+  dbConn = datatier.get_pooled_dbConn(*settings['rds'])
+
+  try:
     #
-    # configure for Rekognition access:
+    # an object uploaded with a presigned URL may arrive before
+    # the client finalizes the upload: if so, record the photo
+    # now, which means checking its content. Read what that
+    # needs (see uploads.read_upload) before locking the upload,
+    # so the lock is not held while S3 is read. (Pending rows
+    # are added before the PUT, so if there is none now, there
+    # will not be one.)
     #
-    rekognition = boto3.client('rekognition')
-    print("**rekognition access**")
+    image_bytes = upload_meta = phash = None
+    rejected = None
+
+    sql = "SELECT photoid FROM pending_uploads WHERE bucketkey = %s;"
+    row = datatier.retrieve_one_row(dbConn, sql, [bucketkey])
+
+    if row != () and row[0] is None:
+      print("**Reading uploaded object '", bucketkey, "'**")
+      try:
+        upload_meta, phash, image_bytes = uploads.read_upload(s3_client, bucketname, bucketkey)
+      except ValueError as err:
+        rejected = str(err)
 
     #
-    # configure for RDS access
+    # (same locking order as lambda_upload_finalize, so the two
+    # wait for each other rather than deadlock); the upload may
+    # have been finalized since we looked
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-    print("**RDS access**")
+    duplicate = False
+
+    with datatier.transaction(dbConn) as tx:
+      pending = uploads.pending_upload(tx, bucketkey=bucketkey)
+
+      if pending != () and pending[6] is None:
+        if rejected is None:
+          print("**Finalizing presigned upload", pending[0], "**")
+          try:
+            photoid, duplicate = uploads.finalize(tx, pending, upload_meta, phash)
+          except ValueError as err:
+            rejected = str(err)
+        if rejected is not None:
+          # (the reservation can never be finalized now)
+          uploads.discard_pending(tx, pending[0])
+      elif pending != ():
+        #
+        # finalized already; a duplicate's photo uses the
+        # existing object, not this one
+        #
+        rejected = None
+        sql = "SELECT bucketkey FROM photos WHERE photoid = %s;"
+        row = tx.retrieve_one_row(sql, [pending[6]])
+        duplicate = (row == () or row[0] != bucketkey)
+
+    if rejected is not None or duplicate:
+      #
+      # not an acceptable image, or identical content is stored
+      # (and labelled) already: the object is not needed
+      #
+      print("**Deleting object:", rejected or "duplicate content", "**")
+      s3_client.delete_object(Bucket=bucketname, Key=bucketkey)
+      return {"result": {"bucketkey": bucketkey,
+                         "status": "rejected" if rejected else "duplicate",
+                         "message": rejected or "Duplicate content, labels copied."}}
+
     #
-    # this function is event-driven by a photo being
-    # dropped into S3. The bucket key is sent to 
-    # us and obtain as follows:
+    # the metadata recorded at upload: its hash for the cache,
+    # and its size etc. for the backend to decide how to read
+    # it. A photo still being inserted by /upload has no
+    # committed row yet, nor does one uploaded before migration
+    # 6 have metadata.
     #
+    sql = "SELECT bytesize, format, width, height, sha256 FROM photos WHERE bucketkey = %s LIMIT 1;"
+    row = datatier.retrieve_one_row(dbConn, sql, [bucketkey])
+
+    meta = dict(zip(("bytesize", "format", "width", "height", "sha256"), row or (None,) * 5))
+
+    if upload_meta is not None:
+      meta.update({key: upload_meta[key] for key in meta})
+
+    job = {"bucketkey": bucketkey, "sha256": meta["sha256"]}
 
-    #pic_bucketname =urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['name'], encoding='utf-8')
-     
-    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    
-    print("image bucketkey from event:", bucketkey)
-    
-      
     #
-    # download photo from S3 to LOCAL file system:
+    # identical content may have been recognized before, under
+    # the same policy, e.g. an image deleted and uploaded again:
     #
-    print("**DOWNLOADING '", bucketkey, "'**")
+    cached = None
+    if meta["sha256"] is not None:
+      cached = recognition_cache.lookup(dbConn, meta["sha256"], settings['cache_policy'])
+
+    if cached is not None:
+      print("**Recognition cache hit for", bucketkey, "model version", cached[1], "**")
+      job["labels"], job["model_version"] = cached
+      job["cached"] = True
+    else:
+      job["input"] = backend.prepare(s3_client, bucketname, bucketkey, meta, image_bytes)
+      job["cached"] = False
+
+    return job
+
+  finally:
+    datatier.release_dbConn(dbConn)
+
+
+###################################################################
+#
+# finish:
+#
+# Last step for one object, once its labels are known: caches
+# newly recognized labels, and stores them for every photo
+# stored in the object. Runs on a worker thread, with its own
+# connection. Returns the record's result.
+#
+def finish(job, settings):
+  bucketkey = job["bucketkey"]
+  labels = job["labels"]
+
+  dbConn = datatier.get_pooled_dbConn(*settings['rds'])
+
+  try:
+    if not job["cached"] and job["sha256"] is not None:
+      recognition_cache.store(dbConn, job["sha256"], settings['cache_policy'], labels,
+                              job["model_version"], settings['cache_ttl_days'])
 
     #
-    # Download photo in the local directory where we have access.
+    # look up the photos stored in this object, through the
+    # bucketkey index, and store their labels in one
+    # transaction. Uploads of identical content share one
+    # object, so there may be several photos (of different
+    # users). The locking read waits for an upload still
+    # inserting a photo with this key, and keeps a new one from
+    # being added until the labels are committed, so that a
+    # duplicate upload either is labelled here or copies them.
     #
-    local_filename = f'/tmp/{bucketkey.split("/")[-1]}'
-    print("**filename**")
-    print(local_filename)
-    
-    bucket.download_file(bucketkey, local_filename)#do we need to use bucketname?
+    with datatier.transaction(dbConn) as tx:
+      sql_get_photos = "SELECT photoid, userid FROM photos WHERE bucketkey = %s FOR UPDATE;"
+      photos = tx.retrieve_all_rows(sql_get_photos, [bucketkey])
+
+      if not photos:
+        raise Exception(f"no photo with bucketkey '{bucketkey}'")
+
+      for photoid, userid in photos:
+        #
+        # store every label we recognized, with its confidence,
+        # parents and instances
+        #
+        all_labels = store_labels(tx, photoid, userid, labels)
+        print("photoid", photoid, "userid", userid, "labels stored:", len(all_labels))
+
+    return {"bucketkey": bucketkey, "status": "labelled", "cached": job["cached"],
+            "model_version": job["model_version"],
+            "photoids": [photoid for photoid, userid in photos],
+            "labels": all_labels}
+
+  finally:
+    datatier.release_dbConn(dbConn)
+
+
+def event_bucketkeys(event):
+  """
+  Returns the bucketkey of each record in an S3 event, or None
+  for a record that is not about an S3 object
+  """
+  keys = []
+  for record in event.get('Records', []):
+    try:
+      keys.append(urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8'))
+    except (KeyError, TypeError):
+      keys.append(None)
+  return keys
+
+
+###################################################################
+#
+# queue_unfinalized:
+#
+# With a job queue, the upload lambdas queue a recognize job
+# with each new photo, so an S3 event only needs one for an
+# object uploaded with a presigned URL and not finalized yet;
+# the job finalizes it, if the client has not by then. Queues
+# those jobs and returns their bucketkeys.
+#
+def queue_unfinalized(queue, bucketkeys, configur):
+  keys = list(dict.fromkeys(key for key in bucketkeys if key is not None))
+  if not keys:
+    return []
+
+  dbConn = datatier.get_pooled_dbConn(*datatier.rds_settings(configur))
+
+  try:
+    placeholders = ", ".join(["%s"] * len(keys))
+    sql = f"""
+      SELECT bucketkey FROM pending_uploads
+       WHERE bucketkey IN ({placeholders}) AND photoid IS NULL;
+    """
+    unfinalized = {row[0] for row in datatier.retrieve_all_rows(dbConn, sql, keys)}
+  finally:
+    datatier.release_dbConn(dbConn)
+
+  queued = [key for key in keys if key in unfinalized]
+  if queued:
+    queue.send([{"type": "recognize", "bucketkey": key} for key in queued])
+
+  return queued
+
+
+###################################################################
+#
+# recognize_all:
+#
+# Recognizes the objects named by bucketkeys (None for a record
+# that names none), returning (backend name, a result for each
+# key in order). Objects are prepared and stored concurrently,
+# each on its own pooled connection, and labelled with one
+# batched backend call; a failure is reported as that key's
+# result, with status "error".
+#
+def recognize_all(bucketkeys, configur):
+  #
+  # the recognition backend, and settings for the workers:
+  # S3, recognition and RDS access
+  #
+  backend = recognition_backend.get_backend(configur)
+  print("**backend:", backend.name, "**")
+
+  settings = {
+    'bucketname': configur.get('s3', 'bucket_name'),
+    'max_labels': configur.getint('rekognition', 'max_labels', fallback=10),
+    'min_confidence': configur.getfloat('rekognition', 'min_confidence', fallback=55),
+    'cache_ttl_days': configur.getint('rekognition', 'cache_ttl_days', fallback=0),
+    'rds': datatier.rds_settings(configur),
+  }
+
+  settings['cache_policy'] = recognition_cache.policy_key(
+    backend.name, settings['max_labels'], settings['min_confidence'],
+    configur.getint('rekognition', 'cache_version', fallback=1))
+
+  #
+  # at most this many records at once; more than the
+  # connection pool holds would only wait for a connection
+  #
+  workers = configur.getint('rekognition', 'workers', fallback=4)
+
+  results = [None] * len(bucketkeys)
+  jobs = [None] * len(bucketkeys)
+
+  def failed_record(i, err):
+    print("**ERROR when recognizing", bucketkeys[i], "**")
+    print(str(err))
+    results[i] = {"bucketkey": bucketkeys[i], "status": "error", "error": str(err)}
+
+  def begin(i):
+    if bucketkeys[i] is None:
+      results[i] = {"bucketkey": None, "status": "error", "error": "not an S3 object record"}
+      return
+    try:
+      jobs[i] = prepare(bucketkeys[i], settings, backend)
+      if "result" in jobs[i]:
+        results[i] = jobs[i]["result"]
+    except Exception as err:
+      failed_record(i, err)
+
+  def end(i):
+    try:
+      results[i] = finish(jobs[i], settings)
+    except Exception as err:
+      failed_record(i, err)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    list(pool.map(begin, range(len(bucketkeys))))
 
     #
-    # open LOCAL photo file:
+    # one backend call for every object that needs labels:
     #
-    print("**PROCESSING local photo**")
-    
-    #reader = PdfReader(local_pdf)
-    #number_of_pages = len(reader.pages)
+    pending = [i for i in range(len(bucketkeys)) if results[i] is None and "input" in jobs[i]]
+
+    if pending:
+      detected = backend.detect([jobs[i]["input"] for i in pending],
+                                settings['max_labels'], settings['min_confidence'])
+
+      for i, outcome in zip(pending, detected):
+        if "error" in outcome:
+          failed_record(i, outcome["error"])
+        else:
+          jobs[i]["labels"] = outcome["labels"]
+          jobs[i]["model_version"] = outcome["model_version"]
+
+    list(pool.map(end, [i for i in range(len(bucketkeys)) if results[i] is None]))
 
-    with open(local_filename, 'rb') as image_file:
-            image_bytes = image_file.read()
+  return backend.name, results
 
-    
-    response = rekognition.detect_labels(
-      Image={'Bytes':image_bytes},
-      MaxLabels = 5
-    )
 
+###################################################################
+#
+# run_jobs:
+#
+# Does a batch of queued jobs (see worker.py); returns, for
+# each job in order, None if it is done or an error message.
+#
+def run_jobs(jobs, configur):
+  errors = [None] * len(jobs)
+  recognize = []
+
+  for i, job in enumerate(jobs):
+    if job.get("type") == "recognize" and job.get("bucketkey"):
+      recognize.append(i)
+    else:
+      errors[i] = f"unknown job {json.dumps(job)}"
 
+  if recognize:
+    backend_name, results = recognize_all([jobs[i]["bucketkey"] for i in recognize], configur)
+    for i, result in zip(recognize, results):
+      if result["status"] == "error":
+        errors[i] = result["error"]
 
-    #Select the last created photo id and user id
+  return errors
+
+
+def drain_settings(configur):
+  """
+  Returns the worker.drain settings from the [queue] section
+  """
+  return {
+    'batch_size': configur.getint('queue', 'batch_size', fallback=10),
+    'max_attempts': configur.getint('queue', 'max_attempts', fallback=5),
+    'base_delay': configur.getint('queue', 'retry_base_delay', fallback=2),
+    'max_delay': configur.getint('queue', 'retry_max_delay', fallback=900),
+    'max_batches': configur.getint('queue', 'max_batches', fallback=None),
+  }
+
+
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: final_proj_recognition**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
     #
-    # open connection to the database:
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
+    print("**config read**")
+
     #
-    print("**Opening DB connection**")
+    # with a job queue, this function runs on a schedule (or
+    # with {"drain": true}) and works through the queued jobs
+    # in batches, stopping short of the Lambda time limit:
     #
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    if event.get("drain") or event.get("source") == "aws.events":
+      queue = jobqueue.get_queue(configur)
+      if queue is None:
+        raise Exception("no [queue] backend configured to drain")
+
+      time_left = context.get_remaining_time_in_millis if context is not None else None
+
+      summary = worker.drain(queue, lambda jobs: run_jobs(jobs, configur),
+                             time_left=time_left, **drain_settings(configur))
+
+      print("**DONE, queue drained:", summary["stop"], "**")
 
-    sql_get_photoid = """SELECT photoid, userid FROM photos ORDER BY photoid DESC LIMIT 1;"""
-    result = datatier.retrieve_one_row(dbConn, sql_get_photoid)
+      return {
+        'statusCode': 200,
+        'body': json.dumps(summary)
+      }
 
-    photoid, userid = result
-    print("photoid and userid")
-    print(photoid)
-    print(userid)
+    #
+    # otherwise it is event-driven by photos being dropped
+    # into S3; each record of the event names one object:
+    #
+    bucketkeys = event_bucketkeys(event)
+    print("records:", len(bucketkeys))
 
     #
-    #Store every label we recognized in to the table Labels
-    #with the photo id and user id
+    # with a job queue, the event is not recognized here (that
+    # would label the photos a second time), only queued when
+    # no upload lambda has queued it:
     #
+    queue = jobqueue.get_queue(configur)
+
+    if queue is not None:
+      queued = queue_unfinalized(queue, bucketkeys, configur)
+
+      print("**DONE,", len(queued), "of", len(bucketkeys), "records queued**")
 
-    all_labels = []
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"message": "Photos queued.", "queued": queued})
+      }
 
-    for label in response['Labels']:
-      label_name = label['Name']
-      confidence = label['Confidence'] #there is confidence for every label, save or not?
-      all_labels.append(label_name)
+    backend_name, results = recognize_all(bucketkeys, configur)
+
+    failed = sum(1 for result in results if result["status"] == "error")
 
-      # insert label in to Labels table
-      insert_sql = """INSERT INTO labels (photoid, userid, labelname) VALUES (%s, %s, %s)"""
-      
-      datatier.perform_action(dbConn, insert_sql, [photoid, userid, label_name])
-    
     #
     # done!
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE, returning success**")
-    
+    print("**DONE,", len(results) - failed, "of", len(results), "records processed**")
+
     return {
       'statusCode': 200,
-      'body': json.dumps({"message": "Photo recognized successfully.", "Photo with labels": all_labels})
-      
+      'body': json.dumps({"message": "Photos recognized.", "backend": backend_name,
+                          "failed": failed, "results": results})
     }
 
-    
   #
   # on an error, try to upload error message to S3:
   #
   except Exception as err:
     print("**ERROR when recognition photo**")
     print(str(err))
-     
+
     return {
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    datatier.log_query_summary()
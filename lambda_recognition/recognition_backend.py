@@ -0,0 +1,262 @@
+#
+# recognition_backend.py
+#
+# The services that recognize labels, behind one interface, so
+# lambda_recognition can run without Rekognition, e.g. to load
+# test ingestion or where AWS cannot be reached. Chosen with
+# [rekognition] backend:
+#
+#  rekognition  AWS Rekognition's detect_labels (the default)
+#  local        a colour / texture heuristic computed with NumPy
+#               on the Lambda's CPU; its labels (colours, light,
+#               texture, sky, vegetation) are much coarser, but
+#               cost nothing and need no network
+#
+# A backend works in two steps: prepare(...) turns one image
+# into the backend's input (reading S3 as needed; called for
+# many images at once, on worker threads), and detect(inputs,
+# ...) labels a batch of prepared inputs in one call. Both
+# produce labels in Rekognition's format, [{"Name",
+# "Confidence", "Parents": [{"Name"}], "Instances": [...]}],
+# so storing and caching them does not depend on the backend.
+#
+
+import concurrent.futures
+import io
+import numpy
+import recognition_input
+import runtime
+
+from PIL import Image
+
+
+###################################################################
+#
+# RekognitionBackend:
+#
+# Labels with AWS Rekognition. Images are passed as S3Object
+# references or downscaled copies (see recognition_input.py).
+# Rekognition labels one image per call, so detect makes the
+# calls of a batch concurrently.
+#
+class RekognitionBackend:
+  """
+  Recognition with AWS Rekognition
+
+  Parameters
+  ----------
+  workers : # of concurrent detect_labels calls,
+  max_dimension : largest width / height of a downscaled image
+  """
+
+  name = "rekognition"
+
+  def __init__(self, workers=4, max_dimension=recognition_input.DEFAULT_MAX_DIMENSION):
+    self.workers = workers
+    self.max_dimension = max_dimension
+
+  def prepare(self, s3_client, bucketname, bucketkey, meta, data=None):
+    """
+    Returns the Image parameter for the image; meta as for
+    recognition_input.choose, data its content if already read
+    """
+    if meta.get("bytesize") is None and data is None:
+      response = s3_client.head_object(Bucket=bucketname, Key=bucketkey)
+      meta = dict(meta, bytesize=response['ContentLength'])
+
+    strategy = recognition_input.choose(meta, in_memory=data is not None)
+    image, sent = recognition_input.image_param(strategy, s3_client, bucketname, bucketkey,
+                                                data, self.max_dimension)
+
+    print("**Recognizing", bucketkey, "with", strategy, "input,", sent, "bytes sent**")
+    return image
+
+  def detect(self, inputs, max_labels, min_confidence):
+    """
+    Returns a result for each prepared input, in order: a dict
+    with labels and model_version, or with error
+    """
+    rekognition = runtime.get_client('rekognition')
+
+    def detect_one(image):
+      try:
+        response = rekognition.detect_labels(
+          Image=image,
+          MaxLabels=max_labels,
+          MinConfidence=min_confidence
+        )
+        return {"labels": response['Labels'],
+                "model_version": response.get('LabelModelVersion')}
+      except Exception as err:
+        return {"error": str(err)}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+      return list(pool.map(detect_one, inputs))
+
+
+###################################################################
+#
+# LocalBackend:
+#
+# Labels from colour and texture statistics of a small copy of
+# the image. All the images of a batch are reduced to the same
+# SIZE, so detect works on one (N, SIZE, SIZE, 3) array.
+#
+class LocalBackend:
+  """
+  Recognition with a NumPy heuristic, on the local CPU
+  """
+
+  name = "local"
+  model_version = "local-heuristic-1"
+
+  SIZE = 64
+
+  #
+  # hue ranges (degrees) of the colour labels; red wraps around:
+  #
+  HUES = [("Red", 0, 15), ("Orange", 15, 40), ("Yellow", 40, 70), ("Green", 70, 165),
+          ("Blue", 165, 255), ("Purple", 255, 290), ("Pink", 290, 345), ("Red", 345, 360)]
+
+  def prepare(self, s3_client, bucketname, bucketkey, meta, data=None):
+    """
+    Returns the image reduced to SIZE x SIZE RGB pixels, as a
+    NumPy array; data is its content if already read
+    """
+    if data is None:
+      response = s3_client.get_object(Bucket=bucketname, Key=bucketkey)
+      data = response['Body'].read()
+
+    with Image.open(io.BytesIO(data)) as img:
+      img.draft("RGB", (self.SIZE * 2, self.SIZE * 2))
+      small = img.convert("RGB").resize((self.SIZE, self.SIZE), Image.BILINEAR)
+
+    return numpy.asarray(small, dtype=numpy.uint8)
+
+  def detect(self, inputs, max_labels, min_confidence):
+    """
+    Returns a result for each prepared input, in order: a dict
+    with labels and model_version
+    """
+    if not inputs:
+      return []
+
+    rgb = numpy.stack(inputs).astype(numpy.float32) / 255.0
+    scores = self._scores(rgb)
+
+    results = []
+    for i in range(len(inputs)):
+      labels = [{"Name": name, "Confidence": float(min(99.0, score[i] * 100)),
+                 "Parents": [{"Name": parent}] if parent else [], "Instances": []}
+                for name, parent, score in scores]
+      labels = [label for label in labels if label["Confidence"] >= min_confidence]
+      labels.sort(key=lambda label: -label["Confidence"])
+
+      results.append({"labels": labels[:max_labels], "model_version": self.model_version})
+
+    return results
+
+  def _scores(self, rgb):
+    """
+    Returns [(name, parent, scores)] for the batch rgb, of shape
+    (N, SIZE, SIZE, 3) with values 0-1; scores has one value
+    (0-1) per image
+    """
+    high = rgb.max(axis=3)
+    low = rgb.min(axis=3)
+    chroma = high - low
+
+    value = high
+    saturation = numpy.where(high > 0, chroma / numpy.maximum(high, 1e-6), 0)
+
+    #
+    # hue in degrees, from whichever channel is largest:
+    #
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    c = numpy.maximum(chroma, 1e-6)
+    hue = numpy.select([high == r, high == g],
+                       [((g - b) / c) % 6, (b - r) / c + 2],
+                       (r - g) / c + 4) * 60
+
+    colourful = (saturation > 0.25) & (value > 0.2)
+    pixels = float(self.SIZE * self.SIZE)
+
+    def fraction(mask):
+      return mask.reshape(mask.shape[0], -1).sum(axis=1) / pixels
+
+    colours = {}
+    for name, start, end in self.HUES:
+      share = fraction(colourful & (hue >= start) & (hue < end))
+      colours[name] = colours.get(name, 0) + share
+
+    scores = [(name, "Color", share) for name, share in colours.items()]
+    scores.append(("Black", "Color", fraction(value <= 0.2)))
+    scores.append(("White", "Color", fraction((value > 0.85) & (saturation < 0.15))))
+    scores.append(("Gray", "Color", fraction((value > 0.2) & (value <= 0.85) & (saturation < 0.15))))
+
+    #
+    # whole-image impressions:
+    #
+    mean_value = value.mean(axis=(1, 2))
+    mean_saturation = saturation.mean(axis=(1, 2))
+
+    scores.append(("Dark", "Lighting", numpy.clip((0.35 - mean_value) / 0.35, 0, 1)))
+    scores.append(("Bright", "Lighting", numpy.clip((mean_value - 0.65) / 0.35, 0, 1)))
+    scores.append(("Monochrome", None, numpy.clip((0.1 - mean_saturation) / 0.1, 0, 1)))
+
+    #
+    # texture: mean brightness change between neighbouring pixels
+    #
+    gray = rgb.mean(axis=3)
+    edges = (numpy.abs(numpy.diff(gray, axis=1)).mean(axis=(1, 2)) +
+             numpy.abs(numpy.diff(gray, axis=2)).mean(axis=(1, 2)))
+
+    scores.append(("Texture", None, numpy.clip(edges / 0.2, 0, 1)))
+    scores.append(("Smooth", "Texture", numpy.clip((0.05 - edges) / 0.05, 0, 1)))
+
+    #
+    # scenes: blue, light top third (sky); green share (plants)
+    #
+    top = slice(0, self.SIZE // 3)
+    sky = (colourful[:, top] & (hue[:, top] >= 180) & (hue[:, top] < 250) &
+           (value[:, top] > 0.5))
+    scores.append(("Sky", "Outdoors", numpy.clip(fraction(sky) * 3 / 0.6, 0, 1)))
+    scores.append(("Vegetation", "Plant", numpy.clip(colours["Green"] / 0.4, 0, 1)))
+
+    return scores
+
+
+BACKENDS = {"rekognition": RekognitionBackend, "local": LocalBackend}
+
+
+###################################################################
+#
+# get_backend:
+#
+# Returns the backend named in [rekognition] backend, set up
+# from the rest of the [rekognition] section. Raises ValueError
+# for an unknown name.
+#
+def get_backend(configur):
+  """
+  Returns the recognition backend chosen in the config
+
+  Parameters
+  ----------
+  configur : the parsed config file (ConfigParser)
+
+  Returns
+  -------
+  a backend object
+  """
+  name = configur.get('rekognition', 'backend', fallback='rekognition')
+
+  if name == "rekognition":
+    return RekognitionBackend(
+      workers=configur.getint('rekognition', 'workers', fallback=4),
+      max_dimension=configur.getint('rekognition', 'max_dimension',
+                                    fallback=recognition_input.DEFAULT_MAX_DIMENSION))
+  if name == "local":
+    return LocalBackend()
+
+  raise ValueError(f"unknown recognition backend '{name}', expected one of {sorted(BACKENDS)}")
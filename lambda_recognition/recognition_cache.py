@@ -0,0 +1,100 @@
+#
+# recognition_cache.py
+#
+# Content-addressed cache of recognition results, in the
+# recognition_cache table (see migration 11). Identical image
+# bytes get identical labels from the same backend and
+# settings, so a result is keyed by the image's SHA-256 and a
+# policy string naming those. Changing the backend, max_labels,
+# min_confidence or [rekognition] cache_version changes the
+# policy, so the cache never answers with results of another
+# policy; migrations/invalidate_recognition_cache.py clears
+# out the entries left behind.
+#
+
+import json
+import datatier
+
+
+###################################################################
+#
+# policy_key:
+#
+# Returns the policy string for the backend and its settings.
+#
+def policy_key(backend, max_labels, min_confidence, version=1):
+  """
+  Returns the cache policy for the recognition settings
+
+  Parameters
+  ----------
+  backend : name of the recognition backend (string),
+  max_labels : most labels per image (integer),
+  min_confidence : least confidence of a label,
+  version : [rekognition] cache_version (integer)
+
+  Returns
+  -------
+  the policy (string)
+  """
+  return f"{backend}:v{version}:max_labels={max_labels}:min_confidence={float(min_confidence):g}"
+
+
+###################################################################
+#
+# lookup:
+#
+# Returns (labels, model_version) cached for the content and
+# policy, or None on a miss (or if the entry has expired).
+#
+def lookup(dbConn, sha256, policy):
+  """
+  Returns the cached recognition result for an image, or None
+  """
+  sql = """
+    SELECT labels, model_version FROM recognition_cache
+     WHERE sha256 = %s AND policy = %s
+       AND (expires_at IS NULL OR expires_at > NOW());
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [sha256, policy])
+  if row == ():
+    return None
+
+  return json.loads(row[0]), row[1]
+
+
+###################################################################
+#
+# store:
+#
+# Caches the labels Rekognition returned for the content under
+# the policy, replacing any earlier entry. ttl_days of 0 (or
+# None) caches them until invalidated.
+#
+def store(dbConn, sha256, policy, labels, model_version, ttl_days=0):
+  """
+  Caches the recognition result for an image
+  """
+  #
+  # only what store_labels uses, to keep the rows small:
+  #
+  kept = [{"Name": label["Name"],
+           "Confidence": label["Confidence"],
+           "Parents": [{"Name": parent["Name"]} for parent in label.get("Parents", [])],
+           "Instances": [{"Confidence": instance.get("Confidence", label["Confidence"]),
+                          "BoundingBox": instance.get("BoundingBox", {})}
+                         for instance in label.get("Instances", [])]}
+          for label in labels]
+
+  sql = """
+    INSERT INTO recognition_cache (sha256, policy, model_version, labels, expires_at)
+      VALUES (%s, %s, %s, %s,
+              IF(%s > 0, NOW() + INTERVAL %s DAY, NULL))
+    ON DUPLICATE KEY UPDATE model_version = VALUES(model_version),
+                            labels = VALUES(labels),
+                            created_at = CURRENT_TIMESTAMP,
+                            expires_at = VALUES(expires_at)
+  """
+  ttl_days = ttl_days or 0
+  datatier.perform_action(dbConn, sql, [sha256, policy, model_version,
+                                        json.dumps(kept), ttl_days, ttl_days])
@@ -0,0 +1,167 @@
+#
+# recognition_input.py
+#
+# Chooses how an image is handed to Rekognition's detect_labels,
+# and prepares it:
+#
+#  s3object   Rekognition reads the object from S3 itself; the
+#             Lambda neither downloads it nor sends it. Allowed
+#             for JPEG / PNG objects up to 15 MB.
+#  bytes      the image, already in memory (e.g. read to finalize
+#             a presigned upload), is sent in the request; allowed
+#             up to 5 MB.
+#  downscale  for anything else, the image is reduced in memory
+#             to a JPEG no larger than max_dimension pixels a side
+#             and that is sent. Label detection gains nothing from
+#             more pixels than that, so a large original costs one
+#             download and a small request, instead of failing.
+#
+# The choice is made from the metadata recorded at upload (see
+# imagemeta.probe), so usually nothing is read from S3 to make it.
+#
+
+import io
+
+from PIL import Image
+
+
+#
+# Rekognition's limits for detect_labels:
+#
+FORMATS = {"JPEG", "PNG"}
+MAX_S3OBJECT_BYTES = 15 * 1024 * 1024
+MAX_BYTES = 5 * 1024 * 1024
+MIN_DIMENSION = 80
+
+DEFAULT_MAX_DIMENSION = 1600
+JPEG_QUALITY = 85
+
+STRATEGIES = ("s3object", "bytes", "downscale")
+
+
+###################################################################
+#
+# choose:
+#
+# Returns the strategy for an image. meta has the image's
+# bytesize, format, width and height, any of which may be None
+# when not known; in_memory says whether its content is at hand
+# already.
+#
+def choose(meta, in_memory=False):
+  """
+  Returns how the image should be passed to Rekognition
+
+  Parameters
+  ----------
+  meta : dict with bytesize, format, width, height (or None),
+  in_memory : True if the image content has been read already
+
+  Returns
+  -------
+  one of STRATEGIES
+  """
+  bytesize = meta.get("bytesize")
+  format = meta.get("format")
+  width = meta.get("width")
+  height = meta.get("height")
+
+  #
+  # an image too small for Rekognition is rejected whichever way
+  # it is sent, and upscaling would not make it recognizable;
+  # let Rekognition say so rather than fetching it:
+  #
+  if width is not None and height is not None and min(width, height) < MIN_DIMENSION:
+    return "s3object"
+
+  if format is not None and format not in FORMATS:
+    return "downscale"
+
+  if in_memory and bytesize is not None and bytesize <= MAX_BYTES:
+    return "bytes"
+
+  if bytesize is not None and bytesize <= MAX_S3OBJECT_BYTES:
+    return "s3object"
+
+  return "downscale"
+
+
+###################################################################
+#
+# downscale:
+#
+# Returns the image in data reduced to fit max_dimension pixels
+# a side, as JPEG bytes. JPEGs are decoded at a reduced scale
+# (draft mode) where that still leaves max_dimension pixels, so
+# a large original is never decoded in full; images that are
+# small enough already are only re-encoded.
+#
+def downscale(data, max_dimension=DEFAULT_MAX_DIMENSION):
+  """
+  Returns a reduced JPEG of the image, for label detection
+
+  Parameters
+  ----------
+  data : raw image content (bytes),
+  max_dimension : largest width / height of the result (pixels)
+
+  Returns
+  -------
+  JPEG content (bytes)
+  """
+  with Image.open(io.BytesIO(data)) as img:
+    img.draft("RGB", (max_dimension, max_dimension))
+    small = img.convert("RGB")
+
+  small.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+  quality = JPEG_QUALITY
+  while True:
+    out = io.BytesIO()
+    small.save(out, format="JPEG", quality=quality)
+    if out.tell() <= MAX_BYTES or quality <= 50:
+      return out.getvalue()
+    quality -= 10
+
+
+###################################################################
+#
+# image_param:
+#
+# Returns (image, sent) for detect_labels: the Image parameter
+# for the strategy, and the number of bytes sent in the request
+# (0 for an S3Object reference). data is the image content if
+# already read; otherwise downscale reads it from S3.
+#
+def image_param(strategy, s3_client, bucketname, bucketkey, data=None,
+                max_dimension=DEFAULT_MAX_DIMENSION):
+  """
+  Returns the Image parameter for detect_labels, prepared with
+  the given strategy
+
+  Parameters
+  ----------
+  strategy : one of STRATEGIES,
+  s3_client : boto3 S3 client,
+  bucketname : bucket holding the image,
+  bucketkey : key of the image,
+  data : the image content (bytes), or None if not read yet,
+  max_dimension : largest width / height when downscaling
+
+  Returns
+  -------
+  tuple (image, sent)
+  """
+  if strategy == "s3object":
+    return {'S3Object': {'Bucket': bucketname, 'Name': bucketkey}}, 0
+
+  if data is None:
+    response = s3_client.get_object(Bucket=bucketname, Key=bucketkey)
+    data = response['Body'].read()
+
+  if strategy == "downscale":
+    data = downscale(data, max_dimension)
+  elif strategy != "bytes":
+    raise ValueError(f"unknown recognition input strategy '{strategy}'")
+
+  return {'Bytes': data}, len(data)
@@ -0,0 +1,162 @@
+#
+# worker.py
+#
+# Drains the job queue (see jobqueue.py) in batches. Each batch
+# is handed to a function that does the jobs (for recognition,
+# lambda_function.run_jobs, which labels the batch with one
+# backend call and [rekognition] workers threads); finished
+# jobs are acked, failed ones retried after an exponential
+# backoff, and a job that has failed [queue] max_attempts times
+# is moved to the dead-letter store. After each batch the queue
+# depth is logged as a structured record, {"event":
+# "queue.depth", ...}, for metrics and alarms.
+#
+# Draining stops when the queue is empty, after max_batches, when
+# the Lambda is close to its time limit, or when the service is
+# throttling us: the rest waits for the next run, rather than
+# being retried into the throttle.
+#
+# Usage (e.g. against a SQLite queue, on one machine):
+#   python worker.py [--once]
+#
+# drains until the queue is empty and then polls for more, or
+# with --once stops when it is empty.
+#
+
+import json
+import jobqueue
+import time
+
+
+#
+# error text that means the service is throttling us:
+#
+THROTTLING = ("Throttling", "ThrottlingException", "ProvisionedThroughputExceeded",
+              "LimitExceeded", "TooManyRequests", "SlowDown")
+
+
+def throttled(error):
+  """
+  Returns True if the error says the service is throttling
+  """
+  return any(marker in error for marker in THROTTLING)
+
+
+def log_depth(queue, **counts):
+  """
+  Logs the queue depth (and counts for the last batch) as a
+  structured (JSON) log record; returns the depth
+  """
+  depth = queue.depth()
+  record = {'event': 'queue.depth'}
+  record.update(depth)
+  record.update(counts)
+  print(json.dumps(record))
+  return depth
+
+
+###################################################################
+#
+# drain:
+#
+# Receives batches of up to batch_size jobs and does them with
+# run_jobs(jobs), which returns, for each job in order, None if
+# it succeeded or an error message. Returns a summary dict.
+#
+def drain(queue, run_jobs, batch_size=10, max_attempts=5, base_delay=2, max_delay=900,
+          max_batches=None, wait_seconds=0, time_left=None, reserve_ms=60000):
+  """
+  Works through the queue in batches
+
+  Parameters
+  ----------
+  queue : a jobqueue queue,
+  run_jobs : function doing a list of jobs, returning a list of
+             None (done) or error message (string),
+  batch_size : jobs per batch,
+  max_attempts : attempts before a job is dead-lettered,
+  base_delay, max_delay : retry backoff (seconds),
+  max_batches : stop after this many batches (None: no limit),
+  wait_seconds : how long to wait for jobs before stopping,
+  time_left : function returning the ms left to run, or None,
+  reserve_ms : stop when fewer ms than this are left
+
+  Returns
+  -------
+  dict with batches, done, retried, dead and stop (the reason
+  for stopping)
+  """
+  summary = {"batches": 0, "done": 0, "retried": 0, "dead": 0, "stop": "empty"}
+
+  while max_batches is None or summary["batches"] < max_batches:
+    if time_left is not None and time_left() < reserve_ms:
+      summary["stop"] = "time"
+      break
+
+    messages = queue.receive(batch_size, wait_seconds)
+    if not messages:
+      summary["stop"] = "empty"
+      break
+
+    errors = run_jobs([message["job"] for message in messages])
+
+    done = [message for message, error in zip(messages, errors) if error is None]
+    queue.ack(done)
+
+    retried = dead = 0
+    throttling = False
+
+    for message, error in zip(messages, errors):
+      if error is None:
+        continue
+
+      throttling = throttling or throttled(error)
+
+      if message["attempts"] >= max_attempts:
+        print("**Dead-lettering job", message["id"], "after", message["attempts"],
+              "attempts:", error, "**")
+        queue.dead_letter(message, error)
+        dead += 1
+      else:
+        queue.retry(message, jobqueue.backoff_delay(message["attempts"], base_delay, max_delay))
+        retried += 1
+
+    summary["batches"] += 1
+    summary["done"] += len(done)
+    summary["retried"] += retried
+    summary["dead"] += dead
+
+    summary["depth"] = log_depth(queue, batch_done=len(done), batch_retried=retried,
+                                 batch_dead=dead)
+
+    if throttling:
+      summary["stop"] = "throttled"
+      break
+  else:
+    summary["stop"] = "max_batches"
+
+  return summary
+
+
+if __name__ == "__main__":
+  import sys
+  import lambda_function
+  import runtime
+
+  once = "--once" in sys.argv
+
+  while True:
+    configur = runtime.get_config()
+    queue = jobqueue.get_queue(configur)
+    if queue is None:
+      print("no [queue] backend configured")
+      sys.exit(1)
+
+    summary = drain(queue, lambda jobs: lambda_function.run_jobs(jobs, configur),
+                    **lambda_function.drain_settings(configur))
+    print(json.dumps(summary))
+
+    if once and summary["stop"] == "empty":
+      break
+    if summary["stop"] in ("empty", "throttled"):
+      time.sleep(5)
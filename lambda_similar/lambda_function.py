@@ -0,0 +1,176 @@
+#
+# Finds the photos of a user that look nearly the same as one
+# of their photos (re-encodes, resizes, small edits), by the
+# Hamming distance between perceptual hashes. Candidates come
+# from the phash chunk indexes (see hashindex.py), so the cost
+# depends on the number of near matches, not on the size of
+# the user's library.
+#
+
+import json
+import datatier
+import hashindex
+import runtime
+
+DEFAULT_DISTANCE = 10
+MAX_RESULTS = 100
+
+
+def distance_param(event):
+  """
+  Returns the max_distance requested by the event (top-level or
+  in queryStringParameters), or DEFAULT_DISTANCE; raises
+  ValueError on a bad value
+  """
+  params = event.get("queryStringParameters") or {}
+  value = event.get("max_distance", params.get("max_distance"))
+
+  if value is None or value == "":
+    return DEFAULT_DISTANCE
+
+  try:
+    value = int(value)
+  except (TypeError, ValueError):
+    raise ValueError("max_distance must be a number")
+
+  if not 0 <= value <= hashindex.MAX_DISTANCE:
+    raise ValueError(f"max_distance must be between 0 and {hashindex.MAX_DISTANCE}")
+
+  return value
+
+
+def similar_photos(dbConn, userid, photoid, phash, max_distance):
+  """
+  Returns (photoid, original_name, distance) of the user's other
+  photos within max_distance of phash, nearest first
+  """
+  #
+  # one indexed lookup per chunk: the photos having that chunk
+  # within the search radius of the photo's chunk. UNION drops
+  # the photos found through more than one chunk.
+  #
+  selects = []
+  parameters = []
+
+  for i, values in enumerate(hashindex.probes(phash, max_distance)):
+    placeholders = ", ".join(["%s"] * len(values))
+    selects.append(f"SELECT photoid FROM photos WHERE userid = %s AND phash_{i} IN ({placeholders})")
+    parameters += [userid] + values
+
+  sql = f"""
+    SELECT p.photoid, p.original_name, BIT_COUNT(p.phash ^ %s) AS distance
+      FROM ({" UNION ".join(selects)}) c
+      JOIN photos p ON p.photoid = c.photoid
+     WHERE p.photoid <> %s AND BIT_COUNT(p.phash ^ %s) <= %s
+     ORDER BY distance, p.photoid
+     LIMIT %s;
+  """
+
+  return datatier.retrieve_all_rows(dbConn, sql,
+                                    [phash] + parameters + [photoid, phash, max_distance, MAX_RESULTS])
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_similar**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for RDS access
+    #
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
+
+    #
+    # userid and photoid from event: could be parameters
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    params = event.get("pathParameters") or event
+
+    if "userid" not in params or "photoid" not in params:
+      raise Exception("requires userid and photoid parameters in event")
+
+    userid = params["userid"]
+    photoid = params["photoid"]
+
+    try:
+      max_distance = distance_param(event)
+    except ValueError as err:
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
+
+    print("userid:", userid, "photoid:", photoid, "max_distance:", max_distance)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    sql = "SELECT phash FROM photos WHERE photoid = %s AND userid = %s;"
+
+    row = datatier.retrieve_one_row(dbConn, sql, [photoid, userid])
+
+    if row == ():  # no such photo for this user
+      print("**No such photo, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such photo...")
+      }
+
+    phash = row[0]
+
+    if phash is None:
+      print("**Photo not hashed yet, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("photo has no perceptual hash yet...")
+      }
+
+    #
+    # the near matches, through the chunk indexes:
+    #
+    print("**Searching similar photos**")
+
+    rows = similar_photos(dbConn, int(userid), int(photoid), phash, max_distance)
+
+    similar = [{"photoid": r[0], "original_name": r[1], "distance": r[2]} for r in rows]
+
+    print("**DONE, returning", len(similar), "photos**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({
+        "photoid": int(photoid),
+        "max_distance": max_distance,
+        "similar": similar
+      })
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
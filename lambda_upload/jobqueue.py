@@ -0,0 +1,359 @@
+#
+# jobqueue.py
+#
+# The queue of post-upload work. The upload lambdas send a job
+# (e.g. {"type": "recognize", "bucketkey": ...}) for each new
+# object, and lambda_recognition drains the queue in batches
+# (see worker.py), retrying failed jobs with a backoff and
+# moving jobs that keep failing to a dead-letter store, instead
+# of doing the work once per S3 event. Chosen with [queue]
+# backend:
+#
+#  sqs     an SQS queue, [queue] url, with dead letters sent to
+#          the queue at [queue] dead_letter_url; [sqs]
+#          endpoint_url can point at a local SQS stand-in
+#  sqlite  a SQLite database at [queue] path, holding both the
+#          queue and the dead letters; for running everything
+#          on one machine (e.g. with MinIO for S3)
+#  none    no queue (the default): recognition runs on the S3
+#          events, as before
+#
+# Both queues hand out a message as a dict {"id", "receipt",
+# "job", "attempts"}; a received message stays invisible to
+# other workers for visibility_timeout seconds, and comes back
+# unless it is acked or dead-lettered by then.
+#
+
+import json
+import random
+import runtime
+import sqlite3
+import time
+
+
+DEFAULT_VISIBILITY_TIMEOUT = 300  # seconds
+
+
+###################################################################
+#
+# backoff_delay:
+#
+# Returns the delay (seconds) before retrying a job that has
+# failed attempts times: exponential, capped, with jitter so
+# that jobs which failed together do not retry together.
+#
+def backoff_delay(attempts, base=2, cap=900):
+  """
+  Returns the retry delay after the given number of attempts
+  """
+  delay = min(cap, base * 2 ** max(0, attempts - 1))
+  return int(delay * random.uniform(0.5, 1.0))
+
+
+###################################################################
+#
+# SQSQueue:
+#
+class SQSQueue:
+  """
+  A job queue in Amazon SQS
+
+  Parameters
+  ----------
+  url : the queue URL,
+  dead_letter_url : URL of the queue for jobs that keep failing,
+  visibility_timeout : seconds a received job is hidden
+  """
+
+  SEND_BATCH = 10  # SQS's limit per send_message_batch
+
+  def __init__(self, url, dead_letter_url, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    self.url = url
+    self.dead_letter_url = dead_letter_url
+    self.visibility_timeout = visibility_timeout
+
+  def send(self, jobs, delay=0):
+    """
+    Adds the jobs (dicts) to the queue
+    """
+    sqs = runtime.get_client('sqs')
+
+    for start in range(0, len(jobs), self.SEND_BATCH):
+      entries = [{"Id": str(i), "MessageBody": json.dumps(job), "DelaySeconds": delay}
+                 for i, job in enumerate(jobs[start:start + self.SEND_BATCH])]
+      response = sqs.send_message_batch(QueueUrl=self.url, Entries=entries)
+
+      if response.get('Failed'):
+        raise Exception(f"could not queue {len(response['Failed'])} job(s): "
+                        f"{response['Failed'][0].get('Message')}")
+
+  def receive(self, max_jobs, wait_seconds=0):
+    """
+    Returns up to max_jobs messages (at most 10, SQS's limit)
+    """
+    sqs = runtime.get_client('sqs')
+
+    response = sqs.receive_message(
+      QueueUrl=self.url,
+      MaxNumberOfMessages=max(1, min(10, max_jobs)),
+      WaitTimeSeconds=wait_seconds,
+      VisibilityTimeout=self.visibility_timeout,
+      AttributeNames=['ApproximateReceiveCount']
+    )
+
+    return [{"id": message['MessageId'],
+             "receipt": message['ReceiptHandle'],
+             "job": json.loads(message['Body']),
+             "attempts": int(message['Attributes']['ApproximateReceiveCount'])}
+            for message in response.get('Messages', [])]
+
+  def ack(self, messages):
+    """
+    Removes finished messages from the queue
+    """
+    if not messages:
+      return
+
+    sqs = runtime.get_client('sqs')
+    sqs.delete_message_batch(QueueUrl=self.url,
+                             Entries=[{"Id": str(i), "ReceiptHandle": message["receipt"]}
+                                      for i, message in enumerate(messages)])
+
+  def retry(self, message, delay):
+    """
+    Makes a failed message visible again after delay seconds
+    """
+    sqs = runtime.get_client('sqs')
+    sqs.change_message_visibility(QueueUrl=self.url, ReceiptHandle=message["receipt"],
+                                  VisibilityTimeout=min(delay, 12 * 60 * 60))
+
+  def dead_letter(self, message, error):
+    """
+    Moves a message that keeps failing to the dead-letter queue
+    """
+    sqs = runtime.get_client('sqs')
+    sqs.send_message(
+      QueueUrl=self.dead_letter_url,
+      MessageBody=json.dumps(message["job"]),
+      MessageAttributes={
+        'error': {'DataType': 'String', 'StringValue': error[:1024] or "unknown"},
+        'attempts': {'DataType': 'Number', 'StringValue': str(message["attempts"])},
+      }
+    )
+    self.ack([message])
+
+  def depth(self):
+    """
+    Returns the approximate number of messages waiting
+    (visible), being worked on or delayed (not_visible), and
+    dead-lettered (dead)
+    """
+    sqs = runtime.get_client('sqs')
+
+    def attributes(url):
+      response = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=[
+        'ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible',
+        'ApproximateNumberOfMessagesDelayed'])
+      return {name: int(value) for name, value in response['Attributes'].items()}
+
+    queue = attributes(self.url)
+    dead = attributes(self.dead_letter_url)
+
+    return {"visible": queue['ApproximateNumberOfMessages'],
+            "not_visible": queue['ApproximateNumberOfMessagesNotVisible'] +
+                           queue['ApproximateNumberOfMessagesDelayed'],
+            "dead": dead['ApproximateNumberOfMessages']}
+
+
+###################################################################
+#
+# SQLiteQueue:
+#
+# The same queue in a SQLite database file, for a single
+# machine. Each operation opens its own connection, so the
+# queue can be shared by threads (and processes).
+#
+class SQLiteQueue:
+  """
+  A job queue in a SQLite database
+
+  Parameters
+  ----------
+  path : the database file,
+  visibility_timeout : seconds a received job is hidden
+  """
+
+  def __init__(self, path, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    self.path = path
+    self.visibility_timeout = visibility_timeout
+
+    with self._connect() as dbConn:
+      dbConn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs
+        (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            body          TEXT NOT NULL,
+            attempts      INTEGER NOT NULL DEFAULT 0,
+            available_at  REAL NOT NULL,
+            created_at    REAL NOT NULL
+        )
+      """)
+      dbConn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_available ON jobs (available_at)")
+      dbConn.execute("""
+        CREATE TABLE IF NOT EXISTS dead_jobs
+        (
+            id         INTEGER PRIMARY KEY,
+            body       TEXT NOT NULL,
+            attempts   INTEGER NOT NULL,
+            error      TEXT,
+            failed_at  REAL NOT NULL
+        )
+      """)
+
+  def _connect(self):
+    dbConn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+    dbConn.execute("PRAGMA journal_mode=WAL")
+    return _Closing(dbConn)
+
+  def send(self, jobs, delay=0):
+    """
+    Adds the jobs (dicts) to the queue
+    """
+    now = time.time()
+    with self._connect() as dbConn:
+      dbConn.executemany("INSERT INTO jobs (body, available_at, created_at) VALUES (?, ?, ?)",
+                         [(json.dumps(job), now + delay, now) for job in jobs])
+
+  def receive(self, max_jobs, wait_seconds=0):
+    """
+    Returns up to max_jobs messages, waiting up to wait_seconds
+    for the first
+    """
+    deadline = time.time() + wait_seconds
+
+    while True:
+      now = time.time()
+      with self._connect() as dbConn:
+        #
+        # claim the jobs atomically, so two workers never get
+        # the same one:
+        #
+        dbConn.execute("BEGIN IMMEDIATE")
+        rows = dbConn.execute("""
+          SELECT id, body, attempts FROM jobs
+           WHERE available_at <= ?
+           ORDER BY available_at, id
+           LIMIT ?
+        """, (now, max_jobs)).fetchall()
+
+        dbConn.executemany("UPDATE jobs SET attempts = attempts + 1, available_at = ? WHERE id = ?",
+                           [(now + self.visibility_timeout, row[0]) for row in rows])
+        dbConn.execute("COMMIT")
+
+      if rows or time.time() >= deadline:
+        return [{"id": row[0], "receipt": row[0], "job": json.loads(row[1]),
+                 "attempts": row[2] + 1}
+                for row in rows]
+
+      time.sleep(min(1, max(0, deadline - time.time())))
+
+  def ack(self, messages):
+    """
+    Removes finished messages from the queue
+    """
+    with self._connect() as dbConn:
+      dbConn.executemany("DELETE FROM jobs WHERE id = ?",
+                         [(message["receipt"],) for message in messages])
+
+  def retry(self, message, delay):
+    """
+    Makes a failed message visible again after delay seconds
+    """
+    with self._connect() as dbConn:
+      dbConn.execute("UPDATE jobs SET available_at = ? WHERE id = ?",
+                     (time.time() + delay, message["receipt"]))
+
+  def dead_letter(self, message, error):
+    """
+    Moves a message that keeps failing to the dead_jobs table
+    """
+    with self._connect() as dbConn:
+      dbConn.execute("BEGIN IMMEDIATE")
+      dbConn.execute("INSERT OR REPLACE INTO dead_jobs (id, body, attempts, error, failed_at) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (message["receipt"], json.dumps(message["job"]), message["attempts"],
+                      error, time.time()))
+      dbConn.execute("DELETE FROM jobs WHERE id = ?", (message["receipt"],))
+      dbConn.execute("COMMIT")
+
+  def depth(self):
+    """
+    Returns the number of messages waiting (visible), being
+    worked on or delayed (not_visible), and dead-lettered (dead)
+    """
+    now = time.time()
+    with self._connect() as dbConn:
+      visible, not_visible = dbConn.execute(
+        "SELECT COALESCE(SUM(available_at <= ?), 0), COALESCE(SUM(available_at > ?), 0) FROM jobs",
+        (now, now)).fetchone()
+      dead = dbConn.execute("SELECT COUNT(*) FROM dead_jobs").fetchone()[0]
+
+    return {"visible": visible, "not_visible": not_visible, "dead": dead}
+
+
+class _Closing:
+  #
+  # sqlite3's own context manager only ends the transaction;
+  # this closes the connection too
+  #
+  def __init__(self, dbConn):
+    self.dbConn = dbConn
+
+  def __enter__(self):
+    return self.dbConn
+
+  def __exit__(self, kind, value, traceback):
+    if kind is not None and self.dbConn.in_transaction:
+      self.dbConn.execute("ROLLBACK")
+    self.dbConn.close()
+
+
+###################################################################
+#
+# get_queue:
+#
+# Returns the queue set up in the [queue] section of the config
+# file, or None if there is none. Raises ValueError if the
+# section is incomplete.
+#
+def get_queue(configur):
+  """
+  Returns the job queue chosen in the config, or None
+
+  Parameters
+  ----------
+  configur : the parsed config file (ConfigParser)
+
+  Returns
+  -------
+  an SQSQueue, SQLiteQueue, or None
+  """
+  backend = configur.get('queue', 'backend', fallback='none')
+  visibility_timeout = configur.getint('queue', 'visibility_timeout',
+                                       fallback=DEFAULT_VISIBILITY_TIMEOUT)
+
+  if backend == "none":
+    return None
+
+  if backend == "sqs":
+    url = configur.get('queue', 'url', fallback=None)
+    dead_letter_url = configur.get('queue', 'dead_letter_url', fallback=None)
+    if not url or not dead_letter_url:
+      raise ValueError("[queue] backend sqs needs url and dead_letter_url")
+    return SQSQueue(url, dead_letter_url, visibility_timeout)
+
+  if backend == "sqlite":
+    path = configur.get('queue', 'path', fallback='pixeltailor-queue.sqlite3')
+    return SQLiteQueue(path, visibility_timeout)
+
+  raise ValueError(f"unknown [queue] backend '{backend}', expected sqs, sqlite or none")
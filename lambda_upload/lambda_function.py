@@ -3,48 +3,48 @@
 #
 
 import json
-import boto3
-import os
-import uuid
 import base64
 import pathlib
 import datatier
+import imagemeta
+import jobqueue
+import runtime
+import uploads
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: final_upload**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
     #TODO: config file needed
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for S3 access:
     #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
     bucketname = configur.get('s3', 'bucket_name')
     
-    s3 = boto3.resource('s3')
+    s3 = runtime.get_resource('s3')
     bucket = s3.Bucket(bucketname)
+
+    #
+    # the queue for recognition, if recognition is queued rather
+    # than driven by S3 events (see jobqueue.py):
+    #
+    queue = jobqueue.get_queue(configur)
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
     
     #
     # userid from event: could be a parameter
@@ -96,7 +96,7 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
 
     #
     # first we need to make sure the userid is valid:
@@ -140,6 +140,22 @@ def lambda_handler(event, context):
     if extension not in ['.jpg', '.jpeg', '.png']:
         raise Exception("Invalid file format. Only .jpg, .jpeg, .png are allowed")
 
+    #
+    # read the image header (no decode of the pixels) for the
+    # metadata stored with the photo; this also rejects files
+    # that are not really JPEG or PNG images:
+    #
+    print("**Probing image metadata**")
+    meta = imagemeta.probe(bytes)
+    print("metadata:", meta)
+
+    #
+    # perceptual hash, stored whole and as indexed chunks for
+    # the near-duplicate search (lambda_similar):
+    #
+    phash = imagemeta.dhash(bytes)
+    print("phash:", format(phash, "016x"))
+
     # Write image data to a temporary file
     print("**Writing local data file**")
     local_filename = f"/tmp/data{extension}"
@@ -151,51 +167,59 @@ def lambda_handler(event, context):
     #
     print("**Uploading local file to S3**")
     
-    basename = pathlib.Path(filename).stem
-
-    bucketkey = f"pixeltailor/{bucketfolder}/{basename}-{uuid.uuid4()}{extension}"
+    bucketkey = uploads.new_bucketkey(bucketfolder, filename, extension)
     
     print("S3 bucketkey:", bucketkey)
 
+    #
+    # insert the photos row and upload to S3 as one unit of work:
+    # if the upload fails the row is rolled back, so we never
+    # leave a photo row behind without an object in S3. If the
+    # same content was uploaded before, the photo shares that
+    # object and its labels instead: no upload, and (with no new
+    # object in S3) no recognition.
+    #
     print("**Adding photos row to database**")
     
-    sql = """
-      INSERT INTO photos(userid, original_name, bucketkey)
-                  VALUES(%s, %s, %s);
-    """
-    
-    datatier.perform_action(dbConn, sql, [userid, filename, bucketkey])
+    with datatier.transaction(dbConn) as tx:
+      photoid, bucketkey, duplicate = \
+        uploads.store_photo(tx, userid, filename, bucketkey, meta, phash)
 
-    # grab the photoid that was auto-generated by mysql:
-    #
-    sql = "SELECT LAST_INSERT_ID();"
-    
-    row = datatier.retrieve_one_row(dbConn, sql)
-    
-    photoid = row[0]
-    
-    print("photoid:", photoid)
+      if not duplicate:
+        #
+        # now let's upload image to S3:
+        #
+        print("**Uploading data file to S3**")
 
-    #
-    # now that DB is updated, let's upload image to S3:
-    #
-    print("**Uploading data file to S3**")
+        content_type = imagemeta.content_type(meta["format"])
+        bucket.upload_file(
+                local_filename,
+                bucketkey,
+                ExtraArgs={
+                    'ACL': 'public-read',
+                    'ContentType': content_type
+                }
+            )
 
-    content_type = f"image/{extension.replace('.', '')}"
-    bucket.upload_file(
-            local_filename,
-            bucketkey,
-            ExtraArgs={
-                'ACL': 'public-read',
-                'ContentType': content_type
-            }
-        )
+        if queue is not None:
+          #
+          # queued with the row, so that failing to queue it
+          # fails the upload; the job may run before the commit,
+          # and is retried until the row is there
+          #
+          try:
+            queue.send([{"type": "recognize", "bucketkey": bucketkey}])
+          except Exception:
+            bucket.Object(bucketkey).delete()
+            raise
 
     print("**DONE**")
     
     return {
       'statusCode': 200,
-      'body': json.dumps({"message": "Photo uploaded successfully.", "photoid": photoid})
+      'body': json.dumps({"message": "Photo uploaded successfully.", "photoid": photoid,
+                          "width": meta["width"], "height": meta["height"],
+                          "format": meta["format"], "duplicate": duplicate})
     }
     
   except Exception as err:
@@ -206,3 +230,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
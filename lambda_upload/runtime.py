@@ -0,0 +1,181 @@
+#
+# runtime.py
+#
+# Per-container state shared by every invocation of a Lambda
+# function: the config file, the boto3 session, and the AWS
+# clients built from it. Lambda reuses a container for many
+# invocations, so these are built once, on first use, and kept
+# at module scope. If the config file changes on disk, the
+# cached config and everything built from it are rebuilt.
+#
+# A service's section of the config file may set endpoint_url
+# (e.g. [s3] endpoint_url = http://localhost:9000) to use a
+# local stand-in for that service, such as MinIO for S3.
+#
+
+import boto3
+import os
+import threading
+
+from configparser import ConfigParser
+
+
+CONFIG_FILE = 'final-project-config.ini'
+S3_PROFILE = 's3readwrite'
+
+#
+# the config file doubles as the AWS credentials file:
+#
+os.environ['AWS_SHARED_CREDENTIALS_FILE'] = CONFIG_FILE
+
+_lock = threading.RLock()
+_config = None
+_config_stamp = None
+_session = None
+_clients = {}
+_resources = {}
+
+
+def _file_stamp(filename):
+  try:
+    info = os.stat(filename)
+    return (info.st_mtime_ns, info.st_size)
+  except FileNotFoundError:
+    return None
+
+
+###################################################################
+#
+# get_config:
+#
+# Returns the parsed config file. The file is only re-read when
+# its modification time or size changes, in which case the
+# cached boto3 session and clients are discarded too, since
+# the credentials they were built with may have changed.
+#
+def get_config():
+  """
+  Returns the parsed config file, cached across invocations
+
+  Parameters
+  ----------
+  None
+
+  Returns
+  -------
+  a ConfigParser object
+  """
+  global _config, _config_stamp, _session
+
+  stamp = _file_stamp(CONFIG_FILE)
+
+  with _lock:
+    if _config is None or stamp != _config_stamp:
+      if _config is not None:
+        print("**runtime: config file changed, reloading**")
+
+      configur = ConfigParser()
+      configur.read(CONFIG_FILE)
+
+      _config = configur
+      _config_stamp = stamp
+      _session = None
+      _clients.clear()
+      _resources.clear()
+
+    return _config
+
+
+###################################################################
+#
+# get_session:
+#
+# Returns the boto3 session for the s3readwrite profile,
+# creating it on first use.
+#
+def get_session():
+  """
+  Returns the boto3 session, cached across invocations
+
+  Parameters
+  ----------
+  None
+
+  Returns
+  -------
+  a boto3 Session object
+  """
+  global _session
+
+  get_config()  # reloads (and drops the session) if the file changed
+
+  with _lock:
+    if _session is None:
+      _session = boto3.Session(profile_name=S3_PROFILE)
+    return _session
+
+
+def _endpoint_options(service_name):
+  configur = get_config()
+  endpoint_url = configur.get(service_name, 'endpoint_url', fallback=None)
+  return {'endpoint_url': endpoint_url} if endpoint_url else {}
+
+
+###################################################################
+#
+# get_client:
+#
+# Returns a low-level boto3 client for the given service, e.g.
+# 's3' or 'rekognition', creating it on first use. Clients are
+# thread-safe and can be shared.
+#
+def get_client(service_name):
+  """
+  Returns a boto3 client, cached across invocations
+
+  Parameters
+  ----------
+  service_name : AWS service name, e.g. 's3' (string)
+
+  Returns
+  -------
+  a boto3 client object
+  """
+  session = get_session()
+
+  with _lock:
+    client = _clients.get(service_name)
+    if client is None:
+      client = session.client(service_name, **_endpoint_options(service_name))
+      _clients[service_name] = client
+    return client
+
+
+###################################################################
+#
+# get_resource:
+#
+# Returns a boto3 resource for the given service, e.g. 's3',
+# creating it on first use. Unlike clients, resources are not
+# thread-safe: use get_client when sharing across threads.
+#
+def get_resource(service_name):
+  """
+  Returns a boto3 resource, cached across invocations
+
+  Parameters
+  ----------
+  service_name : AWS service name, e.g. 's3' (string)
+
+  Returns
+  -------
+  a boto3 resource object
+  """
+  session = get_session()
+
+  with _lock:
+    resource = _resources.get(service_name)
+    if resource is None:
+      resource = session.resource(service_name, **_endpoint_options(service_name))
+      _resources[service_name] = resource
+    return resource
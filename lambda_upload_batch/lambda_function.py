@@ -0,0 +1,322 @@
+#
+# Uploads a batch of images to S3 in the PixelTailor database,
+# in one call: the user is checked once, the photos rows are
+# added with one multi-row INSERT, and the images are put to S3
+# by a bounded pool of threads. Each file succeeds or fails on
+# its own; the response lists a photoid or error per file.
+#
+# The body is {"files": [{"filename": ..., "data": <base64>},
+# ...]}, i.e. what lambda_upload takes, for many files. The
+# whole request must fit in one Lambda invocation (6 MB, as
+# base64), so the files together may decode to at most
+# MAX_TOTAL_SIZE, and so may each file (MAX_SIZE). A larger
+# batch is refused with 413, and a larger file gets an error of
+# its own; they should be reserved with /upload-url ({"files":
+# [...]}) and PUT to S3 directly instead.
+#
+
+import base64
+import binascii
+import concurrent.futures
+import json
+import pathlib
+import datatier
+import imagemeta
+import jobqueue
+import runtime
+import uploads
+
+from collections import Counter
+
+MAX_FILES = 100
+MAX_TOTAL_SIZE = 4 * 1024 * 1024  # for the batch, decoded
+MAX_SIZE = min(5 * 1024 * 1024, MAX_TOTAL_SIZE)  # per file (5 MB for lambda_upload)
+
+
+def decoded_size(datastr):
+  """
+  Returns the number of bytes the base64 string decodes to,
+  without decoding it
+  """
+  if not isinstance(datastr, str):
+    return 0
+  return len(datastr) * 3 // 4 - (len(datastr) - len(datastr.rstrip("=")))
+
+
+def prepare(file):
+  """
+  Decodes and checks one file of the batch, returning (filename,
+  extension, raw bytes, metadata, perceptual hash); raises
+  ValueError if it cannot be uploaded
+  """
+  filename = file.get("filename")
+  datastr = file.get("data")
+
+  if not filename or datastr is None:
+    raise ValueError("file needs a filename and data")
+
+  extension = pathlib.Path(filename).suffix.lower()
+  if extension not in ['.jpg', '.jpeg', '.png']:
+    raise ValueError("Invalid file format. Only .jpg, .jpeg, .png are allowed")
+
+  if decoded_size(datastr) > MAX_SIZE:
+    raise ValueError(f"File size exceeds {MAX_SIZE // (1024 * 1024)} MB limit. "
+                     f"Actual size: {decoded_size(datastr)} bytes; upload it with /upload-url")
+
+  try:
+    data = base64.b64decode(datastr.encode(), validate=True)
+  except binascii.Error:
+    raise ValueError("data is not valid base64")
+
+  meta = imagemeta.probe(data)
+  phash = imagemeta.dhash(data)
+
+  return filename, extension, data, meta, phash
+
+
+def put_objects(s3_client, bucketname, objects, workers):
+  """
+  Puts the objects (a dictionary of bucketkey -> (bytes, format))
+  to S3 with at most workers uploads at a time; returns a
+  dictionary of bucketkey -> error message for the failures
+  """
+  def put(bucketkey, data, format):
+    s3_client.put_object(Bucket=bucketname, Key=bucketkey, Body=data,
+                         ACL='public-read', ContentType=imagemeta.content_type(format))
+
+  errors = {}
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = {pool.submit(put, key, data, format): key
+               for key, (data, format) in objects.items()}
+
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        future.result()
+      except Exception as err:
+        errors[futures[future]] = str(err)
+
+  return errors
+
+
+def discard_photos(tx, photos):
+  """
+  Removes photos added earlier in the transaction whose image
+  could not be put to S3, and their content references; photos
+  is a list of (photoid, bucketkey)
+  """
+  photoids = [photoid for photoid, bucketkey in photos]
+  placeholders = ", ".join(["%s"] * len(photoids))
+  tx.perform_action(f"DELETE FROM photos WHERE photoid IN ({placeholders});", photoids)
+
+  released = Counter(bucketkey for photoid, bucketkey in photos)
+  sql = "UPDATE content_objects SET refcount = refcount - %s WHERE bucketkey = %s"
+  tx.perform_bulk_action(sql, [[n, key] for key, n in released.items()])
+
+  placeholders = ", ".join(["%s"] * len(released))
+  sql = f"DELETE FROM content_objects WHERE refcount <= 0 AND bucketkey IN ({placeholders});"
+  tx.perform_action(sql, list(released))
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_upload_batch**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for S3 access:
+    #
+    bucketname = configur.get('s3', 'bucket_name')
+    workers = configur.getint('s3', 'upload_workers', fallback=8)
+
+    s3_client = runtime.get_client('s3')  # (clients are thread-safe)
+
+    #
+    # the queue for recognition, if recognition is queued rather
+    # than driven by S3 events (see jobqueue.py):
+    #
+    queue = jobqueue.get_queue(configur)
+
+    #
+    # configure for RDS access
+    #
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
+
+    #
+    # userid from event: could be a parameter
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    if "userid" in event:
+      userid = event["userid"]
+    elif "pathParameters" in event and "userid" in event["pathParameters"]:
+      userid = event["pathParameters"]["userid"]
+    else:
+      raise Exception("requires userid parameter in event or pathParameters")
+
+    print("userid:", userid)
+
+    print("**Accessing request body**")
+
+    if "body" not in event:
+      raise Exception("event has no body")
+
+    body = json.loads(event["body"])
+    files = body.get("files")
+
+    if not isinstance(files, list) or not files or len(files) > MAX_FILES or \
+       not all(isinstance(file, dict) for file in files):
+      return {
+        'statusCode': 400,
+        'body': json.dumps(f"'files' must be a list of 1 to {MAX_FILES} files")
+      }
+
+    #
+    # check the size of the batch before decoding any of it; a
+    # file over MAX_SIZE is not counted, as it gets an error of
+    # its own:
+    #
+    sizes = [decoded_size(file.get("data")) for file in files]
+    total_size = sum(size for size in sizes if size <= MAX_SIZE)
+
+    if total_size > MAX_TOTAL_SIZE:
+      return {
+        'statusCode': 413,
+        'body': json.dumps(f"Batch size exceeds {MAX_TOTAL_SIZE // (1024 * 1024)} MB limit. "
+                           f"Actual size: {total_size} bytes; send fewer files per "
+                           f"batch, and upload large files with /upload-url")
+      }
+
+    print("files:", len(files), "bytes:", total_size)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    #
+    # first we need to make sure the userid is valid (once, for
+    # the whole batch):
+    #
+    print("**Checking if userid is valid**")
+
+    sql = "SELECT * FROM users WHERE userid = %s;"
+
+    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+    if row == ():  # no such user
+      print("**No such user, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such user...")
+      }
+
+    bucketfolder = row[3]
+
+    #
+    # decode and probe each file:
+    #
+    print("**Probing files**")
+
+    results = [None] * len(files)
+    prepared = []  # (index, filename, bucketkey, data, meta, phash)
+
+    for i, file in enumerate(files):
+      try:
+        filename, extension, data, meta, phash = prepare(file)
+      except Exception as err:
+        results[i] = {"filename": file.get("filename"), "error": str(err)}
+        continue
+
+      bucketkey = uploads.new_bucketkey(bucketfolder, filename, extension)
+      prepared.append((i, filename, bucketkey, data, meta, phash))
+
+    #
+    # add every photos row, then put the new images to S3, as one
+    # unit of work, like lambda_upload: a row whose image fails
+    # to upload is taken out again before the commit.
+    #
+    print("**Adding", len(prepared), "photos rows to database**")
+
+    put_keys = []
+
+    try:
+      with datatier.transaction(dbConn) as tx:
+        stored = uploads.store_photos(tx, userid, [(filename, bucketkey, meta, phash)
+                                                   for i, filename, bucketkey, data, meta, phash in prepared])
+
+        objects = {}
+        for (i, filename, bucketkey, data, meta, phash), (photoid, stored_key, duplicate) \
+            in zip(prepared, stored):
+          if not duplicate:
+            objects[bucketkey] = (data, meta["format"])
+
+        print("**Uploading", len(objects), "files to S3**")
+
+        put_keys = list(objects)
+        errors = put_objects(s3_client, bucketname, objects, workers)
+
+        failed = []
+        for (i, filename, bucketkey, data, meta, phash), (photoid, stored_key, duplicate) \
+            in zip(prepared, stored):
+          if stored_key in errors:
+            results[i] = {"filename": filename, "error": errors[stored_key]}
+            failed.append((photoid, stored_key))
+          else:
+            results[i] = {"filename": filename, "photoid": photoid, "duplicate": duplicate}
+
+        if failed:
+          print("**Discarding", len(failed), "photos that failed to upload**")
+          discard_photos(tx, failed)
+
+        if queue is not None:
+          #
+          # one recognition job per new object, queued with the
+          # rows (a failure rolls the batch back)
+          #
+          failed_keys = {stored_key for photoid, stored_key in failed}
+          queue.send([{"type": "recognize", "bucketkey": key}
+                      for key in put_keys if key not in failed_keys])
+    except Exception:
+      #
+      # the rows are rolled back, so the images put to S3 must go
+      #
+      if put_keys:
+        s3_client.delete_objects(Bucket=bucketname,
+                                 Delete={"Objects": [{"Key": key} for key in put_keys], "Quiet": True})
+      raise
+
+    uploaded = sum(1 for result in results if "photoid" in result)
+
+    print("**DONE,", uploaded, "of", len(files), "uploaded**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"uploaded": uploaded, "results": results})
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
@@ -0,0 +1,371 @@
+#
+# uploads.py
+#
+# Storing an uploaded photo in the database, shared by the ways
+# a photo gets uploaded: lambda_upload (the image in the
+# request body), and the presigned PUT flow, where the client
+# sends the image straight to S3 and lambda_upload_finalize (or
+# lambda_recognition, on the S3 event, whichever comes first)
+# then records it. In both cases the photo's content is looked
+# up by hash first, so that identical uploads share one S3
+# object and its labels.
+#
+
+import base64
+import hashindex
+import imagemeta
+import pathlib
+import uuid
+
+
+###################################################################
+#
+# claim_content:
+#
+# Takes a reference to the S3 object holding the content with
+# the given SHA-256, registering bucketkey as that object if
+# the content is new. Returns the bucketkey the photo should
+# use: the given one if the content is new (and so must be
+# uploaded), else the key of the existing object. The upsert
+# locks the content_objects row until the transaction ends, so
+# concurrent uploads of the same content are serialized.
+#
+def claim_content(tx, sha256, bucketkey):
+  sql = """
+    INSERT INTO content_objects (sha256, bucketkey, refcount) VALUES (%s, %s, 1)
+    ON DUPLICATE KEY UPDATE refcount = refcount + 1;
+  """
+  tx.perform_action(sql, [sha256, bucketkey])
+
+  sql = "SELECT bucketkey FROM content_objects WHERE sha256 = %s;"
+  row = tx.retrieve_one_row(sql, [sha256])
+
+  return row[0]
+
+
+###################################################################
+#
+# copy_labels:
+#
+# Gives a new photo the labels recognition already stored for
+# another photo of the same S3 object, instead of running
+# recognition again; the user's label counts go up to match.
+# If no photo of the object has labels yet (its recognition is
+# still running), there is nothing to copy: lambda_recognition
+# labels every photo of the object when it finishes. Returns
+# the number of labels copied.
+#
+def copy_labels(tx, photoid, userid, bucketkey):
+  #
+  # (INSERT ... SELECT reads the latest committed labels, with
+  # shared locks, not this transaction's snapshot)
+  #
+  sql = """
+    SELECT p.photoid FROM photos p
+     WHERE p.bucketkey = %s AND p.photoid <> %s
+       AND EXISTS (SELECT 1 FROM photo_labels pl WHERE pl.photoid = p.photoid)
+     LIMIT 1
+     LOCK IN SHARE MODE;
+  """
+  row = tx.retrieve_one_row(sql, [bucketkey, photoid])
+  if row == ():
+    return 0
+
+  sourceid = row[0]
+
+  sql = """
+    INSERT INTO photo_labels (photoid, labelid, userid, confidence)
+      SELECT %s, labelid, %s, confidence FROM photo_labels WHERE photoid = %s;
+  """
+  copied = tx.perform_action(sql, [photoid, userid, sourceid])
+
+  sql = """
+    INSERT INTO label_counts (userid, labelid, photo_count)
+      SELECT %s, labelid, 1 FROM photo_labels WHERE photoid = %s
+    ON DUPLICATE KEY UPDATE photo_count = photo_count + 1;
+  """
+  tx.perform_action(sql, [userid, photoid])
+
+  sql = """
+    INSERT INTO label_instances
+      (photoid, labelid, confidence, box_left, box_top, box_width, box_height)
+      SELECT %s, labelid, confidence, box_left, box_top, box_width, box_height
+        FROM label_instances WHERE photoid = %s;
+  """
+  tx.perform_action(sql, [photoid, sourceid])
+
+  return copied
+
+
+###################################################################
+#
+# check_reservation:
+#
+# Validates a client's request to reserve an upload (presigned
+# or multipart): the file name and its extension, the declared
+# size, at most max_upload_mb, and the optional SHA-256 (64 hex
+# digits). Returns the extension, lowercased; raises ValueError
+# with the reason otherwise.
+#
+CONTENT_TYPES = {extension: format["content_type"]
+                 for format in imagemeta.FORMATS.values()
+                 for extension in format["extensions"]}
+
+
+def check_reservation(filename, bytesize, sha256, max_upload_mb):
+  if not isinstance(filename, str) or not filename:
+    raise ValueError("event has a body but no filename")
+
+  extension = pathlib.Path(filename).suffix.lower()
+
+  if extension not in CONTENT_TYPES:
+    raise ValueError("Invalid file format. Only .jpg, .jpeg, .png are allowed")
+  if not isinstance(bytesize, int) or isinstance(bytesize, bool) or bytesize <= 0:
+    raise ValueError("bytesize must be a positive number")
+  if bytesize > max_upload_mb * 1024 * 1024:
+    raise ValueError(f"File size exceeds {max_upload_mb} MB limit. Actual size: {bytesize} bytes")
+  if sha256 is not None and (not isinstance(sha256, str) or len(sha256) != 64 or
+                             any(c not in "0123456789abcdef" for c in sha256.lower())):
+    raise ValueError("sha256 must be 64 hex digits")
+
+  return extension
+
+
+###################################################################
+#
+# new_bucketkey:
+#
+# Returns a new, unique S3 key for a file uploaded by a user,
+# in the user's folder and keeping the file's name.
+#
+def new_bucketkey(bucketfolder, filename, extension):
+  basename = pathlib.Path(filename).stem
+  return f"pixeltailor/{bucketfolder}/{basename}-{uuid.uuid4()}{extension}"
+
+
+###################################################################
+#
+# store_photo:
+#
+# Adds the photos row for an upload of the image with the given
+# metadata (from imagemeta.probe) and perceptual hash, stored
+# at bucketkey. If the same content is already stored, the
+# photo shares that object and copies its labels instead.
+# Returns (photoid, the bucketkey the photo uses, True if the
+# content was a duplicate); when it was, the caller must not
+# keep the object at bucketkey.
+#
+PHOTO_INSERT = """
+  INSERT INTO photos(userid, original_name, bucketkey,
+                     width, height, format, bytesize, mode, sha256,
+                     phash, phash_0, phash_1, phash_2, phash_3)
+              VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s,
+                     %s, %s, %s, %s, %s);
+"""
+
+
+def photo_row(userid, filename, bucketkey, meta, phash):
+  """
+  Returns the parameters of PHOTO_INSERT for a photo; phash may
+  be None, if not computed yet
+  """
+  chunks = hashindex.split(phash) if phash is not None else [None] * hashindex.CHUNKS
+  return [userid, filename, bucketkey,
+          meta["width"], meta["height"], meta["format"],
+          meta["bytesize"], meta["mode"], meta["sha256"],
+          phash] + chunks
+
+
+def store_photo(tx, userid, filename, bucketkey, meta, phash):
+  stored_key = claim_content(tx, meta["sha256"], bucketkey)
+  duplicate = (stored_key != bucketkey)
+
+  if duplicate:
+    print("**Content already stored as", stored_key, "**")
+
+  #
+  # the photoid auto-generated by mysql comes back with
+  # the INSERT itself:
+  #
+  photoid = tx.insert(PHOTO_INSERT, photo_row(userid, filename, stored_key, meta, phash))
+
+  print("photoid:", photoid)
+
+  if duplicate:
+    print("**Copying labels**")
+    copied = copy_labels(tx, photoid, userid, stored_key)
+    print("labels copied:", copied)
+
+  return photoid, stored_key, duplicate
+
+
+###################################################################
+#
+# store_photos:
+#
+# Like store_photo, for many uploads of one user at once: the
+# content references are taken with one multi-row upsert and
+# the photos rows added with one multi-row INSERT. items is a
+# list of (filename, bucketkey, meta, phash); returns a list of
+# (photoid, bucketkey used, duplicate) in the same order. Two
+# uploads of the same content in the batch share the object of
+# the first (the second is a duplicate).
+#
+def store_photos(tx, userid, items):
+  if not items:
+    return []
+
+  sql = """
+    INSERT INTO content_objects (sha256, bucketkey, refcount) VALUES (%s, %s, 1)
+    ON DUPLICATE KEY UPDATE refcount = refcount + 1;
+  """
+  tx.perform_bulk_action(sql, [[meta["sha256"], bucketkey]
+                               for filename, bucketkey, meta, phash in items])
+
+  hashes = list(dict.fromkeys(meta["sha256"] for filename, bucketkey, meta, phash in items))
+  placeholders = ", ".join(["%s"] * len(hashes))
+  sql = f"SELECT sha256, bucketkey FROM content_objects WHERE sha256 IN ({placeholders});"
+  stored = {row[0]: row[1] for row in tx.retrieve_all_rows(sql, hashes)}
+
+  rows = [photo_row(userid, filename, stored[meta["sha256"]], meta, phash)
+          for filename, bucketkey, meta, phash in items]
+
+  #
+  # the ids of a multi-row INSERT come back with it, in row
+  # order (see datatier.perform_bulk_action):
+  #
+  modified, photoids = tx.perform_bulk_action(PHOTO_INSERT, rows)
+
+  results = []
+  for (filename, bucketkey, meta, phash), photoid in zip(items, photoids):
+    stored_key = stored[meta["sha256"]]
+    duplicate = (stored_key != bucketkey)
+
+    if duplicate:
+      copy_labels(tx, photoid, userid, stored_key)
+
+    results.append((photoid, stored_key, duplicate))
+
+  return results
+
+
+###################################################################
+#
+# pending_upload:
+#
+# Returns the pending_uploads row (uploadid, userid,
+# original_name, bucketkey, bytesize, sha256, photoid, expired)
+# for the upload id, or for the bucketkey, locked until the
+# transaction ends; () if there is none. expired is 1 once the
+# reservation's expires_in has passed (the PUT can no longer
+# succeed), else 0, or None if it has no expiry.
+#
+PENDING_COLUMNS = ("uploadid, userid, original_name, bucketkey, bytesize, sha256, photoid, "
+                   "created_at + INTERVAL expires_in SECOND < NOW()")
+
+
+def pending_upload(tx, uploadid=None, bucketkey=None):
+  if uploadid is not None:
+    sql = f"SELECT {PENDING_COLUMNS} FROM pending_uploads WHERE uploadid = %s FOR UPDATE;"
+    return tx.retrieve_one_row(sql, [uploadid])
+
+  sql = f"SELECT {PENDING_COLUMNS} FROM pending_uploads WHERE bucketkey = %s FOR UPDATE;"
+  return tx.retrieve_one_row(sql, [bucketkey])
+
+
+###################################################################
+#
+# read_upload:
+#
+# Reads what finalize needs to know about an uploaded object,
+# without holding any lock (call it before locking the pending
+# row). When the client declared a SHA-256, S3 verified the PUT
+# against it and reports it back (ChecksumSHA256), so only the
+# first HEADER_BYTES are fetched, for the image header; the
+# perceptual hash, which needs the whole image, is then left for
+# backfill_photo_metadata.py. Otherwise (no checksum, or a
+# multipart upload's checksum of part checksums) the object is
+# read in full. Returns (meta, phash or None, the content or
+# None if not read in full); raises ValueError if the object
+# is not an acceptable image.
+#
+HEADER_BYTES = 64 * 1024
+
+
+def read_upload(s3_client, bucketname, bucketkey):
+  response = s3_client.head_object(Bucket=bucketname, Key=bucketkey, ChecksumMode='ENABLED')
+  bytesize = response['ContentLength']
+  checksum = response.get('ChecksumSHA256')
+
+  full_object = (checksum is not None and "-" not in checksum and
+                 response.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT')
+
+  if full_object and bytesize > HEADER_BYTES:
+    response = s3_client.get_object(Bucket=bucketname, Key=bucketkey,
+                                    Range=f"bytes=0-{HEADER_BYTES - 1}")
+    header = response['Body'].read()
+
+    try:
+      meta = imagemeta.probe(header)
+    except Exception:
+      #
+      # not an image, or its header runs past HEADER_BYTES (e.g.
+      # a large EXIF block): decide on the whole object below
+      #
+      meta = None
+
+    if meta is not None:
+      meta["bytesize"] = bytesize
+      meta["sha256"] = base64.b64decode(checksum).hex()
+      return meta, None, None
+
+  response = s3_client.get_object(Bucket=bucketname, Key=bucketkey)
+  data = response['Body'].read()
+
+  return imagemeta.probe(data), imagemeta.dhash(data), data
+
+
+###################################################################
+#
+# discard_pending:
+#
+# Deletes a reservation that can never be finalized (its object
+# was rejected, or never arrived before the reservation
+# expired), unless it has been finalized meanwhile.
+#
+def discard_pending(tx, uploadid):
+  sql = "DELETE FROM pending_uploads WHERE uploadid = %s AND photoid IS NULL;"
+  tx.perform_action(sql, [uploadid])
+
+
+###################################################################
+#
+# finalize:
+#
+# Records a presigned upload whose object has arrived in S3:
+# checks the image's metadata (from read_upload) against what
+# the client declared when reserving it, stores the photo, and
+# marks the reservation done. pending must have been locked by
+# pending_upload in this transaction. Returns (photoid,
+# duplicate); if the content was already stored, the photo
+# shares the existing object, and the caller should delete the
+# newly uploaded one once the transaction has committed. Raises
+# ValueError if the object does not match the reservation.
+#
+def finalize(tx, pending, meta, phash):
+  uploadid, userid, filename, bucketkey, bytesize, sha256, photoid, expired = pending
+
+  if photoid is not None:  # already finalized
+    return photoid, False
+
+  if bytesize is not None and meta["bytesize"] != bytesize:
+    raise ValueError(f"uploaded {meta['bytesize']} bytes, expected {bytesize}")
+  if sha256 is not None and meta["sha256"] != sha256:
+    raise ValueError("uploaded content does not match the declared sha256")
+
+  photoid, stored_key, duplicate = store_photo(tx, userid, filename, bucketkey, meta, phash)
+
+  sql = "UPDATE pending_uploads SET photoid = %s WHERE uploadid = %s;"
+  tx.perform_action(sql, [photoid, uploadid])
+
+  return photoid, duplicate
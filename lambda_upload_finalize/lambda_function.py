@@ -0,0 +1,192 @@
+#
+# Confirms a presigned upload (see lambda_upload_url): once the
+# client has PUT the image to S3, records it as a photo in the
+# PixelTailor database. Safe to call again, and a no-op if
+# lambda_recognition has already recorded the photo from the S3
+# event.
+#
+
+import json
+import datatier
+import jobqueue
+import runtime
+import uploads
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_upload_finalize**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for S3 access:
+    #
+    bucketname = configur.get('s3', 'bucket_name')
+
+    s3_client = runtime.get_client('s3')
+
+    #
+    # the queue for recognition, if recognition is queued rather
+    # than driven by S3 events (see jobqueue.py):
+    #
+    queue = jobqueue.get_queue(configur)
+
+    #
+    # configure for RDS access
+    #
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
+
+    #
+    # userid and uploadid from event: could be parameters
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    params = event.get("pathParameters") or event
+
+    if "userid" not in params or "uploadid" not in params:
+      raise Exception("requires userid and uploadid parameters in event")
+
+    userid = int(params["userid"])
+    uploadid = int(params["uploadid"])
+
+    print("userid:", userid, "uploadid:", uploadid)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    #
+    # look the reservation up (without locking it yet):
+    #
+    sql = f"SELECT {uploads.PENDING_COLUMNS} FROM pending_uploads WHERE uploadid = %s;"
+    pending = datatier.retrieve_one_row(dbConn, sql, [uploadid])
+
+    if pending == () or pending[1] != userid:
+      print("**No such upload, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such upload...")
+      }
+
+    bucketkey = pending[3]
+    meta = phash = None
+
+    if pending[6] is None:
+      #
+      # read what we need of the object before taking the lock,
+      # so the lock is never held while S3 is read (usually just
+      # the checksum S3 verified and the image header):
+      #
+      print("**Reading uploaded object**")
+      try:
+        meta, phash, data = uploads.read_upload(s3_client, bucketname, bucketkey)
+      except s3_client.exceptions.ClientError as err:
+        if err.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+          raise
+        if pending[7]:
+          #
+          # the presigned URL has expired, so the object can
+          # never arrive now: the reservation goes
+          #
+          print("**Reservation expired, discarding...**")
+          with datatier.transaction(dbConn) as tx:
+            uploads.discard_pending(tx, uploadid)
+          return {
+            'statusCode': 400,
+            'body': json.dumps("upload reservation expired, reserve it again...")
+          }
+        print("**Object not uploaded yet, returning...**")
+        return {
+          'statusCode': 400,
+          'body': json.dumps("upload not received yet...")
+        }
+      except ValueError as err:
+        #
+        # not an image we accept: drop the object, and the
+        # reservation, which can never be finalized now
+        #
+        print("**Rejected upload:", str(err), "**")
+        s3_client.delete_object(Bucket=bucketname, Key=bucketkey)
+        with datatier.transaction(dbConn) as tx:
+          uploads.discard_pending(tx, uploadid)
+        return {
+          'statusCode': 400,
+          'body': json.dumps(str(err))
+        }
+
+    #
+    # record the photo, with the reservation locked so that a
+    # concurrent finalize (or the S3 event) waits and then finds
+    # it done; it may have been finalized since we looked:
+    #
+    try:
+      with datatier.transaction(dbConn) as tx:
+        pending = uploads.pending_upload(tx, uploadid=uploadid)
+
+        if pending[6] is None:
+          photoid, duplicate = uploads.finalize(tx, pending, meta, phash)
+
+          if queue is not None and not duplicate:
+            #
+            # queued with the photo, so that failing to queue it
+            # fails the finalize (which the client can retry)
+            #
+            queue.send([{"type": "recognize", "bucketkey": bucketkey}])
+        else:
+          photoid, duplicate = pending[6], False
+    except ValueError as err:
+      #
+      # not what the client reserved: drop the object and the
+      # reservation, as above
+      #
+      print("**Rejected upload:", str(err), "**")
+      s3_client.delete_object(Bucket=bucketname, Key=bucketkey)
+      with datatier.transaction(dbConn) as tx:
+        uploads.discard_pending(tx, uploadid)
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
+
+    #
+    # identical content was already stored: the photo uses that
+    # object, so the copy just uploaded is not needed
+    #
+    if duplicate:
+      print("**Deleting duplicate object", bucketkey, "**")
+      s3_client.delete_object(Bucket=bucketname, Key=bucketkey)
+
+    print("**DONE**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"message": "Photo uploaded successfully.", "photoid": photoid,
+                          "duplicate": duplicate})
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
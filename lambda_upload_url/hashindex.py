@@ -0,0 +1,68 @@
+#
+# hashindex.py
+#
+# Multi-index hashing for finding near-duplicate photos by
+# perceptual hash. A 64-bit hash is split into CHUNKS 16-bit
+# chunks, each stored in its own indexed column. If two hashes
+# differ in at most d bits, then (pigeonhole) at least one of
+# their chunks differs in at most d // CHUNKS bits. So the
+# photos within distance d of a hash are found by looking up,
+# in each chunk's index, the few chunk values within that
+# radius of the hash's chunk, and checking the exact distance
+# of just those candidates, instead of comparing the hash with
+# every photo.
+#
+
+import itertools
+
+BITS = 64
+CHUNKS = 4
+CHUNK_BITS = BITS // CHUNKS
+
+#
+# the largest distance searched: a radius of 3 bits per chunk,
+# i.e. 697 probe values per chunk
+#
+MAX_DISTANCE = 12
+
+
+def split(phash):
+  """
+  Returns the CHUNKS chunks of a hash, most significant first
+  """
+  mask = (1 << CHUNK_BITS) - 1
+  return [(phash >> (CHUNK_BITS * (CHUNKS - 1 - i))) & mask for i in range(CHUNKS)]
+
+
+def within(value, radius):
+  """
+  Returns every chunk value within Hamming distance radius of
+  value (including value itself)
+  """
+  values = []
+  for r in range(radius + 1):
+    for bits in itertools.combinations(range(CHUNK_BITS), r):
+      flipped = value
+      for bit in bits:
+        flipped ^= 1 << bit
+      values.append(flipped)
+  return values
+
+
+def probes(phash, max_distance):
+  """
+  Returns, for each chunk, the list of chunk values to look up
+  to find every hash within max_distance of phash
+  """
+  if not 0 <= max_distance <= MAX_DISTANCE:
+    raise ValueError(f"max_distance must be between 0 and {MAX_DISTANCE}")
+
+  radius = max_distance // CHUNKS
+  return [within(chunk, radius) for chunk in split(phash)]
+
+
+def distance(a, b):
+  """
+  Returns the Hamming distance between two hashes
+  """
+  return bin(a ^ b).count("1")
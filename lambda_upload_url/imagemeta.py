@@ -0,0 +1,117 @@
+#
+# imagemeta.py
+#
+# Probes an uploaded image for the metadata stored alongside it
+# in the photos table: pixel dimensions, format, mode, size in
+# bytes and a SHA-256 of the content. Pillow's Image.open only
+# parses the header, so the pixel data is never decoded; the
+# other lambdas can then answer questions about an image (its
+# format, whether a crop fits) from the database, without
+# fetching the object from S3.
+#
+# dhash computes a perceptual hash of the image, used to find
+# near-duplicates (see hashindex.py); unlike probe, it has to
+# decode the image, but only at a reduced scale where possible.
+#
+
+import hashlib
+import io
+import numpy
+
+from PIL import Image, UnidentifiedImageError
+
+
+#
+# formats we accept, as reported by Pillow, and the matching
+# file extensions / content types:
+#
+FORMATS = {
+  "JPEG": {"extensions": [".jpg", ".jpeg"], "content_type": "image/jpeg"},
+  "PNG":  {"extensions": [".png"], "content_type": "image/png"},
+}
+
+
+###################################################################
+#
+# probe:
+#
+# Returns a dict with width, height, format, mode, bytesize and
+# sha256 for the image in data (bytes). Raises ValueError if
+# the data is not an image in one of the accepted FORMATS.
+#
+def probe(data):
+  """
+  Returns the metadata of an image, reading only its header
+
+  Parameters
+  ----------
+  data : raw image content (bytes)
+
+  Returns
+  -------
+  dict with keys width, height, format, mode, bytesize, sha256;
+  raises ValueError if data is not a JPEG or PNG image
+  """
+  try:
+    with Image.open(io.BytesIO(data)) as img:
+      width, height = img.size
+      format = img.format
+      mode = img.mode
+  except UnidentifiedImageError:
+    raise ValueError("file is not a recognized image")
+
+  if format not in FORMATS:
+    raise ValueError(f"unsupported image format {format}, only JPEG and PNG are allowed")
+
+  return {
+    "width": width,
+    "height": height,
+    "format": format,
+    "mode": mode,
+    "bytesize": len(data),
+    "sha256": hashlib.sha256(data).hexdigest(),
+  }
+
+
+def content_type(format):
+  """
+  Returns the MIME content type for a format from probe()
+  """
+  return FORMATS[format]["content_type"]
+
+
+###################################################################
+#
+# dhash:
+#
+# Returns the 64-bit difference hash of the image in data: the
+# image is reduced to 9x8 grayscale pixels, and each bit says
+# whether a pixel is brighter than its right-hand neighbour.
+# Re-encoding, resizing or mild recompression of an image
+# changes few (if any) bits, so near-identical images have
+# hashes a small Hamming distance apart.
+#
+def dhash(data):
+  """
+  Returns the perceptual (difference) hash of an image
+
+  Parameters
+  ----------
+  data : raw image content (bytes)
+
+  Returns
+  -------
+  64-bit hash (integer)
+  """
+  with Image.open(io.BytesIO(data)) as img:
+    #
+    # JPEGs can be decoded at 1/2 - 1/8 scale, far faster than
+    # a full decode; other formats ignore this:
+    #
+    img.draft("L", (64, 64))
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+
+  pixels = numpy.asarray(small, dtype=numpy.int16)
+  bits = pixels[:, 1:] > pixels[:, :-1]
+
+  return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(), "big")
@@ -0,0 +1,238 @@
+#
+# Reserves an upload of a photo to S3 in the PixelTailor
+# database, and returns a presigned URL the client PUTs the
+# image to directly, instead of sending it through API Gateway
+# and Lambda. The upload is then confirmed by
+# lambda_upload_finalize (or by lambda_recognition, when the S3
+# event for the new object arrives first).
+#
+# The body reserves one file, {"filename", "bytesize", "sha256"},
+# or up to MAX_FILES at once, {"files": [{...}, ...]}; the batch
+# is checked against the user once and its pending_uploads rows
+# added with one multi-row INSERT, and the response then has a
+# reservation (or error) per file, in order. A reservation
+# expires with its presigned URL ([s3] presign_expires).
+#
+
+import base64
+import json
+import datatier
+import runtime
+import uploads
+
+MAX_FILES = 100
+
+
+def presign(s3_client, bucketname, bucketkey, extension, bytesize, sha256, expires_in):
+  """
+  Presigns the PUT of a reserved upload, returning (url,
+  headers); the signature covers the headers, so S3 rejects a
+  PUT with a different type, length or (if declared) checksum
+  """
+  params = {
+    'Bucket': bucketname,
+    'Key': bucketkey,
+    'ContentType': uploads.CONTENT_TYPES[extension],
+    'ContentLength': bytesize,
+    'ACL': 'public-read'
+  }
+  headers = {
+    'Content-Type': uploads.CONTENT_TYPES[extension],
+    'x-amz-acl': 'public-read'
+  }
+
+  if sha256:
+    checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+    params['ChecksumSHA256'] = checksum
+    headers['x-amz-checksum-sha256'] = checksum
+
+  url = s3_client.generate_presigned_url('put_object', Params=params, ExpiresIn=expires_in)
+  return url, headers
+
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final_upload_url**")
+    datatier.reset_query_stats()
+
+    #
+    # setup AWS based on config file:
+    # (cached across warm invocations, re-read if the file changes)
+    #
+    configur = runtime.get_config()
+
+    #
+    # configure for S3 access:
+    #
+    bucketname = configur.get('s3', 'bucket_name')
+    max_upload_mb = configur.getint('s3', 'max_upload_mb', fallback=50)
+    expires_in = configur.getint('s3', 'presign_expires', fallback=900)  # seconds
+
+    s3_client = runtime.get_client('s3')
+
+    #
+    # configure for RDS access
+    #
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur)
+
+    #
+    # userid from event: could be a parameter
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    if "userid" in event:
+      userid = event["userid"]
+    elif "pathParameters" in event and "userid" in event["pathParameters"]:
+      userid = event["pathParameters"]["userid"]
+    else:
+      raise Exception("requires userid parameter in event or pathParameters")
+
+    print("userid:", userid)
+
+    #
+    # the body names each file and declares its size, and
+    # optionally its SHA-256 (hex), which S3 then verifies:
+    #
+    print("**Accessing request body**")
+
+    if "body" not in event:
+      raise Exception("event has no body")
+
+    body = json.loads(event["body"])
+
+    if "files" in body:
+      files = body["files"]
+      if not isinstance(files, list) or not files or len(files) > MAX_FILES or \
+         not all(isinstance(file, dict) for file in files):
+        return {
+          'statusCode': 400,
+          'body': json.dumps(f"'files' must be a list of 1 to {MAX_FILES} files")
+        }
+    else:
+      files = [body]
+
+    #
+    # check each file; in a batch, a bad file gets an error of
+    # its own instead of failing the rest:
+    #
+    results = [None] * len(files)
+    accepted = []  # (index, filename, extension, bytesize, sha256)
+
+    for i, file in enumerate(files):
+      filename = file.get("filename")
+      bytesize = file.get("bytesize")
+      sha256 = file.get("sha256")
+
+      try:
+        extension = uploads.check_reservation(filename, bytesize, sha256, max_upload_mb)
+      except ValueError as err:
+        if "files" not in body:
+          return {
+            'statusCode': 400,
+            'body': json.dumps(str(err))
+          }
+        results[i] = {"filename": filename, "error": str(err)}
+        continue
+
+      accepted.append((i, filename, extension, bytesize, sha256.lower() if sha256 else None))
+
+    print("files:", len(files), "accepted:", len(accepted))
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    #
+    # first we need to make sure the userid is valid:
+    #
+    print("**Checking if userid is valid**")
+
+    sql = "SELECT * FROM users WHERE userid = %s;"
+
+    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+    if row == ():  # no such user
+      print("**No such user, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such user...")
+      }
+
+    bucketfolder = row[3]
+
+    #
+    # reserve each upload under a new, unique bucketkey, with one
+    # multi-row INSERT:
+    #
+    bucketkeys = [uploads.new_bucketkey(bucketfolder, filename, extension)
+                  for i, filename, extension, bytesize, sha256 in accepted]
+
+    sql = """
+      INSERT INTO pending_uploads(userid, original_name, bucketkey, bytesize, sha256,
+                                  expires_in)
+                  VALUES(%s, %s, %s, %s, %s, %s);
+    """
+
+    uploadids = []
+    if accepted:
+      with datatier.transaction(dbConn) as tx:
+        modified, uploadids = tx.perform_bulk_action(
+          sql, [[userid, filename, bucketkey, bytesize, sha256, expires_in]
+                for (i, filename, extension, bytesize, sha256), bucketkey
+                in zip(accepted, bucketkeys)])
+
+    print("uploadids:", uploadids)
+
+    #
+    # presign the PUTs (locally, no call to S3 per file):
+    #
+    print("**Presigning PUTs**")
+
+    for (i, filename, extension, bytesize, sha256), bucketkey, uploadid \
+        in zip(accepted, bucketkeys, uploadids):
+      url, headers = presign(s3_client, bucketname, bucketkey, extension, bytesize,
+                             sha256, expires_in)
+      results[i] = {
+        "filename": filename,
+        "uploadid": uploadid,
+        "url": url,
+        "method": "PUT",
+        "headers": headers,
+        "expires_in": expires_in
+      }
+
+    print("**DONE**")
+
+    if "files" not in body:
+      reservation = results[0]
+      del reservation["filename"]
+      return {
+        'statusCode': 200,
+        'body': json.dumps(reservation)
+      }
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"reserved": len(accepted), "results": results})
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
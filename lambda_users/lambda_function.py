@@ -4,43 +4,51 @@
 #
 
 import json
-import boto3
-import os
 import datatier
+import runtime
+import paging
 
-from configparser import ConfigParser
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: final_users**")
+    datatier.reset_query_stats()
     
     #
     # setup AWS based on config file:
     #
     #TODO: config file needed
     #
-    config_file = 'final-project-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    # (cached across warm invocations, re-read if the file changes)
+    configur = runtime.get_config()
     
     #
     # configure for RDS access
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # (SELECT-only, so routed to the read-only endpoint)
+    rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname = \
+      datatier.rds_settings(configur, readonly=True)
+
+    #
+    # which page? (limit and after from the query string)
+    #
+    try:
+      limit, after = paging.page_params(event)
+    except ValueError as err:
+      return {
+        'statusCode': 400,
+        'body': json.dumps(str(err))
+      }
 
     #
     # open connection to the database:
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.get_pooled_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
     #
     # now retrieve all the users:
@@ -48,28 +56,30 @@ def lambda_handler(event, context):
     print("**Retrieving data**")
 
     #
-    # select all users' info from the 
-    # users table, ordered by userid
+    # select one page of users' info from the users
+    # table, ordered by userid, starting after the
+    # last userid of the previous page
     #
-    sql = "SELECT * FROM users ORDER BY userid"
+    sql = "SELECT * FROM users WHERE userid > %s ORDER BY userid LIMIT %s"
     
-    rows = datatier.retrieve_all_rows(dbConn, sql)
+    rows = datatier.stream_rows(dbConn, sql, [after or 0, limit + 1])
     
-    if rows == ():
-      print("**No users...**")
+    page = paging.Page(rows, limit, key=lambda row: row[0])
+
+    body = paging.json_body("".join(datatier.stream_json_array(page)), page)
 
-    for row in rows:
-      print(row)
+    if page.count == 0:
+      print("**No users...**")
 
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE, returning rows**")
+    print("**DONE, returning", page.count, "rows**")
     
     return {
       'statusCode': 200,
-      'body': json.dumps(rows)
+      'body': body
     }
     
   except Exception as err:
@@ -80,3 +90,7 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    datatier.release_dbConn(dbConn)
+    datatier.log_query_summary()
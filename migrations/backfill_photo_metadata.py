@@ -0,0 +1,131 @@
+#
+# backfill_photo_metadata.py
+#
+# Fills in the image metadata columns added by migration 6
+# (width, height, format, bytesize, mode, sha256) and the
+# perceptual hash added by migration 8 (phash, phash_0 ..
+# phash_3) for photos uploaded before lambda_upload recorded
+# them. Each such photo is read from S3 once and probed with
+# imagemeta.probe and imagemeta.dhash, the same as at upload.
+# Photos that cannot be read or are not JPEG / PNG images are
+# reported and left as they are.
+#
+# Photos finalized from a presigned upload with a declared
+# SHA-256 have their metadata but no perceptual hash (see
+# uploads.read_upload); running this regularly fills it in.
+#
+# Each photo's object is also registered in content_objects
+# (migration 7), unless an object with the same content is
+# already there, so later uploads of the same image reuse it.
+#
+# Usage:
+#   python backfill_photo_metadata.py [config_file] [--batch=N]
+#
+# The config file needs the [rds] and [s3] sections and the
+# [s3readwrite] credentials, as in the lambdas' config file.
+#
+
+import boto3
+import datatier
+import hashindex
+import imagemeta
+import migrate
+import os
+import sys
+
+from configparser import ConfigParser
+
+
+def photos_without_metadata(dbConn, after, batch):
+  """
+  Returns (photoid, bucketkey) of the next batch of photos
+  without metadata, in photoid order, after the given photoid
+  """
+  sql = """
+    SELECT photoid, bucketkey FROM photos
+     WHERE (sha256 IS NULL OR phash IS NULL) AND photoid > %s
+     ORDER BY photoid
+     LIMIT %s;
+  """
+  return datatier.retrieve_all_rows(dbConn, sql, [after, batch])
+
+
+def backfill(dbConn, s3, bucketname, batch=100):
+  """
+  Probes every photo without metadata and stores the result;
+  returns (# updated, # failed)
+  """
+  sql = """
+    UPDATE photos
+       SET width = %s, height = %s, format = %s, bytesize = %s, mode = %s, sha256 = %s,
+           phash = %s, phash_0 = %s, phash_1 = %s, phash_2 = %s, phash_3 = %s
+     WHERE photoid = %s;
+  """
+
+  register_sql = """
+    INSERT IGNORE INTO content_objects (sha256, bucketkey, refcount)
+      VALUES (%s, %s, 1)
+  """
+
+  updated = 0
+  failed = 0
+  after = 0
+
+  while True:
+    rows = photos_without_metadata(dbConn, after, batch)
+    if not rows:
+      break
+
+    updates = []
+    objects = []
+    for photoid, bucketkey in rows:
+      try:
+        response = s3.get_object(Bucket=bucketname, Key=bucketkey)
+        data = response["Body"].read()
+        meta = imagemeta.probe(data)
+        phash = imagemeta.dhash(data)
+      except Exception as err:
+        print(f"photo {photoid} ({bucketkey}): {err}")
+        failed += 1
+        continue
+
+      updates.append([meta["width"], meta["height"], meta["format"],
+                      meta["bytesize"], meta["mode"], meta["sha256"],
+                      phash] + hashindex.split(phash) + [photoid])
+      objects.append([meta["sha256"], bucketkey])
+
+    with datatier.transaction(dbConn) as tx:
+      tx.perform_bulk_action(sql, updates)
+      tx.perform_bulk_action(register_sql, objects)
+    updated += len(updates)
+    after = rows[-1][0]
+    print(f"** {updated} photo(s) updated, up to photoid {after} **")
+
+  return updated, failed
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  config_file = args[0] if args else "final-project-config.ini"
+
+  batch = 100
+  for arg in sys.argv[1:]:
+    if arg.startswith("--batch="):
+      batch = int(arg[len("--batch="):])
+
+  configur = ConfigParser()
+  configur.read(config_file)
+  bucketname = configur.get("s3", "bucket_name")
+
+  os.environ["AWS_SHARED_CREDENTIALS_FILE"] = config_file
+  s3 = boto3.Session(profile_name="s3readwrite").client("s3")
+
+  dbConn = migrate.connect(config_file)
+  try:
+    updated, failed = backfill(dbConn, s3, bucketname, batch)
+  finally:
+    dbConn.close()
+
+  print(f"** {updated} updated, {failed} failed **")
+  if failed:
+    sys.exit(1)
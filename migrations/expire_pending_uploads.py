@@ -0,0 +1,139 @@
+#
+# expire_pending_uploads.py
+#
+# Clears out reservations in pending_uploads (see migrations 9,
+# 10 and 12) that expired without being finalized: the client
+# never PUT the object, or never finalized it and no S3 event
+# did either. Each such reservation is deleted, and then its
+# object (if any) deleted from S3 and its multipart upload (if
+# any) aborted. Only reservations expired for longer than the
+# grace period are touched, so an upload the S3 event is
+# finalizing right now is left alone; a reservation finalized
+# meanwhile is skipped. Run it regularly, e.g. daily.
+#
+# Usage:
+#   python expire_pending_uploads.py [config_file] [--grace-hours=N] [--batch=N]
+#                                    [--check-only]
+#
+#   --grace-hours=N  hours past expiry before a reservation is
+#                    cleared out (default 24)
+#   --check-only     list the expired reservations, change nothing
+#
+# The config file needs the [rds] and [s3] sections and the
+# [s3readwrite] credentials, as in the lambdas' config file.
+#
+
+import boto3
+import datatier
+import migrate
+import os
+import sys
+
+from configparser import ConfigParser
+
+
+def expired_uploads(dbConn, after, grace_hours, batch):
+  """
+  Returns (uploadid, bucketkey, s3_uploadid) of the next batch of
+  unfinalized reservations expired for over grace_hours, in
+  uploadid order after the given uploadid
+  """
+  sql = """
+    SELECT uploadid, bucketkey, s3_uploadid
+      FROM pending_uploads
+     WHERE photoid IS NULL AND uploadid > %s
+       AND created_at + INTERVAL expires_in SECOND + INTERVAL %s HOUR < NOW()
+     ORDER BY uploadid
+     LIMIT %s;
+  """
+  return datatier.retrieve_all_rows(dbConn, sql, [after, grace_hours, batch])
+
+
+def discard(dbConn, uploadid):
+  """
+  Deletes the reservation unless it has been finalized since it
+  was listed; returns True if it was deleted
+  """
+  with datatier.transaction(dbConn) as tx:
+    sql = "SELECT photoid FROM pending_uploads WHERE uploadid = %s FOR UPDATE;"
+    row = tx.retrieve_one_row(sql, [uploadid])
+    if row == () or row[0] is not None:
+      return False
+    tx.perform_action("DELETE FROM pending_uploads WHERE uploadid = %s;", [uploadid])
+    return True
+
+
+def expire(dbConn, s3, bucketname, grace_hours, batch, check_only=False):
+  """
+  Clears out the expired reservations; returns the number
+  cleared (or, with check_only, found)
+  """
+  cleared = 0
+  after = 0
+
+  while True:
+    rows = expired_uploads(dbConn, after, grace_hours, batch)
+    if not rows:
+      break
+
+    for uploadid, bucketkey, s3_uploadid in rows:
+      if check_only:
+        print(f"upload {uploadid}: {bucketkey}")
+        cleared += 1
+        continue
+
+      if not discard(dbConn, uploadid):
+        continue
+
+      #
+      # the reservation is gone, so nothing can finalize the
+      # upload now; its object and parts can go:
+      #
+      try:
+        if s3_uploadid is not None:
+          s3.abort_multipart_upload(Bucket=bucketname, Key=bucketkey, UploadId=s3_uploadid)
+      except s3.exceptions.ClientError as err:
+        if err.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+          print(f"upload {uploadid} ({bucketkey}): {err}")
+      try:
+        s3.delete_object(Bucket=bucketname, Key=bucketkey)
+      except Exception as err:
+        print(f"upload {uploadid} ({bucketkey}): {err}")
+
+      cleared += 1
+
+    after = rows[-1][0]
+
+  return cleared
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  config_file = args[0] if args else "final-project-config.ini"
+
+  grace_hours = 24
+  batch = 100
+  for arg in sys.argv[1:]:
+    if arg.startswith("--grace-hours="):
+      grace_hours = int(arg[len("--grace-hours="):])
+    elif arg.startswith("--batch="):
+      batch = int(arg[len("--batch="):])
+  check_only = "--check-only" in sys.argv
+
+  configur = ConfigParser()
+  configur.read(config_file)
+  bucketname = configur.get("s3", "bucket_name")
+
+  os.environ["AWS_SHARED_CREDENTIALS_FILE"] = config_file
+  s3 = boto3.Session(profile_name="s3readwrite").client("s3")
+
+  dbConn = migrate.connect(config_file)
+  try:
+    cleared = expire(dbConn, s3, bucketname, grace_hours, batch, check_only)
+  finally:
+    dbConn.close()
+
+  if check_only:
+    print(f"** {cleared} expired reservation(s) **")
+  else:
+    print(f"** {cleared} expired reservation(s) cleared **")
@@ -0,0 +1,201 @@
+#
+# explain_check.py
+#
+# Runs EXPLAIN on the queries the lambdas execute on their hot
+# paths and checks that MySQL resolves every table access
+# through an index rather than a full table scan. Run it after
+# migrate.py; exits with status 1 if any query scans a table.
+#
+# Usage:
+#   python explain_check.py [config_file]
+#
+# Keep QUERIES in step with the SQL in the lambda_* handlers.
+#
+
+import migrate
+import pymysql
+import sys
+
+
+#
+# (name, sql, sample parameters):
+#
+QUERIES = [
+  ("lambda_users: page of users",
+   "SELECT * FROM users WHERE userid > %s ORDER BY userid LIMIT %s",
+   [0, 101]),
+  ("lambda_list_image: user check",
+   "SELECT * FROM users WHERE userid = %s;",
+   [80001]),
+  ("lambda_list_image: photos of a user",
+   """
+   SELECT photoid, userid, original_name,
+          width, height, format, bytesize, mode, sha256
+     FROM photos
+    WHERE userid=%s AND photoid > %s
+    ORDER BY photoid
+    LIMIT %s
+   """,
+   [80001, 0, 101]),
+  ("lambda_metadata: metadata of a photo",
+   """
+   SELECT photoid, userid, original_name, width, height, format, bytesize, mode, sha256
+     FROM photos
+    WHERE photoid = %s AND userid = %s;
+   """,
+   [10001, 80001]),
+  ("lambda_gallery_label: labels of a user",
+   """
+   SELECT n.labelname, c.photo_count
+     FROM label_counts c
+     JOIN label_names n ON n.labelid = c.labelid
+    WHERE c.userid = %s AND c.photo_count > 0
+    ORDER BY n.labelname;
+   """,
+   [80001]),
+  ("lambda_gallery_photos: photos with a label",
+   """
+   SELECT p.photoid, p.original_name, p.bucketkey, n.labelname, pl.confidence
+     FROM label_names n
+     JOIN photo_labels pl ON pl.labelid = n.labelid
+     JOIN photos p ON p.photoid = pl.photoid
+    WHERE n.labelname = %s AND pl.userid = %s
+      AND pl.confidence >= %s
+      AND (pl.confidence < %s OR (pl.confidence = %s AND pl.photoid < %s))
+    ORDER BY pl.confidence DESC, pl.photoid DESC
+    LIMIT %s
+   """,
+   ["Cat", 80001, 80.0, 101.0, 101.0, 0, 101]),
+  ("lambda_recognition: label ids by name",
+   "SELECT labelid, labelname FROM label_names WHERE labelname IN (%s, %s);",
+   ["Cat", "Dog"]),
+  ("lambda_upload: content object by hash",
+   "SELECT bucketkey FROM content_objects WHERE sha256 = %s;",
+   ["0" * 64]),
+  ("lambda_upload: labelled photo of an object",
+   """
+   SELECT p.photoid FROM photos p
+    WHERE p.bucketkey = %s AND p.photoid <> %s
+      AND EXISTS (SELECT 1 FROM photo_labels pl WHERE pl.photoid = p.photoid)
+    LIMIT 1;
+   """,
+   ["pixeltailor/folder/cat.jpg", 10001]),
+  ("lambda_recognition: pending upload of an object",
+   """
+   SELECT uploadid, userid, original_name, bucketkey, bytesize, sha256, photoid,
+          created_at + INTERVAL expires_in SECOND < NOW()
+     FROM pending_uploads WHERE bucketkey = %s;
+   """,
+   ["pixeltailor/folder/cat.jpg"]),
+  ("lambda_recognition: unfinalized uploads of an event",
+   """
+   SELECT bucketkey FROM pending_uploads
+    WHERE bucketkey IN (%s, %s) AND photoid IS NULL;
+   """,
+   ["pixeltailor/folder/cat.jpg", "pixeltailor/folder/dog.jpg"]),
+  ("lambda_recognition: metadata of an object",
+   "SELECT bytesize, format, width, height, sha256 FROM photos WHERE bucketkey = %s LIMIT 1;",
+   ["pixeltailor/folder/cat.jpg"]),
+  ("lambda_recognition: cached labels of content",
+   """
+   SELECT labels, model_version FROM recognition_cache
+    WHERE sha256 = %s AND policy = %s
+      AND (expires_at IS NULL OR expires_at > NOW());
+   """,
+   ["0" * 64, "rekognition:v1:max_labels=10:min_confidence=55"]),
+  ("lambda_recognition: photos of an object",
+   "SELECT photoid, userid FROM photos WHERE bucketkey = %s;",
+   ["pixeltailor/folder/cat.jpg"]),
+  ("lambda_delete: content objects of photos",
+   "SELECT bucketkey, refcount FROM content_objects WHERE bucketkey IN (%s, %s);",
+   ["pixeltailor/folder/cat.jpg", "pixeltailor/folder/dog.jpg"]),
+  ("lambda_similar: near matches by hash chunk",
+   """
+   SELECT p.photoid, p.original_name, BIT_COUNT(p.phash ^ %s) AS distance
+     FROM (SELECT photoid FROM photos WHERE userid = %s AND phash_0 IN (%s, %s)
+           UNION SELECT photoid FROM photos WHERE userid = %s AND phash_1 IN (%s, %s)
+           UNION SELECT photoid FROM photos WHERE userid = %s AND phash_2 IN (%s, %s)
+           UNION SELECT photoid FROM photos WHERE userid = %s AND phash_3 IN (%s, %s)) c
+     JOIN photos p ON p.photoid = c.photoid
+    WHERE p.photoid <> %s AND BIT_COUNT(p.phash ^ %s) <= %s
+    ORDER BY distance, p.photoid
+    LIMIT %s;
+   """,
+   [0, 80001, 0, 1, 80001, 0, 1, 80001, 0, 1, 80001, 0, 1, 10001, 0, 10, 100]),
+  ("lambda_download: photo of a user",
+   "SELECT bucketkey, original_name, format, bytesize FROM photos WHERE photoid = %s AND userid = %s;",
+   [10001, 80001]),
+  ("lambda_delete: photo of a user",
+   "SELECT photoid, bucketkey FROM photos WHERE photoid = %s AND userid = %s FOR UPDATE;",
+   [10001, 80001]),
+]
+
+#
+# queries that are allowed to read a whole table, because
+# that is what they are for:
+#
+FULL_SCAN_OK = set()
+
+
+def explain(dbConn, sql, parameters):
+  """
+  Returns the EXPLAIN output for the query as a list of dicts
+  """
+  dbCursor = dbConn.cursor(pymysql.cursors.DictCursor)
+  try:
+    dbCursor.execute("EXPLAIN " + sql, parameters)
+    return dbCursor.fetchall()
+  finally:
+    dbCursor.close()
+
+
+def check(dbConn):
+  """
+  EXPLAINs every query in QUERIES and prints the access path of
+  each table; returns the names of queries that scan a table
+  """
+  failures = []
+
+  for name, sql, parameters in QUERIES:
+    plan = explain(dbConn, sql, parameters)
+    ok = True
+
+    print(name)
+    for step in plan:
+      #
+      # type ALL is a full table scan; index is a full scan of
+      # an index, which is only acceptable when it is covering
+      # and the query is meant to read everything. Tables named
+      # <derivedN> / <unionN,M> are the query's own temporary
+      # results, which are always read in full:
+      #
+      scans = step["type"] in ("ALL", "index") and name not in FULL_SCAN_OK
+      temporary = step["table"] is not None and step["table"].startswith("<")
+      if step["table"] is not None and scans and not temporary:
+        ok = False
+      print(f"  {step['table']}: type={step['type']} key={step['key']} "
+            f"rows={step['rows']} extra={step['Extra']}")
+
+    print("  " + ("OK" if ok else "FULL SCAN"))
+    if not ok:
+      failures.append(name)
+
+  return failures
+
+
+if __name__ == "__main__":
+  config_file = sys.argv[1] if len(sys.argv) > 1 else "final-project-config.ini"
+
+  dbConn = migrate.connect(config_file)
+  try:
+    failures = check(dbConn)
+  finally:
+    dbConn.close()
+
+  if failures:
+    print(f"** {len(failures)} quer(ies) not using an index: **")
+    for name in failures:
+      print("  " + name)
+    sys.exit(1)
+
+  print("** all queries use an index **")
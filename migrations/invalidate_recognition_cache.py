@@ -0,0 +1,77 @@
+#
+# invalidate_recognition_cache.py
+#
+# Deletes entries from the recognition_cache table (see
+# migration 11). lambda_recognition only uses entries of its
+# current policy, so entries of an old policy (left behind when
+# the backend, max_labels, min_confidence or cache_version
+# changed) are dead weight; this clears them out, as well as
+# expired entries. Deletes in batches, so recognition is not
+# held up by one long delete.
+#
+# Usage:
+#   python invalidate_recognition_cache.py [config_file] [--expired]
+#                                          [--policy=P] [--except=P] [--all]
+#
+#   --expired    entries past their TTL (the default)
+#   --policy=P   entries of policy P
+#   --except=P   entries of every policy but P, i.e. the current one
+#   --all        every entry
+#
+# Policies look like rekognition:v1:max_labels=10:min_confidence=55;
+# --list shows the policies in the cache and their entry counts.
+#
+
+import datatier
+import migrate
+import sys
+
+BATCH_SIZE = 1000
+
+
+def policies(dbConn):
+  """
+  Returns a list of (policy, entries) in the cache
+  """
+  sql = "SELECT policy, COUNT(*) FROM recognition_cache GROUP BY policy ORDER BY policy;"
+  return datatier.retrieve_all_rows(dbConn, sql)
+
+
+def invalidate(dbConn, where, parameters=[]):
+  """
+  Deletes the cache entries matching the WHERE condition, in
+  batches; returns the number deleted
+  """
+  sql = f"DELETE FROM recognition_cache WHERE {where} LIMIT {BATCH_SIZE};"
+  deleted = 0
+
+  while True:
+    modified = datatier.perform_action(dbConn, sql, parameters)
+    deleted += modified
+    if modified < BATCH_SIZE:
+      return deleted
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  config_file = args[0] if args else "final-project-config.ini"
+
+  where, parameters = "expires_at <= NOW()", []
+  for arg in sys.argv[1:]:
+    if arg.startswith("--policy="):
+      where, parameters = "policy = %s", [arg[len("--policy="):]]
+    elif arg.startswith("--except="):
+      where, parameters = "policy <> %s", [arg[len("--except="):]]
+    elif arg == "--all":
+      where, parameters = "1 = 1", []
+
+  dbConn = migrate.connect(config_file)
+  try:
+    if "--list" in sys.argv:
+      for policy, entries in policies(dbConn):
+        print(f"{policy}: {entries}")
+    else:
+      deleted = invalidate(dbConn, where, parameters)
+      print(f"** {deleted} cache entr(ies) deleted **")
+  finally:
+    dbConn.close()
@@ -0,0 +1,120 @@
+#
+# migrate.py
+#
+# Applies the versioned schema migrations in versions/ to the
+# PixelTailor database, in order. Each migration is a module
+# named mNNN_<description>.py defining VERSION, DESCRIPTION and
+# upgrade(dbConn). Applied versions are recorded in the
+# schema_migrations table, so running this again only applies
+# new migrations; the migrations themselves are also written
+# to be safely re-run (see schema.py).
+#
+# Usage:
+#   python migrate.py [config_file]           apply pending migrations
+#   python migrate.py [config_file] --status  list applied / pending
+#
+# The config file (default final-project-config.ini) needs an
+# [rds] section, the same as the lambdas use; point it at a
+# local MySQL to try migrations out before running on RDS.
+#
+
+import datatier
+import importlib
+import pathlib
+import sys
+
+from configparser import ConfigParser
+
+
+def load_migrations():
+  """
+  Returns the migration modules in versions/, sorted by VERSION
+  """
+  folder = pathlib.Path(__file__).parent / "versions"
+  migrations = []
+
+  for path in sorted(folder.glob("m[0-9][0-9][0-9]_*.py")):
+    module = importlib.import_module("versions." + path.stem)
+    migrations.append(module)
+
+  migrations.sort(key=lambda m: m.VERSION)
+
+  versions = [m.VERSION for m in migrations]
+  if len(versions) != len(set(versions)):
+    raise Exception("duplicate migration VERSION in versions/")
+
+  return migrations
+
+
+def applied_versions(dbConn):
+  """
+  Returns the set of migration versions already applied,
+  creating the schema_migrations table if needed
+  """
+  sql = """
+    CREATE TABLE IF NOT EXISTS schema_migrations
+    (
+        version      int not null,
+        description  varchar(256) not null,
+        applied_at   timestamp not null default CURRENT_TIMESTAMP,
+        PRIMARY KEY  (version)
+    );
+  """
+  datatier.perform_action(dbConn, sql)
+
+  rows = datatier.retrieve_all_rows(dbConn, "SELECT version FROM schema_migrations;")
+  return {row[0] for row in rows}
+
+
+def migrate(dbConn, status_only=False):
+  """
+  Applies every pending migration in order, and returns the
+  list of versions applied
+  """
+  done = applied_versions(dbConn)
+  applied = []
+
+  for migration in load_migrations():
+    state = "applied" if migration.VERSION in done else "pending"
+    print(f"{migration.VERSION:03d} {state:8s} {migration.DESCRIPTION}")
+
+    if status_only or migration.VERSION in done:
+      continue
+
+    migration.upgrade(dbConn)
+
+    sql = "INSERT INTO schema_migrations(version, description) VALUES(%s, %s);"
+    datatier.perform_action(dbConn, sql, [migration.VERSION, migration.DESCRIPTION])
+    applied.append(migration.VERSION)
+    print(f"{migration.VERSION:03d} done")
+
+  return applied
+
+
+def connect(config_file):
+  """
+  Opens a connection to the (primary) database named in the
+  config file
+  """
+  if not pathlib.Path(config_file).is_file():
+    raise Exception(f"config file '{config_file}' does not exist")
+
+  configur = ConfigParser()
+  configur.read(config_file)
+
+  endpoint, portnum, username, pwd, dbname = datatier.rds_settings(configur)
+  return datatier.get_dbConn(endpoint, portnum, username, pwd, dbname)
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  config_file = args[0] if args else "final-project-config.ini"
+  status_only = "--status" in sys.argv
+
+  dbConn = connect(config_file)
+  try:
+    applied = migrate(dbConn, status_only)
+    if not status_only:
+      print(f"** {len(applied)} migration(s) applied **")
+  finally:
+    dbConn.close()
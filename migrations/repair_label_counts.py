@@ -0,0 +1,98 @@
+#
+# repair_label_counts.py
+#
+# Consistency check and repair for the label_counts table,
+# which lambda_recognition and lambda_delete maintain
+# incrementally. Recomputes every user's label counts from
+# photo_labels, reports any that differ, and (unless
+# --check-only) corrects them. Counts are recomputed from a
+# snapshot, so run it when uploads and deletes are quiet.
+#
+# Usage:
+#   python repair_label_counts.py [config_file] [--check-only] [--user=N]
+#
+
+import datatier
+import migrate
+import sys
+
+
+def find_drift(dbConn, userid=None):
+  """
+  Returns a list of (userid, labelid, stored count, actual
+  count) for every label count that is wrong or missing
+  """
+  where_c = "WHERE c.userid = %s" if userid is not None else ""
+  where_pl = "WHERE userid = %s" if userid is not None else ""
+  parameters = [userid] if userid is not None else []
+
+  sql = f"""
+    SELECT c.userid, c.labelid, c.photo_count
+      FROM label_counts c
+      {where_c};
+  """
+  stored = {(row[0], row[1]): row[2]
+            for row in datatier.retrieve_all_rows(dbConn, sql, parameters)}
+
+  sql = f"""
+    SELECT userid, labelid, COUNT(*)
+      FROM photo_labels
+      {where_pl}
+     GROUP BY userid, labelid;
+  """
+  actual = {(row[0], row[1]): row[2]
+            for row in datatier.retrieve_all_rows(dbConn, sql, parameters)}
+
+  drift = []
+  for key in sorted(set(stored) | set(actual)):
+    if stored.get(key, 0) != actual.get(key, 0):
+      drift.append((key[0], key[1], stored.get(key), actual.get(key, 0)))
+
+  return drift
+
+
+def repair(dbConn, drift):
+  """
+  Sets each drifted label count to its actual value, in one
+  transaction
+  """
+  with datatier.transaction(dbConn) as tx:
+    upserts = [[userid, labelid, count] for userid, labelid, stored, count in drift if count > 0]
+    removals = [[userid, labelid] for userid, labelid, stored, count in drift if count == 0]
+
+    sql = """
+      INSERT INTO label_counts (userid, labelid, photo_count) VALUES (%s, %s, %s)
+      ON DUPLICATE KEY UPDATE photo_count = VALUES(photo_count)
+    """
+    tx.perform_bulk_action(sql, upserts)
+
+    sql = "DELETE FROM label_counts WHERE userid = %s AND labelid = %s"
+    tx.perform_bulk_action(sql, removals)
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  config_file = args[0] if args else "final-project-config.ini"
+  check_only = "--check-only" in sys.argv
+
+  userid = None
+  for arg in sys.argv[1:]:
+    if arg.startswith("--user="):
+      userid = int(arg[len("--user="):])
+
+  dbConn = migrate.connect(config_file)
+  try:
+    drift = find_drift(dbConn, userid)
+
+    for userid_, labelid, stored, count in drift:
+      print(f"user {userid_} label {labelid}: stored {stored}, actual {count}")
+    print(f"** {len(drift)} label count(s) out of step **")
+
+    if drift and not check_only:
+      repair(dbConn, drift)
+      print("** repaired **")
+  finally:
+    dbConn.close()
+
+  if drift and check_only:
+    sys.exit(1)
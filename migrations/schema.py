@@ -0,0 +1,125 @@
+#
+# schema.py
+#
+# Helpers for writing idempotent migrations: MySQL commits DDL
+# statements implicitly, so a migration that fails half way
+# cannot be rolled back. Instead, each step checks the current
+# schema (through information_schema) and is skipped if it has
+# already been applied, so a migration can simply be re-run.
+#
+
+import datatier
+
+
+def table_exists(dbConn, table):
+  """
+  Returns True if the table exists in the current database
+  """
+  sql = """
+    SELECT COUNT(*) FROM information_schema.tables
+     WHERE table_schema = DATABASE() AND table_name = %s;
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [table])
+  return row[0] > 0
+
+
+def column_exists(dbConn, table, column):
+  """
+  Returns True if the table has the given column
+  """
+  sql = """
+    SELECT COUNT(*) FROM information_schema.columns
+     WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s;
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [table, column])
+  return row[0] > 0
+
+
+def index_exists(dbConn, table, index):
+  """
+  Returns True if the table has an index with the given name
+  """
+  sql = """
+    SELECT COUNT(*) FROM information_schema.statistics
+     WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s;
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [table, index])
+  return row[0] > 0
+
+
+def create_index(dbConn, table, index, columns, unique=False):
+  """
+  Creates the index unless an index with that name already
+  exists; returns True if it was created
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  table : table name (string),
+  index : index name (string),
+  columns : list of column names, in index order,
+  unique : True for a UNIQUE index (boolean)
+  """
+  if index_exists(dbConn, table, index):
+    print("  index", index, "already exists, skipping")
+    return False
+
+  kind = "UNIQUE INDEX" if unique else "INDEX"
+  sql = f"CREATE {kind} {index} ON {table} ({', '.join(columns)});"
+  print("  " + sql)
+  datatier.perform_action(dbConn, sql)
+  return True
+
+
+def add_column(dbConn, table, column, definition):
+  """
+  Adds the column unless it already exists; returns True if it
+  was added
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  table : table name (string),
+  column : column name (string),
+  definition : column type and options, e.g. "int null" (string)
+  """
+  if column_exists(dbConn, table, column):
+    print("  column", table + "." + column, "already exists, skipping")
+    return False
+
+  sql = f"ALTER TABLE {table} ADD COLUMN {column} {definition};"
+  print("  " + sql)
+  datatier.perform_action(dbConn, sql)
+  return True
+
+
+def unique_index_on(dbConn, table, column):
+  """
+  Returns the name of the single-column UNIQUE index on the
+  column, or None if there is none (a UNIQUE constraint
+  declared in CREATE TABLE gets a name chosen by MySQL)
+  """
+  sql = """
+    SELECT s.index_name FROM information_schema.statistics s
+     WHERE s.table_schema = DATABASE() AND s.table_name = %s
+       AND s.column_name = %s AND s.non_unique = 0
+       AND (SELECT COUNT(*) FROM information_schema.statistics t
+             WHERE t.table_schema = s.table_schema AND t.table_name = s.table_name
+               AND t.index_name = s.index_name) = 1;
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [table, column])
+  return row[0] if row else None
+
+
+def drop_index(dbConn, table, index):
+  """
+  Drops the index if it exists; returns True if it was dropped
+  """
+  if not index_exists(dbConn, table, index):
+    print("  index", index, "does not exist, skipping")
+    return False
+
+  sql = f"DROP INDEX {index} ON {table};"
+  print("  " + sql)
+  datatier.perform_action(dbConn, sql)
+  return True
@@ -0,0 +1,38 @@
+#
+# The original schema created the table as "lables", but every
+# lambda reads and writes "labels". Rename it (or create it, if
+# neither exists yet).
+#
+
+import datatier
+import schema
+
+VERSION = 1
+DESCRIPTION = "rename lables table to labels"
+
+
+def upgrade(dbConn):
+  if schema.table_exists(dbConn, "labels"):
+    if schema.table_exists(dbConn, "lables"):
+      print("  both labels and lables exist; leaving lables in place")
+    return
+
+  if schema.table_exists(dbConn, "lables"):
+    print("  RENAME TABLE lables TO labels;")
+    datatier.perform_action(dbConn, "RENAME TABLE lables TO labels;")
+    return
+
+  sql = """
+    CREATE TABLE labels
+    (
+        lableid           int not null AUTO_INCREMENT,
+        photoid           int not null,
+        userid            int not null,
+        labelname         varchar(256) not null,  -- cat or dog or...
+        PRIMARY KEY (lableid),
+        FOREIGN KEY (photoid) REFERENCES photos(photoid),
+        FOREIGN KEY (userid) REFERENCES users(userid)
+    ) AUTO_INCREMENT = 101;
+  """
+  print("  CREATE TABLE labels")
+  datatier.perform_action(dbConn, sql)
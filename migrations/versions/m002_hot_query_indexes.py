@@ -0,0 +1,25 @@
+#
+# Secondary indexes for the hottest handler queries:
+#
+#  - lambda_gallery_label:  SELECT DISTINCT labelname FROM labels
+#                            WHERE userid = %s ORDER BY labelname
+#  - lambda_gallery_photos: labels WHERE userid = %s AND
+#                            labelname = %s, joined to photos
+#  - lambda_list_image:     photos WHERE userid = %s ORDER BY photoid
+#
+# (userid, labelname, photoid) covers the first two: the label
+# list is read straight off the index in order, and the photo
+# join finds its photoids without touching the labels rows.
+#
+
+import schema
+
+VERSION = 2
+DESCRIPTION = "indexes for label gallery and photo listing queries"
+
+
+def upgrade(dbConn):
+  schema.create_index(dbConn, "labels", "ix_labels_user_label_photo",
+                      ["userid", "labelname", "photoid"])
+  schema.create_index(dbConn, "photos", "ix_photos_user_photo",
+                      ["userid", "photoid"])
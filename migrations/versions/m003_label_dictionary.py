@@ -0,0 +1,66 @@
+#
+# Normalizes labels: each distinct label name is stored once in
+# label_names (with an integer labelid), and photo_labels links
+# photos to labelids. The (photoid, labelid) primary key makes
+# re-inserting a photo's labels (e.g. when S3 redelivers an
+# event) a no-op. Existing rows in labels are backfilled, and
+# the labels table is then dropped.
+#
+
+import datatier
+import schema
+
+VERSION = 3
+DESCRIPTION = "label_names dictionary and photo_labels junction table"
+
+
+def upgrade(dbConn):
+  if not schema.table_exists(dbConn, "label_names"):
+    sql = """
+      CREATE TABLE label_names
+      (
+          labelid       int not null AUTO_INCREMENT,
+          labelname     varchar(256) not null,  -- cat or dog or...
+          PRIMARY KEY   (labelid),
+          UNIQUE        (labelname)
+      );
+    """
+    print("  CREATE TABLE label_names")
+    datatier.perform_action(dbConn, sql)
+
+  if not schema.table_exists(dbConn, "photo_labels"):
+    sql = """
+      CREATE TABLE photo_labels
+      (
+          photoid       int not null,
+          labelid       int not null,
+          userid        int not null,  -- owner of the photo, for per-user lookups
+          PRIMARY KEY   (photoid, labelid),
+          INDEX ix_photo_labels_user_label_photo (userid, labelid, photoid),
+          FOREIGN KEY   (photoid) REFERENCES photos(photoid),
+          FOREIGN KEY   (labelid) REFERENCES label_names(labelid),
+          FOREIGN KEY   (userid) REFERENCES users(userid)
+      );
+    """
+    print("  CREATE TABLE photo_labels")
+    datatier.perform_action(dbConn, sql)
+
+  if schema.table_exists(dbConn, "labels"):
+    print("  backfilling label_names and photo_labels from labels")
+
+    sql = """
+      INSERT IGNORE INTO label_names (labelname)
+        SELECT DISTINCT labelname FROM labels;
+    """
+    datatier.perform_action(dbConn, sql)
+
+    sql = """
+      INSERT IGNORE INTO photo_labels (photoid, labelid, userid)
+        SELECT l.photoid, n.labelid, l.userid
+          FROM labels l
+          JOIN label_names n ON n.labelname = l.labelname;
+    """
+    datatier.perform_action(dbConn, sql)
+
+    print("  DROP TABLE labels;")
+    datatier.perform_action(dbConn, "DROP TABLE labels;")
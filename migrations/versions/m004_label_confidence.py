@@ -0,0 +1,65 @@
+#
+# Keeps what Rekognition tells us about each label rather than
+# just its name:
+#
+#  - photo_labels.confidence, indexed as (userid, labelid,
+#    confidence, photoid) so a gallery can filter by minimum
+#    confidence and rank by it straight from the index;
+#  - label_parents, the label hierarchy (e.g. Cat -> Pet ->
+#    Animal), which belongs to the label, not the photo;
+#  - label_instances, the bounding boxes of each instance of a
+#    label found in a photo (fractions of the image size).
+#
+
+import datatier
+import schema
+
+VERSION = 4
+DESCRIPTION = "label confidence, parents and instance boxes"
+
+
+def upgrade(dbConn):
+  #
+  # (double, not float: MySQL returns a float rounded to ~6
+  # digits, which would not compare equal to the stored value
+  # when used as a page key)
+  #
+  schema.add_column(dbConn, "photo_labels", "confidence",
+                    "double not null default 0")  # 0-100, from Rekognition
+  schema.create_index(dbConn, "photo_labels", "ix_photo_labels_user_label_conf",
+                      ["userid", "labelid", "confidence", "photoid"])
+
+  if not schema.table_exists(dbConn, "label_parents"):
+    sql = """
+      CREATE TABLE label_parents
+      (
+          labelid       int not null,
+          parentid      int not null,  -- labelid of the parent category
+          PRIMARY KEY   (labelid, parentid),
+          FOREIGN KEY   (labelid) REFERENCES label_names(labelid),
+          FOREIGN KEY   (parentid) REFERENCES label_names(labelid)
+      );
+    """
+    print("  CREATE TABLE label_parents")
+    datatier.perform_action(dbConn, sql)
+
+  if not schema.table_exists(dbConn, "label_instances"):
+    sql = """
+      CREATE TABLE label_instances
+      (
+          instanceid    int not null AUTO_INCREMENT,
+          photoid       int not null,
+          labelid       int not null,
+          confidence    float not null,
+          box_left      float not null,  -- bounding box, as fractions
+          box_top       float not null,  -- of the image width / height
+          box_width     float not null,
+          box_height    float not null,
+          PRIMARY KEY   (instanceid),
+          INDEX ix_label_instances_photo_label (photoid, labelid),
+          FOREIGN KEY   (photoid) REFERENCES photos(photoid),
+          FOREIGN KEY   (labelid) REFERENCES label_names(labelid)
+      );
+    """
+    print("  CREATE TABLE label_instances")
+    datatier.perform_action(dbConn, sql)
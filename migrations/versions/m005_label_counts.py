@@ -0,0 +1,39 @@
+#
+# label_counts holds, per user and label, the number of the
+# user's photos with that label. lambda_recognition and
+# lambda_delete keep it up to date as labels are added and
+# photos removed, so the label gallery is a single read of the
+# user's rows instead of a DISTINCT over all their labels.
+# repair_label_counts.py recomputes it if it ever drifts.
+#
+
+import datatier
+import schema
+
+VERSION = 5
+DESCRIPTION = "materialized per-user label counts"
+
+
+def upgrade(dbConn):
+  if not schema.table_exists(dbConn, "label_counts"):
+    sql = """
+      CREATE TABLE label_counts
+      (
+          userid        int not null,
+          labelid       int not null,
+          photo_count   int not null default 0,
+          PRIMARY KEY   (userid, labelid),
+          FOREIGN KEY   (userid) REFERENCES users(userid),
+          FOREIGN KEY   (labelid) REFERENCES label_names(labelid)
+      );
+    """
+    print("  CREATE TABLE label_counts")
+    datatier.perform_action(dbConn, sql)
+
+  print("  computing label_counts from photo_labels")
+  sql = """
+    INSERT INTO label_counts (userid, labelid, photo_count)
+      SELECT userid, labelid, COUNT(*) FROM photo_labels GROUP BY userid, labelid
+    ON DUPLICATE KEY UPDATE photo_count = VALUES(photo_count);
+  """
+  datatier.perform_action(dbConn, sql)
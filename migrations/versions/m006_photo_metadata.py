@@ -0,0 +1,25 @@
+#
+# Stores what lambda_upload learns from the image header next
+# to each photo: pixel dimensions, format (JPEG / PNG), Pillow
+# mode, size in bytes, and a SHA-256 of the content. Handlers
+# use these to validate requests and size responses without
+# fetching the object from S3.
+#
+# The columns are nullable: photos uploaded before this
+# migration have no metadata until backfill_photo_metadata.py
+# is run, and the handlers fall back to reading S3 for them.
+#
+
+import schema
+
+VERSION = 6
+DESCRIPTION = "image metadata on photos"
+
+
+def upgrade(dbConn):
+  schema.add_column(dbConn, "photos", "width", "int null")     # pixels
+  schema.add_column(dbConn, "photos", "height", "int null")    # pixels
+  schema.add_column(dbConn, "photos", "format", "varchar(16) null")  # e.g. JPEG, PNG
+  schema.add_column(dbConn, "photos", "bytesize", "int null")  # size of the S3 object
+  schema.add_column(dbConn, "photos", "mode", "varchar(16) null")    # e.g. RGB, RGBA, L
+  schema.add_column(dbConn, "photos", "sha256", "char(64) null")     # hex digest of the content
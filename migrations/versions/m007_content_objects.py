@@ -0,0 +1,58 @@
+#
+# Content-hash deduplication of uploads. content_objects holds
+# one row per distinct image content (by SHA-256) stored in S3,
+# with the number of photos that refer to it. lambda_upload
+# looks a new upload's hash up here and, on a hit, points the
+# new photo at the existing object instead of storing another
+# copy; lambda_delete only removes the object from S3 when its
+# last reference goes.
+#
+# Photos may now share a bucketkey, so photos.bucketkey is no
+# longer UNIQUE (but stays indexed, for lambda_recognition's
+# lookup by bucketkey).
+#
+# Photos uploaded before this migration are registered if their
+# hash is known (see backfill_photo_metadata.py); when several
+# old photos hold identical content in different objects, the
+# earliest is registered and the others keep their own object.
+#
+
+import datatier
+import schema
+
+VERSION = 7
+DESCRIPTION = "content-hash deduplication of S3 objects"
+
+
+def upgrade(dbConn):
+  if not schema.table_exists(dbConn, "content_objects"):
+    sql = """
+      CREATE TABLE content_objects
+      (
+          sha256        char(64) not null,      -- hex digest of the content
+          bucketkey     varchar(256) not null,  -- the S3 object holding it
+          refcount      int not null default 0, -- # of photos using the object
+          created_at    timestamp not null default CURRENT_TIMESTAMP,
+          PRIMARY KEY   (sha256),
+          UNIQUE        (bucketkey)
+      );
+    """
+    print("  CREATE TABLE content_objects")
+    datatier.perform_action(dbConn, sql)
+
+  schema.create_index(dbConn, "photos", "ix_photos_bucketkey", ["bucketkey"])
+
+  unique = schema.unique_index_on(dbConn, "photos", "bucketkey")
+  if unique is not None:
+    schema.drop_index(dbConn, "photos", unique)
+
+  print("  registering existing photos in content_objects")
+  sql = """
+    INSERT IGNORE INTO content_objects (sha256, bucketkey, refcount)
+      SELECT sha256, bucketkey, COUNT(*)
+        FROM photos
+       WHERE sha256 IS NOT NULL
+       GROUP BY sha256, bucketkey
+       ORDER BY MIN(photoid);
+  """
+  datatier.perform_action(dbConn, sql)
@@ -0,0 +1,26 @@
+#
+# Perceptual hashes for the near-duplicate search. photos.phash
+# is the 64-bit dHash of the image (see imagemeta.dhash), and
+# phash_0 .. phash_3 are its four 16-bit chunks, each indexed
+# with the userid: lambda_similar looks up the chunk values
+# near a photo's chunks in these indexes (multi-index hashing,
+# see hashindex.py) rather than scanning the user's photos.
+#
+# Nullable, like the other image metadata: run
+# backfill_photo_metadata.py to hash photos uploaded before.
+#
+
+import hashindex
+import schema
+
+VERSION = 8
+DESCRIPTION = "perceptual hash with chunk indexes"
+
+
+def upgrade(dbConn):
+  schema.add_column(dbConn, "photos", "phash", "bigint unsigned null")
+
+  for i in range(hashindex.CHUNKS):
+    schema.add_column(dbConn, "photos", f"phash_{i}", "smallint unsigned null")
+    schema.create_index(dbConn, "photos", f"ix_photos_user_phash_{i}",
+                        ["userid", f"phash_{i}"])
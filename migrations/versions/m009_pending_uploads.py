@@ -0,0 +1,37 @@
+#
+# Reservations for presigned uploads. lambda_upload_url adds a
+# row when it hands the client a presigned PUT URL for a new
+# object; the row becomes a photo (photoid is set) once the
+# object has arrived and lambda_upload_finalize or
+# lambda_recognition has recorded it. Until then there is no
+# photos row, so nothing lists or labels a photo whose image
+# has not been uploaded yet.
+#
+
+import datatier
+import schema
+
+VERSION = 9
+DESCRIPTION = "pending presigned uploads"
+
+
+def upgrade(dbConn):
+  if not schema.table_exists(dbConn, "pending_uploads"):
+    sql = """
+      CREATE TABLE pending_uploads
+      (
+          uploadid       int not null AUTO_INCREMENT,
+          userid         int not null,
+          original_name  varchar(256) not null,
+          bucketkey      varchar(256) not null,  -- where the client PUTs the image
+          bytesize       int null,               -- as declared by the client
+          sha256         char(64) null,          -- as declared by the client
+          photoid        int null,               -- set once the upload is finalized
+          created_at     timestamp not null default CURRENT_TIMESTAMP,
+          PRIMARY KEY    (uploadid),
+          UNIQUE         (bucketkey),
+          FOREIGN KEY    (userid) REFERENCES users(userid)
+      );
+    """
+    print("  CREATE TABLE pending_uploads")
+    datatier.perform_action(dbConn, sql)
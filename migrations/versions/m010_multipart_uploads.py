@@ -0,0 +1,17 @@
+#
+# Multipart presigned uploads (lambda_multipart) reserve their
+# upload in pending_uploads too, and record the S3 multipart
+# upload id and the part size the client was told to use, so
+# the upload can be completed (or aborted) later, e.g. after
+# the client resumes an interrupted upload.
+#
+
+import schema
+
+VERSION = 10
+DESCRIPTION = "multipart upload state on pending uploads"
+
+
+def upgrade(dbConn):
+  schema.add_column(dbConn, "pending_uploads", "s3_uploadid", "varchar(1024) null")
+  schema.add_column(dbConn, "pending_uploads", "part_size", "int null")  # bytes
@@ -0,0 +1,38 @@
+#
+# Recognition results by image content. lambda_recognition looks
+# an image's SHA-256 up here before calling Rekognition, and on
+# a hit stores the cached labels instead of paying for another
+# detect_labels call. The policy column identifies the
+# recognition backend and its settings (MaxLabels,
+# MinConfidence and a version that can be bumped to start
+# afresh), so a change of policy misses the old entries;
+# invalidate_recognition_cache.py deletes them. expires_at is
+# NULL unless a TTL is configured.
+#
+
+import datatier
+import schema
+
+VERSION = 11
+DESCRIPTION = "recognition cache by content hash"
+
+
+def upgrade(dbConn):
+  if not schema.table_exists(dbConn, "recognition_cache"):
+    sql = """
+      CREATE TABLE recognition_cache
+      (
+          sha256         char(64) not null,      -- hex digest of the image content
+          policy         varchar(128) not null,  -- detect_labels settings used
+          model_version  varchar(32) null,       -- Rekognition's LabelModelVersion
+          labels         mediumtext not null,    -- JSON list of labels
+          created_at     timestamp not null default CURRENT_TIMESTAMP,
+          expires_at     timestamp null,
+          PRIMARY KEY    (sha256, policy)
+      );
+    """
+    print("  CREATE TABLE recognition_cache")
+    datatier.perform_action(dbConn, sql)
+
+  schema.create_index(dbConn, "recognition_cache", "ix_recognition_cache_policy", ["policy"])
+  schema.create_index(dbConn, "recognition_cache", "ix_recognition_cache_expires", ["expires_at"])
@@ -0,0 +1,21 @@
+#
+# Reservations in pending_uploads expire: expires_in is how many
+# seconds after created_at the client may still PUT the object,
+# i.e. the lifetime of its presigned URL (for a multipart
+# upload, of the whole upload). A reservation that expired
+# without being finalized is dead weight; lambda_upload_finalize
+# deletes it when its object never arrived, and
+# expire_pending_uploads.py clears out the rest. Rows added
+# before this migration have no expiry.
+#
+
+import schema
+
+VERSION = 12
+DESCRIPTION = "expiry of pending uploads"
+
+
+def upgrade(dbConn):
+  schema.add_column(dbConn, "pending_uploads", "expires_in", "int null")  # seconds
+  schema.create_index(dbConn, "pending_uploads", "ix_pending_uploads_unfinalized",
+                      ["photoid", "created_at"])